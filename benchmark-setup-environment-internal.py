@@ -0,0 +1,302 @@
+#! /usr/bin/env python3
+##
+## Benchmarks for setup_environment_internal.
+##
+## Runs against synthetic sources/ trees of increasing size (generated
+## in a temporary directory, with a stub oe-init-build-env, so no
+## network or real layers are needed) and prints how the time taken by
+## each operation scales with the size of the tree.
+##
+## Usage: benchmark-setup-environment-internal.py [--sizes 10,50,200]
+##            [--machines 5] [--modules <n>] [--conf-lines 20]
+##            [--save-baseline <file>] [--baseline <file> [--tolerance 1.5]]
+##
+## With --baseline, exits with an error if any operation got slower
+## than the time recorded in the baseline file multiplied by the
+## tolerance.  Baselines are only meaningful on the machine they have
+## been recorded on.
+##
+
+from setup_environment_internal import *
+import setup_environment_internal
+
+import argparse
+import shutil
+import tempfile
+import timeit
+
+###
+### The parse_assignment_expr() implementation based on a character by
+### character state machine and eval(), used as a reference
+###
+def legacy_parse_value(val):
+    # Eventually, the value might have quotes and we those need to be escaped or
+    # the `eval(...)` below might use invalid syntax.
+    if val.startswith('"') and val.endswith('"'):
+        val = '"' + val[1:-1].replace('"', '\\"') + '"'
+
+    return split_keep_spaces(str(eval(val)))
+
+def legacy_parse_assignment_expr(line):
+    var = ''
+    op = ''
+    val = ''
+    looking_for = 'var'
+    line = line.strip()
+    for pos, char in enumerate(line):
+        if looking_for == 'var':
+            if char not in ['=', '?', '+']:
+                if char == ' ':
+                    looking_for = 'op'
+                else:
+                    var += char
+            else:
+                looking_for = 'op'
+        elif looking_for == 'op':
+            if char in ['=', '?', ':', '+', '.']:
+                op += char
+                if len(char) > 3:
+                    raise Exception('Syntax error (operator): %s' % line)
+            elif char == ' ':
+                if op != '':
+                    if not op in ['=', '+=', '=+', '?=', '??=', ':=', '.=', '=.']:
+                        raise Exception('Invalid operator: %s' % op)
+                    looking_for = 'val'
+            else:
+                raise Exception('Syntax error (operator): %s' % line)
+        else:
+            val = line[pos:]
+            break
+    if var and op and val:
+        return (var, op, legacy_parse_value(val))
+    else:
+        return None # Not an assignment line
+
+
+def best_time(fn, repeat=5, number=1, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        times.append(timeit.timeit(fn, number=number))
+    return min(times)
+
+
+###
+### Synthetic sources tree
+###
+OE_INIT_BUILD_ENV_STUB = '''
+OEROOT=$(dirname $BASH_SOURCE)
+BUILDDIR=$(readlink -f ${1:-build})
+mkdir -p $BUILDDIR/conf
+touch $BUILDDIR/conf/local.conf $BUILDDIR/conf/bblayers.conf
+export BUILDDIR
+export PATH=$(readlink -f $OEROOT/scripts):$PATH
+cd $BUILDDIR
+'''
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+def make_sources_tree(platform_dir, layers, machines_per_layer=5, modules=None, conf_lines=20):
+    ''' Create a sources/ tree in platform_dir with the given number of
+    layers (half of them nested in layer repositories, like
+    meta-openembedded), machines per layer, hook modules (one per
+    layer by default) and layer.conf lines.  Return the list of layer
+    directories, starting with OE-Core's meta. '''
+    if modules is None:
+        modules = layers
+    sources_dir = os.path.join(platform_dir, 'sources')
+    write_file(os.path.join(sources_dir, 'poky', 'oe-init-build-env'), OE_INIT_BUILD_ENV_STUB)
+    write_file(os.path.join(sources_dir, 'poky', 'meta', 'conf', 'layer.conf'),
+               'BBFILE_COLLECTIONS += "core"\nBBFILE_PRIORITY_core = "5"\n')
+    layer_dirs = [os.path.join(sources_dir, 'poky', 'meta')]
+    for i in range(layers):
+        if i % 2:
+            layer_dir = os.path.join(sources_dir, 'meta-repo-%d' % (i // 10), 'meta-bench-%d' % i)
+        else:
+            layer_dir = os.path.join(sources_dir, 'meta-bench-%d' % i)
+        layer_conf = ['BBPATH .= ":${LAYERDIR}"',
+                      'BBFILES += "${LAYERDIR}/recipes-*/*/*.bb"',
+                      'BBFILE_COLLECTIONS += "bench%d"' % i,
+                      'BBFILE_PATTERN_bench%d = "^${LAYERDIR}/"' % i,
+                      'BBFILE_PRIORITY_bench%d = "%d"' % (i, i % 10 + 1),
+                      'LAYERSERIES_COMPAT_bench%d = "scarthgap"' % i]
+        layer_conf += [ '# comment %d' % j if j % 3 else 'BENCH_VAR_%d ?= "value %d"' % (j, j)
+                        for j in range(conf_lines - len(layer_conf)) ]
+        write_file(os.path.join(layer_dir, 'conf', 'layer.conf'), '\n'.join(layer_conf) + '\n')
+        for j in range(machines_per_layer):
+            write_file(os.path.join(layer_dir, 'conf', 'machine', 'bench-%d-%d.conf' % (i, j)),
+                       'MACHINEOVERRIDES =. "bench:"\n')
+        for j in range(4):
+            write_file(os.path.join(layer_dir, 'recipes-bench', 'bench-%d' % j, 'bench-%d_1.0.bb' % j), '')
+        layer_dirs.append(layer_dir)
+    for i in range(modules):
+        layer_dir = layer_dirs[1 + i % layers] if layers else layer_dirs[0]
+        write_file(os.path.join(layer_dir, 'setup-environment.d', 'bench-%d.py' % i),
+                   "def bench_%d_after_init():\n"
+                   "    set_var('BENCH_%d', 'x')\n"
+                   "\n"
+                   "run_after_init(bench_%d_after_init)\n" % (i, i, i))
+    ## Files modified in the last seconds are not trusted by the layer
+    ## index, so pretend the tree is older
+    old = time.time() - 3600
+    for dir, subdirs, files in os.walk(platform_dir):
+        for name in subdirs + files:
+            os.utime(os.path.join(dir, name), (old, old))
+    return layer_dirs
+
+def use_platform(platform_dir):
+    context = SetupContext(platform_dir)
+    context.oeroot = os.path.join(platform_dir, 'sources', 'poky')
+    context.layer_index_file = os.path.join(platform_dir, 'build', 'conf', '.layer-index.json')
+    setup_environment_internal.CACHE_DIR = os.path.join(platform_dir, 'cache')
+    reset_caches()
+    return context.activate()
+
+
+###
+### Synthetic trees benchmark
+###
+def bench_tree(size, machines_per_layer=5, modules=None, conf_lines=20):
+    ''' Return a dict mapping operations to the time (in seconds) they
+    take on a tree with `size' layers (see make_sources_tree() for the
+    other arguments) '''
+    results = {}
+    platform_dir = tempfile.mkdtemp(prefix='setup-environment-bench-')
+    environ = dict(os.environ)
+    try:
+        layer_dirs = make_sources_tree(platform_dir, size, machines_per_layer, modules, conf_lines)
+        context = use_platform(platform_dir)
+        index_file = context.layer_index_file
+
+        def no_index():
+            reset_caches()
+            if os.path.exists(index_file):
+                os.remove(index_file)
+
+        results['find_layers (no index)'] = best_time(find_layers, setup=no_index)
+        find_layers()
+        results['find_layers (index)'] = best_time(find_layers, setup=reset_caches)
+        results['find_modules (index)'] = best_time(find_modules, setup=reset_caches)
+        results['get_layer_priority (all layers)'] = \
+            best_time(lambda: [ get_layer_priority(l) for l in layer_dirs ], setup=reset_caches)
+
+        bblayers_file = os.path.join(platform_dir, 'bblayers.conf')
+        def new_bblayers():
+            reset_caches()
+            context.bblayers_conf = Conf(bblayers_file, quiet=True)
+            context.bblayers_conf.add('BBLAYERS', '?=', layer_dirs[0])
+        results['append_layers'] = best_time(lambda: append_layers(layer_dirs[1:]), setup=new_bblayers)
+
+        conf_file = os.path.join(platform_dir, 'local.conf')
+        conf = Conf(conf_file, quiet=True)
+        for i in range(size * 50):
+            conf.add('BENCH_VAR_%d' % i, '?=', 'value %d' % i)
+            conf.add('IMAGE_INSTALL', '+=', 'package-%d' % i)
+        def no_conf():
+            if os.path.exists(conf_file):
+                os.remove(conf_file)
+        results['Conf.write'] = best_time(conf.write, setup=no_conf)
+        results['Conf.read_conf'] = best_time(Conf(conf_file, quiet=True).read_conf)
+
+        lines = [ 'BENCH_VAR_%d ?= "value %d"' % (i, i) for i in range(size * 50) ]
+        results['parse_assignment_expr'] = best_time(lambda: [ parse_assignment_expr(l) for l in lines ])
+
+        bitbake_dir = os.path.join(platform_dir, 'sources', 'poky', 'bitbake')
+        def reset_environ():
+            os.environ.clear()
+            os.environ.update(environ)
+        build_env_cache = os.path.join(platform_dir, 'build', 'conf', '.build-env-cache.json')
+        def no_build_env_cache():
+            reset_environ()
+            if os.path.exists(build_env_cache):
+                os.remove(build_env_cache)
+        results['run_oe_init_build_env (subshell)'] = \
+            best_time(lambda: run_oe_init_build_env('build', bitbake_dir), setup=no_build_env_cache)
+        results['run_oe_init_build_env (cached)'] = \
+            best_time(lambda: run_oe_init_build_env('build', bitbake_dir), setup=reset_environ)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(platform_dir)
+    return results
+
+
+###
+### parse_assignment_expr()
+###
+def bench_parse_assignment_expr():
+    conf1 = Conf('test-data/conf1', quiet=True)
+    lines = conf1._read_conf()
+
+    ## Both parsers must agree on test-data/conf1
+    for line in lines:
+        assert parse_assignment_expr(line) == legacy_parse_assignment_expr(line), line
+
+    ## A local.conf-like workload: plain assignments, weak defaults,
+    ## appends and long values
+    workload = []
+    for i in range(2000):
+        workload += ['FOO_%d = "value %d"' % (i, i),
+                     'BAR_%d ?= "weak"' % i,
+                     'IMAGE_INSTALL += "package-%d"' % i,
+                     'LONG_%d = "%s"' % (i, ' '.join(['token'] * 20))]
+
+    legacy_time = best_time(lambda: [ legacy_parse_assignment_expr(l) for l in workload ])
+    new_time = best_time(lambda: [ parse_assignment_expr(l) for l in workload ])
+    print('parse_assignment_expr (%d lines): legacy %.2f ms, current %.2f ms (%.1fx)' %
+          (len(workload), legacy_time * 1000, new_time * 1000, legacy_time / new_time))
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    regressions = []
+    for size, operations in results.items():
+        for operation, elapsed in operations.items():
+            reference = baseline.get(size, {}).get(operation)
+            if reference and elapsed > reference * tolerance:
+                regressions.append('%s (%s layers): %.2f ms, baseline %.2f ms' %
+                                   (operation, size, elapsed * 1000, reference * 1000))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark setup_environment_internal.')
+    parser.add_argument('--sizes', default='10,50,200',
+                        help='comma-separated numbers of layers of the synthetic trees')
+    parser.add_argument('--machines', type=int, default=5, help='number of machines per layer')
+    parser.add_argument('--modules', type=int, help='number of hook modules (default: one per layer)')
+    parser.add_argument('--conf-lines', type=int, default=20, help='number of lines of each layer.conf')
+    parser.add_argument('--baseline', help='fail on regressions compared to this baseline file')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='slowdown factor tolerated compared to the baseline')
+    parser.add_argument('--save-baseline', help='store the results in this baseline file')
+    args = parser.parse_args()
+
+    bench_parse_assignment_expr()
+
+    results = {}
+    for size in args.sizes.split(','):
+        results[size] = bench_tree(int(size), args.machines, args.modules, args.conf_lines)
+
+    ## Scaling curves: one row per operation, one column per tree size
+    sizes = list(results.keys())
+    print('\n%-34s' % 'ms / layers' + ''.join([ '%10s' % size for size in sizes ]))
+    for operation in results[sizes[0]]:
+        print('%-34s' % operation +
+              ''.join([ '%10.2f' % (results[size][operation] * 1000) for size in sizes ]))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.stderr.write('ERROR: performance regressions:\n')
+            for regression in regressions:
+                sys.stderr.write(' * %s\n' % regression)
+            sys.exit(1)
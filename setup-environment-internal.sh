@@ -13,33 +13,50 @@ if [ "$1" = "--help" ] || [ "$1" = "-h" ]; then
     return 0
 fi
 
-BUILDDIR="`pwd`/$1"
-
 # These variable are whitelisted in 'oe-buildenv-internal' so keep it
 # in sync as it is know to affect the build setup
 passthrough_env_additions=
 while read var; do
-    if [ -z "$passthrough_env_additions" ]; then
-        passthrough_env_additions=$var
-    else
-        passthrough_env_additions="`echo -n $passthrough_env_additions` $var"
-    fi
+    passthrough_env_additions="$passthrough_env_additions $var"
     eval "[ -n \"\$$var\" ] && export $var || true"
 done < $passthrough_env
 
 export BB_ENV_PASSTHROUGH_ADDITIONS="$BB_ENV_PASSTHROUGH_ADDITIONS $passthrough_env_additions"
 
+if [ "$1" = "--batch" ]; then
+    # Set up several build directories, without entering any of them
+    shift
+    $setupenv --batch "$@"
+    return $?
+fi
+
+if [ "$1" = "--plan" ]; then
+    # Only show what setting up the build directory would change
+    $setupenv --plan "`pwd`/$2"
+    return $?
+fi
+
+if [ "$1" = "--eval" ]; then
+    # Print the values BitBake would give to variables in the build
+    # directory
+    shift
+    eval_build_dir="`pwd`/$1"
+    shift
+    $setupenv --eval "$eval_build_dir" "$@"
+    return $?
+fi
+
+BUILDDIR="`pwd`/$1"
+
 # File to which $setupenv will write the environment
 env_file=`mktemp`
 
+# $setupenv hands the request to the setup-environment daemon when one
+# is running for this platform, and does the setup itself otherwise
 $setupenv $BUILDDIR $env_file || return $?
 
-while read line; do
-    variable=`echo $line | awk -F'=' '{ print $1; }'`
-    if grep -w -q $variable $passthrough_env; then
-        export "$line"
-    fi
-done < $env_file
+# $env_file exports the variables from $passthrough_env, quoted
+. $env_file
 
 # Support for ye's `cd' command:
 [ -e sources/ye/ye-cd ] && . sources/ye/ye-cd
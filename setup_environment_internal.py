@@ -3,7 +3,19 @@
 import os
 import re
 import sys
+import ast
 import glob
+import json
+import fnmatch
+import time
+import hashlib
+import difflib
+import marshal
+import mmap
+import struct
+import importlib.util
+import atexit
+import contextlib
 # Starting with Python 3.3, shlex.quote() was introduced as
 # a replacement for the deprecated pipes.quote() function,
 # which was removed in Python 3.13.
@@ -15,7 +27,11 @@ import tempfile
 import subprocess
 
 def usage(exit_code=None):
-    message = 'Usage: MACHINE=<machine> %s <build dir>\n' % (os.path.basename(sys.argv[0]).replace('-internal.py', ''))
+    name = os.path.basename(sys.argv[0]).replace('-internal.py', '')
+    message = ('Usage: MACHINE=<machine> %s [--plan] <build dir>\n' % name +
+               '       %s --batch [--jobs <n>] <build dir>[:<machine>] ...\n' % name +
+               '       %s --eval <build dir> <variable> ...\n' % name +
+               '       %s --daemon\n' % name)
     if exit_code and exit_code != 0:
         sys.stderr.write(message)
     else:
@@ -28,12 +44,35 @@ def usage(exit_code=None):
 ###
 DEBUG_SETUP_ENVIRONMENT = 'DEBUG_SETUP_ENVIRONMENT' in os.environ
 
+###
+### Caches
+###
+## Ignore (and rebuild) the on-disk caches
+SETUP_ENVIRONMENT_REFRESH = 'SETUP_ENVIRONMENT_REFRESH' in os.environ
+
+## Directory for caches which are not specific to a build directory
+CACHE_DIR = os.environ.get('SETUP_ENVIRONMENT_CACHE_DIR',
+                           os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                                       os.path.join(os.path.expanduser('~'), '.cache')),
+                                        'setup-environment'))
+
+## Set in plan mode (--plan): nothing is written, neither to the build
+## directory nor to the caches
+DRY_RUN = False
+
 ###
 ### Paths
 ###
-PLATFORM_ROOT_DIR = os.getcwd()
+## Like the configuration files data, defaults and hooks, paths are
+## owned by the active SetupContext (see SetupContext.activate())
+PLATFORM_ROOT_DIR = None
 OEROOT = None
 
+## File where find_layers() persists the layer index across runs
+## (<build dir>/conf/.layer-index.json).  When None, the index is only
+## kept in memory.
+LAYER_INDEX_FILE = None
+
 ###
 ### Configuration files data
 ###
@@ -44,82 +83,80 @@ BBLAYERS_CONF = None
 ### API to be used by modules
 ###
 def set_default(var, val):
-    DEFAULTS[var] = val
+    _CONTEXT.set_default(var, val)
 
 def set_var(var, val, op='=', quote='"'):
     # quote is not currently used.  It's been kept in the function
     # prototype for backward compatibility
-    LOCAL_CONF.add(var, op, val)
+    _CONTEXT.set_var(var, val, op)
 
 def append_var(var, val, quote='"'):
     # quote is not currently used.  It's been kept in the function
     # prototype for backward compatibility
-    LOCAL_CONF.add(var, '+=', val)
+    _CONTEXT.set_var(var, val, '+=')
 
 def remove_var(var):
     # Remove `var' from the configuration
-    LOCAL_CONF.remove(var)
+    _CONTEXT.remove_var(var)
 
 def reset_var(var, val, op='='):
-    remove_var(var)
-    set_var(var, val, op)
+    _CONTEXT.reset_var(var, val, op)
 
 def append_layer(layer_dir):
-    priority = get_layer_priority(layer_dir)
-    data = BBLAYERS_CONF._simplify()
-    layers = []
-    for expr in data:
-        if expr[0] == 'BBLAYERS':
-            layers = expr[2]
-            break
-    layers.append(layer_dir)
-    layers = [l.strip() for l in layers]
-    layers = list(dict.fromkeys(layers))
-    layers = sorted(layers, key=get_layer_priority, reverse=True)
-    BBLAYERS_CONF.remove('BBLAYERS')
-    BBLAYERS_CONF.add('BBLAYERS', '+=', ' '.join(layers))
+    append_layers([layer_dir])
 
 def append_layers(layer_dirs):
-    for layer_dir in layer_dirs:
-        append_layer(layer_dir)
+    _CONTEXT.append_layers(layer_dirs)
 
 def get_machines_by_layer(layer):
     layers = find_layers()
     if layer in layers.keys():
-        machines_dir = os.path.join(layers[layer]['path'], 'conf', 'machine')
-        machine_conf_files = []
-        try:
-            machine_conf_files = glob.glob(os.path.join(machines_dir, '*.conf'))
-        except:
-            raise Exception('Could not list machines for layer %s' % layer)
-        return [ os.path.basename(os.path.splitext(f)[0]) \
-                     for f in machine_conf_files ]
+        return sorted([ machine for machine, providers in get_machine_catalog().items()
+                        if any([ p['layer'] == layer for p in providers ]) ])
     else:
         raise Exception('Could not find layer %s' % layer)
 
+def find_machine(machine):
+    ''' Return the list of layers providing machine, highest priority
+    first, as dicts with the layer name, its priority, the machine
+    configuration file and the SoC families of the machine. '''
+    return get_machine_catalog().get(machine, [])
+
+def get_effective_var(var):
+    ''' Return the value BitBake would give to var in the build
+    directory being set up (see build_dir_evaluator()), or None if it
+    would not be set '''
+    return _CONTEXT.evaluator().get(var)
+
+def get_machines_by_soc_family(soc_family):
+    return sorted([ machine for machine, providers in get_machine_catalog().items()
+                    if any([ soc_family in p['soc_families'] for p in providers ]) ])
+
 ###
 ### Hooks & modules
 ###
-HOOKS = { 'set-defaults': [],
-          'before-init': [],
-          'after-init': [] }
+## HOOKS and DEFAULTS are those of the active SetupContext.  Each
+## context starts with INITIAL_DEFAULTS, which hook scripts can change
+## with set_default().
+HOOKS = None
+DEFAULTS = None
 
-DEFAULTS = { 'DISTRO': 'poky',
-             'MACHINE': 'qemuarm',
-             'SDKMACHINE': 'x86_64',
-             'PACKAGE_CLASSES': 'package_ipk' }
+INITIAL_DEFAULTS = { 'DISTRO': 'poky',
+                     'MACHINE': 'qemuarm',
+                     'SDKMACHINE': 'x86_64',
+                     'PACKAGE_CLASSES': 'package_ipk' }
 
 def run_set_defaults(fn):
-    HOOKS['set-defaults'].append(fn)
+    _CONTEXT.add_hook('set-defaults', fn)
 
 def run_before_init(fn):
-    HOOKS['before-init'].append(fn)
+    _CONTEXT.add_hook('before-init', fn)
 
 def run_after_init(fn):
-    HOOKS['after-init'].append(fn)
+    _CONTEXT.add_hook('after-init', fn)
 
 def run_hook(hook):
-    [ fn() for fn in HOOKS[hook] ]
+    _CONTEXT.run_hook(hook)
 
 def read_project_priority(mod):
     ''' Projects that are not proper Yocto Project layers can specify
@@ -138,13 +175,7 @@ def read_project_priority(mod):
 def find_modules():
     ''' Return a list of modules.  Lower priority ones first. '''
     layers = find_layers()
-    mod_dirs = system_find(os.path.join(PLATFORM_ROOT_DIR, "sources"),
-                           maxdepth = 3,
-                           type = 'd',
-                           name = 'setup-environment.d')
-    modules = []
-    for dir in mod_dirs:
-        modules += glob.glob(os.path.join(dir, "*.py"))
+    _, modules = scan_sources()
 
     ## Build up a dict mapping module paths to their priorities (None
     ## if no priority).  The priority is the layer priority.
@@ -195,75 +226,299 @@ def find_modules():
     debug('modules in order: %s' % modules)
     return modules
 
-def load_modules():
-    for module in find_modules():
-        with open(module) as module_source:
-            exec(module_source.read())
+def module_cache_file(module):
+    ''' Return the path to the bytecode cache file for module '''
+    path_hash = hashlib.sha1(os.path.abspath(module).encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, '__pycache__',
+                        '%s.%s.%s.pyc' % (os.path.splitext(os.path.basename(module))[0],
+                                          path_hash,
+                                          sys.implementation.cache_tag))
+
+def compile_module(module):
+    ''' Return the code object for module.  Code objects are cached
+    in CACHE_DIR, keyed on the module path, mtime and size. '''
+    st = os.stat(module)
+    header = importlib.util.MAGIC_NUMBER + struct.pack('<qq', st.st_mtime_ns, st.st_size)
+    cache_file = module_cache_file(module)
+    if not SETUP_ENVIRONMENT_REFRESH:
+        try:
+            with open(cache_file, 'rb') as cache_fd:
+                data = cache_fd.read()
+            if data.startswith(header):
+                return marshal.loads(data[len(header):])
+        except (IOError, OSError, ValueError, EOFError, TypeError):
+            pass
+    with open(module) as module_source:
+        code = compile(module_source.read(), module, 'exec', dont_inherit=True)
+    if DRY_RUN:
+        return code
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        write_file_atomically(cache_file, header + marshal.dumps(code))
+    except (IOError, OSError) as e:
+        debug('Could not write bytecode cache %s: %s' % (cache_file, e))
+    return code
+
+## (module, code object) tuples, computed once per process
+_COMPILED_MODULES = None
+
+def compile_modules():
+    global _COMPILED_MODULES
+    if _COMPILED_MODULES is None:
+        with phase('find modules'):
+            modules = find_modules()
+        _COMPILED_MODULES = [ (module, compile_module(module)) for module in modules ]
+    return _COMPILED_MODULES
+
+## With SETUP_ENVIRONMENT_LAZY_MODULES set, hook scripts which declare
+## the layers or machines they apply to are only loaded for build
+## directories they are relevant to (see module_applies()).
+## Declarations are comments at the top of the hook script, e.g.:
+##
+##   # setup-environment-layers: meta-freescale meta-freescale-3rdparty
+##   # setup-environment-machines: imx6* imx7*
+SETUP_ENVIRONMENT_LAZY_MODULES = 'SETUP_ENVIRONMENT_LAZY_MODULES' in os.environ
+
+MODULE_DECLARATION_RE = re.compile(r'#\s*setup-environment-(layers|machines):(.*)$')
+
+def read_module_declarations(module):
+    ''' Return a dict with the layers and machines declared by the
+    comments at the top of module (empty lists if none) '''
+    declarations = { 'layers': [], 'machines': [] }
+    try:
+        with open(module) as module_fd:
+            for line in module_fd:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    break
+                m = MODULE_DECLARATION_RE.match(line)
+                if m:
+                    declarations[m.group(1)] += m.group(2).split()
+    except (IOError, OSError):
+        pass
+    return declarations
+
+## Declarations of the modules, computed once per process
+_MODULE_DECLARATIONS = None
+
+def module_declarations():
+    ''' Return a dict mapping the modules to their declarations (see
+    read_module_declarations()).  Like the machine catalog, they are
+    persisted in the layer index, so only modules which changed are
+    read again. '''
+    global _MODULE_DECLARATIONS
+    if _MODULE_DECLARATIONS is not None:
+        return _MODULE_DECLARATIONS
+
+    modules = compile_modules()
+    with phase('module declarations'):
+        index = load_layer_index()
+        old_declarations = index.get('modules', {})
+        declarations = {}
+        for module, _ in modules:
+            try:
+                key = _stat_key(module)
+            except OSError:
+                continue
+            entry = old_declarations.get(module)
+            if key is None or not entry or entry['stat'] != key:
+                entry = read_module_declarations(module)
+                entry['stat'] = key
+            declarations[module] = entry
+        if declarations != old_declarations:
+            index['modules'] = declarations
+            save_layer_index(index)
+
+    _MODULE_DECLARATIONS = declarations
+    return _MODULE_DECLARATIONS
+
+def conf_machine(local_conf_file):
+    ''' Return the MACHINE set by local_conf_file, or None if it does
+    not exist or MACHINE can't be told without expanding variables '''
+    if not os.path.exists(local_conf_file):
+        return None
+    assignments = {}
+    for var, op, val in iter_assignments(local_conf_file):
+        if var == 'MACHINE':
+            ## Of weak assignments (?=), the first one wins; of the other
+            ## ones, the last one
+            op = '=' if op == ':=' else op
+            if op != '?=' or op not in assignments:
+                assignments[op] = ' '.join(val)
+    for op in [ '=', '?=', '??=' ]:
+        if op in assignments:
+            machine = assignments[op]
+            return machine if machine and '$' not in machine else None
+    return None
+
+def module_scope(local_conf_file, bblayers_conf_file):
+    ''' Return a (machine, layers) tuple: the MACHINE the build
+    directory is set up for and the set of names of the layers it uses
+    (the ones in an existing bblayers.conf and the ones providing
+    MACHINE).  Either is None when it is not known before running hook
+    scripts. '''
+    machine = os.environ.get('MACHINE') or conf_machine(local_conf_file)
+    layers = None
+    if os.path.exists(bblayers_conf_file):
+        layers = set([ os.path.basename(layer.strip().rstrip('/'))
+                       for var, _, val in iter_assignments(bblayers_conf_file)
+                       if var == 'BBLAYERS'
+                       for layer in val if layer.strip() ])
+    if machine:
+        layers = (layers or set()).union([ p['layer'] for p in find_machine(machine) ])
+    return machine, layers
+
+def module_applies(declarations, machine, layers):
+    ''' Return whether a module with declarations (see
+    read_module_declarations()) is relevant to a build directory with
+    machine and layers (see module_scope()).  Modules without
+    declarations always are, as are modules whose declarations can't be
+    checked. '''
+    if not declarations['layers'] and not declarations['machines']:
+        return True
+    if declarations['machines']:
+        if machine is None:
+            return True
+        for pattern in declarations['machines']:
+            if fnmatch.fnmatchcase(machine, pattern):
+                return True
+    if declarations['layers']:
+        if layers is None or layers.intersection(declarations['layers']):
+            return True
+    return False
+
+def load_modules(local_conf_file=None, bblayers_conf_file=None):
+    modules = compile_modules()
+    lazy = SETUP_ENVIRONMENT_LAZY_MODULES and local_conf_file and bblayers_conf_file
+    if lazy:
+        declarations = module_declarations()
+        machine, layers = module_scope(local_conf_file, bblayers_conf_file)
+    for module, code in modules:
+        if lazy and module in declarations and not module_applies(declarations[module], machine, layers):
+            debug('Not loading %s: not relevant to MACHINE %s and layers %s' % (module, machine, layers))
+            continue
+        with phase('load module', module=module):
+            ## Modules are executed right here, so they share this
+            ## module's global namespace
+            exec(code)
 
 
 ###
 ### EULAs
 ###
+## Set to handle EULAs without asking anything: EULAs which have not
+## been accepted (in local.conf, ACCEPTED_EULAS or the EULA ledger)
+## make setup fail instead of prompting for acceptance
+SETUP_ENVIRONMENT_NONINTERACTIVE = 'SETUP_ENVIRONMENT_NONINTERACTIVE' in os.environ
+
+## EULA ledger: a JSON file mapping EULA files (relative to sources/)
+## to the checksum of the EULA text which has been accepted and the
+## acceptance expression.  EULAs are accepted automatically when they
+## match an entry in the ledger, and EULAs accepted interactively are
+## recorded in it.
+SETUP_ENVIRONMENT_EULA_LEDGER = os.environ.get('SETUP_ENVIRONMENT_EULA_LEDGER')
+
 class Eula():
     def __init__(self, local_conf_file):
         self.accept = {}
         self.local_conf_file = local_conf_file
 
-    def _set_eula_accepted(self, acceptance_expr):
-        conf = open(self.local_conf_file, 'a')
-        conf.write(acceptance_expr + '\n')
-        conf.close()
-
-    def _require_eula_acceptance(self, eula_file, acceptance_expr):
+    def _eula_file_path(self, eula_file):
         ## The current directory is the poky layer root directory, so
         ## we prepend ../ to the eula file path
-        eula_file_path = os.path.join(PLATFORM_ROOT_DIR, 'sources', eula_file)
-
-        if os.path.exists(eula_file_path):
-            os.system('more -d "%s"' % eula_file_path)
-            answer = None
-            while not answer in ['y', 'Y', 'n', 'N']:
-                print('Accept EULA (%s)? [y/n] ' % eula_file, end = '', flush = True)
-                answer = sys.stdin.readline().strip()
-            if answer in ['y', 'Y']:
-                self._set_eula_accepted(acceptance_expr)
-        else:
-            sys.stderr.write('%s does not exist. Aborting.\n' % (eula_file))
-            sys.exit(1)
+        return os.path.join(PLATFORM_ROOT_DIR, 'sources', eula_file)
 
+    def _checksum(self, eula_file):
+        with open(self._eula_file_path(eula_file), 'rb') as eula_fd:
+            return hashlib.sha256(eula_fd.read()).hexdigest()
 
-    def _local_conf_accepted_eulas(self):
-        "Return a list of accepted EULAS (indicated by the EULA file) in local.conf"
-        eula_files = []
-        local_conf = Conf(self.local_conf_file, quiet=True)
-        local_conf.read_conf()
-        local_conf_data = local_conf.conf_data
-        for eula_file, acceptance_expr in eulas.accept.items():
+    def _read_ledger(self):
+        if not SETUP_ENVIRONMENT_EULA_LEDGER or not os.path.exists(SETUP_ENVIRONMENT_EULA_LEDGER):
+            return {}
+        try:
+            with open(SETUP_ENVIRONMENT_EULA_LEDGER) as ledger_fd:
+                return json.load(ledger_fd)
+        except (IOError, OSError, ValueError) as e:
+            sys.stderr.write('ERROR: could not read the EULA ledger %s: %s\n' % (SETUP_ENVIRONMENT_EULA_LEDGER, e))
+            sys.exit(1)
+
+    def _ledger_accepted(self, ledger, eula_file, acceptance_expr):
+        entry = ledger.get(eula_file)
+        if not entry or entry.get('acceptance') != acceptance_expr:
+            return False
+        try:
+            return entry.get('sha256') == self._checksum(eula_file)
+        except (IOError, OSError):
+            return False
+
+    def _write_ledger(self, ledger):
+        os.makedirs(os.path.dirname(os.path.abspath(SETUP_ENVIRONMENT_EULA_LEDGER)), exist_ok=True)
+        write_file_atomically(SETUP_ENVIRONMENT_EULA_LEDGER,
+                              json.dumps(ledger, indent=1, sort_keys=True) + '\n')
+
+    def _set_eulas_accepted(self, acceptance_exprs):
+        ## All the acceptance expressions are appended to local.conf at
+        ## once
+        with open(self.local_conf_file) as conf:
+            content = conf.read()
+        if content and not content.endswith('\n'):
+            content += '\n'
+        write_file_atomically(self.local_conf_file,
+                              content + ''.join([ expr + '\n' for expr in acceptance_exprs ]))
+
+    def _require_eula_acceptance(self, eula_file):
+        ''' Show the EULA and return whether the user accepted it '''
+        subprocess.call(['more', '-d', self._eula_file_path(eula_file)])
+        answer = None
+        while not answer in ['y', 'Y', 'n', 'N']:
+            print('Accept EULA (%s)? [y/n] ' % eula_file, end = '', flush = True)
+            answer = sys.stdin.readline().strip()
+        return answer in ['y', 'Y']
+
+
+    def _local_conf_accepted_eulas(self, assignments):
+        """Return a list of accepted EULAS (indicated by the EULA file) in
+        the local.conf assignments.  They are only read until all the
+        EULAs have been found."""
+        expected = {} # (var, val) -> EULA files
+        for eula_file, acceptance_expr in self.accept.items():
             ae_var = ae_op = ae_val = None
             try:
                 ae_var, ae_op, ae_val = parse_assignment_expr(acceptance_expr)
             except:
                 pass
             if ae_var:
-                for lc_var, lc_op, lc_val in local_conf_data:
-                    ## We ignore the operator when comparing
-                    ## acceptance expressions.  We probably shouldn't.
-                    if lc_var == ae_var and lc_val == ae_val:
-                        eula_files.append(eula_file)
-                        break
+                expected.setdefault((ae_var, tuple(ae_val)), []).append(eula_file)
+        eula_files = []
+        if not expected:
+            return eula_files
+        for lc_var, lc_op, lc_val in assignments:
+            ## We ignore the operator when comparing
+            ## acceptance expressions.  We probably shouldn't.
+            eula_files += expected.pop((lc_var, tuple(lc_val)), [])
+            if not expected:
+                break
         return eula_files
 
-    def handle(self):
-        accepted_eulas = []
-        try:
-            accepted_eulas = os.environ['ACCEPTED_EULAS'].split()
-        except:
-            pass
+    def plan(self, local_conf=None):
+        ''' Return a (to_accept, to_prompt) tuple: the EULA files which
+        are accepted without asking (via ACCEPTED_EULAS or the ledger)
+        and the ones which require the user to accept them.  EULAs
+        already accepted in local.conf (or in the local_conf Conf
+        object, when given) are in neither. '''
+        accepted_eulas = os.environ.get('ACCEPTED_EULAS', '').split()
+
+        if local_conf is None:
+            assignments = iter_assignments(self.local_conf_file)
+        else:
+            assignments = local_conf.conf_data
+        already_accepted_eulas = self._local_conf_accepted_eulas(assignments)
 
-        already_accepted_eulas = self._local_conf_accepted_eulas()
-        show_eula_banner = True
+        ledger = self._read_ledger()
 
-        for eula_file, eula_acceptance_expr in eulas.accept.items():
+        to_accept = []
+        to_prompt = []
+        for eula_file, acceptance_expr in self.accept.items():
             if eula_file in already_accepted_eulas:
                 ## EULA has been set as accepted in local.conf, so just
                 ## ignore it
@@ -271,65 +526,101 @@ class Eula():
             elif eula_file in accepted_eulas:
                 ## If EULA has been accepted via the environment, set it
                 ## accepted without displaying the EULA text
-                acceptance_expr = eulas.accept[eula_file]
-                self._set_eula_accepted(acceptance_expr)
+                to_accept.append(eula_file)
+            elif self._ledger_accepted(ledger, eula_file, acceptance_expr):
+                debug('EULA %s accepted by the ledger' % eula_file)
+                to_accept.append(eula_file)
             else:
-                ## Prompt for EULAs acceptance based on settings in hook scripts
-                if show_eula_banner:
-                    show_eula_banner = False # show banner only once
-                    print(
-                        '\n\n==========================================================================\n'
-                        '=== Some SoC depends on libraries and packages that requires accepting ===\n' +
-                        '=== EULA(s). To have the right to use those binaries in your images    ===\n' +
-                        '=== you need to read and accept the EULA(s) that will be displayed.    ===\n' +
-                        '==========================================================================\n\n')
-                    print('Press ENTER to continue ', end = '', flush = True)
-                    sys.stdin.readline()
-                self._require_eula_acceptance(eula_file, eula_acceptance_expr)
+                to_prompt.append(eula_file)
+        return to_accept, to_prompt
+
+    def handle(self):
+        to_accept, to_prompt = self.plan()
+
+        for eula_file in to_prompt:
+            if not os.path.exists(self._eula_file_path(eula_file)):
+                sys.stderr.write('%s does not exist. Aborting.\n' % (eula_file))
+                sys.exit(1)
+
+        if to_prompt and SETUP_ENVIRONMENT_NONINTERACTIVE:
+            sys.stderr.write('ERROR: the following EULAs have not been accepted:\n')
+            for eula_file in to_prompt:
+                sys.stderr.write(' * %s (sha256: %s)\n' % (eula_file, self._checksum(eula_file)))
+            sys.stderr.write('Accept them via ACCEPTED_EULAS or the EULA ledger '
+                             '(SETUP_ENVIRONMENT_EULA_LEDGER).\n')
+            sys.exit(1)
+
+        accepted_interactively = []
+        if to_prompt:
+            ## Prompt for EULAs acceptance based on settings in hook scripts
+            print(
+                '\n\n==========================================================================\n'
+                '=== Some SoC depends on libraries and packages that requires accepting ===\n' +
+                '=== EULA(s). To have the right to use those binaries in your images    ===\n' +
+                '=== you need to read and accept the EULA(s) that will be displayed.    ===\n' +
+                '==========================================================================\n\n')
+            print('Press ENTER to continue ', end = '', flush = True)
+            sys.stdin.readline()
+            for eula_file in to_prompt:
+                if self._require_eula_acceptance(eula_file):
+                    accepted_interactively.append(eula_file)
+
+        if to_accept or accepted_interactively:
+            self._set_eulas_accepted([ self.accept[f] for f in to_accept + accepted_interactively ])
+
+        if accepted_interactively and SETUP_ENVIRONMENT_EULA_LEDGER:
+            ledger = self._read_ledger()
+            for eula_file in accepted_interactively:
+                ledger[eula_file] = { 'sha256': self._checksum(eula_file),
+                                      'acceptance': self.accept[eula_file] }
+            self._write_ledger(ledger)
+
+        ## EULAs which are still not accepted
+        return [ f for f in to_prompt if f not in accepted_interactively ]
 
 
 ###
 ### Configuration files handling
 ###
-def parse_value(val):
-    # Eventually, the value might have quotes and we those need to be escaped or
-    # the `eval(...)` below might use invalid syntax.
-    if val.startswith('"') and val.endswith('"'):
-        val = '"' + val[1:-1].replace('"', '\\"') + '"'
+## Assignment expressions, mostly like BitBake's configuration parser
+## accepts them:
+##     [export] VAR[flag] OP VALUE
+## where VAR may include overrides (e.g., FOO:append:machine) and OP is
+## any of BitBake's assignment operators.
+ASSIGNMENT_EXPR_RE = re.compile(r'''
+    ^(?:export\s+)?
+    (?P<var>[\w\-.${}/~+:]+?(?:\[[\w\-+.][\w\-+.@/]*\])?)
+    \s*
+    (?P<op>\?\?=|\?=|:=|\+=|=\+|\.=|=\.|=)
+    \s*
+    (?P<val>.*)$
+    ''', re.X)
+
+## Variable names taken by the fast path in parse_assignment_expr()
+SIMPLE_VAR_RE = re.compile(r'[\w\-.${}/~+:]+$')
 
-    return split_keep_spaces(str(eval(val)))
+def parse_value(val):
+    ## Values are taken literally, just without the surrounding quotes
+    ## (like BitBake does)
+    if len(val) > 1 and val[0] == val[-1] and val[0] in '"\'':
+        val = val[1:-1]
+    return split_keep_spaces(val)
 
 def parse_assignment_expr(line):
-    var = ''
-    op = ''
-    val = ''
-    looking_for = 'var'
     line = line.strip()
-    for pos, char in enumerate(line):
-        if looking_for == 'var':
-            if char not in ['=', '?', '+']:
-                if char == ' ':
-                    looking_for = 'op'
-                else:
-                    var += char
-            else:
-                looking_for = 'op'
-        elif looking_for == 'op':
-            if char in ['=', '?', ':', '+', '.']:
-                op += char
-                if len(char) > 3:
-                    raise Exception('Syntax error (operator): %s' % line)
-            elif char == ' ':
-                if op != '':
-                    if not op in ['=', '+=', '=+', '?=', '??=', ':=', '.=', '=.']:
-                        raise Exception('Invalid operator: %s' % op)
-                    looking_for = 'val'
-            else:
-                raise Exception('Syntax error (operator): %s' % line)
-        else:
-            val = line[pos:]
-            break
-    if var and op and val:
+    ## Fast path for the most common form: VAR = "value"
+    var, op, val = line.partition(' = ')
+    if op and SIMPLE_VAR_RE.match(var):
+        op = '='
+    else:
+        if '=' not in line:
+            return None # Not an assignment line
+        match = ASSIGNMENT_EXPR_RE.match(line)
+        if not match:
+            return None # Not an assignment line
+        var, op, val = match.group('var', 'op', 'val')
+    val = val.strip()
+    if val:
         return (var, op, parse_value(val))
     else:
         return None # Not an assignment line
@@ -357,94 +648,728 @@ def format_value(val):
         return escaped
 
 
+def format_assignment(var, op, val):
+    return '%s %s %s\n' % (var, op, format_value(val))
+
+def simplify_assignments(assignments):
+    ## Squash multiple values for sequential assignment
+    ## expressions which envolve the same variable and operator is
+    ## '+='.  So:
+    ##     foo += 'bar'
+    ##     foo += 'baz'
+    ## is turned into:
+    ##     foo += 'bar baz'
+    simpl_data = []
+    for expr in assignments:
+        if simpl_data:
+            prev_var, prev_op, prev_val = simpl_data[-1]
+            if prev_var == expr[0] and prev_op == '+=' and prev_op == expr[1]:
+                simpl_data[-1] = (prev_var, prev_op, prev_val + expr[2])
+                continue
+        simpl_data.append(expr)
+    return simpl_data
+
+def write_file_atomically(path, content):
+    ''' Replace the contents of path by writing to a temporary file
+    in the same directory and renaming it over path '''
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode & 0o7777
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(content, bytes) else 'w') as tmp_fd:
+            tmp_fd.write(content)
+        os.chmod(tmp_file, mode)
+        os.replace(tmp_file, path)
+    except:
+        os.unlink(tmp_file)
+        raise
+
+
+def read_lines(conf_file):
+    ''' Yield the lines of conf_file, read through a memory map, so that
+    large files are not loaded at once '''
+    with open(conf_file, 'rb') as conf_fd:
+        if os.fstat(conf_fd.fileno()).st_size == 0:
+            return
+        with mmap.mmap(conf_fd.fileno(), 0, access=mmap.ACCESS_READ) as conf_map:
+            for line in iter(conf_map.readline, b''):
+                line = line.decode()
+                if line.endswith('\r\n'):
+                    line = line[:-2] + '\n'
+                yield line
+
+def logical_lines(lines):
+    ''' Join the continued lines in lines.  Yield (text, line) tuples,
+    where text is the text of lines making up line, the logical line,
+    or None for comments, empty lines and dangling continuations. '''
+    linebuf = ''
+    rawbuf = ''
+    for line in lines:
+        stripped_line = line.strip()
+        rstripped_line = line.rstrip()
+        if stripped_line.startswith('#') or stripped_line == '':
+            if rawbuf:
+                yield (rawbuf, None)
+            yield (line, None)
+            linebuf = ''
+            rawbuf = ''
+            continue
+        rawbuf += line
+        if rstripped_line.endswith('\\'):
+            linebuf += rstripped_line[:-1]
+            continue
+        yield (rawbuf, linebuf + line if linebuf else line)
+        linebuf = ''
+        rawbuf = ''
+    if rawbuf:
+        yield (rawbuf, None)
+
+def parse_conf_line(line):
+    ''' Return the assignment expression in a logical line, or None '''
+    lstripped_line = line.lstrip()
+    if (lstripped_line.startswith('require') or
+        lstripped_line.startswith('addpylib') or
+        lstripped_line.startswith('include')):
+        return None
+    return parse_assignment_expr(line)
+
+def iter_assignments(conf_file):
+    ''' Lazily yield the (var, op, val) assignments in conf_file.  The
+    file is streamed, so lookups can stop as soon as they found what
+    they need. '''
+    for _, line in logical_lines(read_lines(conf_file)):
+        if line is not None:
+            expr = parse_conf_line(line)
+            if expr:
+                yield expr
+
+class Assignment(object):
+    ''' An assignment expression.  Behaves like a (var, op, val) tuple. '''
+    __slots__ = ('var', 'op', 'val')
+
+    def __init__(self, var, op, val):
+        self.var = var
+        self.op = op
+        self.val = val
+
+    def __iter__(self):
+        return iter((self.var, self.op, self.val))
+
+    def __getitem__(self, i):
+        return (self.var, self.op, self.val)[i]
+
+    def __len__(self):
+        return 3
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+
+class AssignmentList(list):
+    ''' The conf_data of a Conf: a list of (var, op, val) assignments
+    which hook scripts may still change in place (e.g.,
+    LOCAL_CONF.conf_data.append((var, op, val))).  Changing it makes its
+    contents the assignments of the Conf. '''
+    def __init__(self, conf, assignments):
+        list.__init__(self, assignments)
+        self._conf = conf
+
+def _changes_conf(method):
+    def change(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._conf.conf_data = list(self)
+        return result
+    return change
+
+for _name in [ 'append', 'extend', 'insert', 'remove', 'pop', 'clear', 'sort', 'reverse',
+               '__setitem__', '__delitem__', '__iadd__', '__imul__' ]:
+    setattr(AssignmentList, _name, _changes_conf(getattr(list, _name)))
+del _name
+
+
 class Conf(object):
-    def __init__(self, conf_file, quiet=False):
+    def __init__(self, conf_file, quiet=False, update=False):
+        ''' When `update' is True, an existing conf_file is not
+        regenerated, but updated in place: only the assignments which
+        changed are rewritten, and anything else (comments, includes,
+        formatting) is kept. '''
         self.conf_file = conf_file
-        self.read_only = os.path.exists(conf_file)
+        self.update = update
+        self.read_only = os.path.exists(conf_file) and not update
         if self.read_only and not quiet:
             sys.stderr.write("WARNING: %s exists.  Not overwriting it.\n" % conf_file)
-        self.conf_data = []
-
-    def _read_conf(self):
-        lines = open(self.conf_file).readlines()
-        content = []
-        linebuf = ''
-        for line in lines:
-            stripped_line = line.strip()
-            rstripped_line = line.rstrip()
-            if stripped_line.startswith('#') or stripped_line == '':
-                linebuf = ''
-                continue
-            if rstripped_line.endswith('\\'):
-                prev_line_continued = True
-                linebuf += rstripped_line[:-1]
-                continue
-            if linebuf:
-                linebuf += line
-                content.append(linebuf)
-            else:
-                content.append(line)
-            linebuf = ''
-        return(content)
+        ## Assignments are kept in insertion order, indexed by a
+        ## sequence number, and indexed by variable (var -> list of
+        ## sequence numbers), so that they can be looked up and
+        ## removed without going through the whole configuration.
+        self._assignments = {}
+        self._index = {}
+        self._seq = 0
+        ## The file as read by read_conf() in update mode: a list of
+        ## (text, expr) tuples, where expr is the assignment expression
+        ## parsed from text, or None for anything else
+        self._file_segments = None
+        ## Sequence numbers of the assignments read from the file in
+        ## update mode which have not been set again.  Setting them
+        ## again (see add()) updates them where they are, instead of
+        ## adding another copy on each run.
+        self._from_file = set()
+
+    def _lines(self, content=None):
+        if content is None:
+            return read_lines(self.conf_file)
+        return content.splitlines(True)
+
+    def _read_conf(self, content=None):
+        ''' Return the logical lines of the configuration file '''
+        return [ line for _, line in logical_lines(self._lines(content)) if line is not None ]
+
+    def _parse_line(self, line):
+        return parse_conf_line(line)
 
     def _parse_conf(self, lines):
         assignments = []
         for line in lines:
-            lstripped_line = line.lstrip()
-            if (lstripped_line.startswith('require') or
-                lstripped_line.startswith('addpylib') or
-                lstripped_line.startswith('include')):
-                continue
-            expr = parse_assignment_expr(line)
+            expr = self._parse_line(line)
             if expr:
                 assignments.append(expr)
         return assignments
 
     def _simplify(self):
-        ## Squash multiple values for sequential assignment
-        ## expressions which envolve the same variable and operator is
-        ## '+='.  So:
-        ##     foo += 'bar'
-        ##     foo += 'baz'
-        ## is turned into:
-        ##     foo += 'bar baz'
-        simpl_data = []
-        for expr in self.conf_data:
-            if simpl_data:
-                prev_var, prev_op, prev_val = simpl_data[-1]
-                if prev_var == expr[0] and prev_op == '+=' and prev_op == expr[1]:
-                    simpl_data[-1] = (prev_var, prev_op, prev_val + expr[2])
-                    continue
-            simpl_data.append(expr)
-        return simpl_data
-
-
-    def read_conf(self):
-        self.conf_data = self._parse_conf(self._read_conf())
+        return simplify_assignments(self.conf_data)
+
+    @property
+    def conf_data(self):
+        ''' The list of (var, op, val) assignments.  Changing it (see
+        AssignmentList) replaces the assignments, like setting it. '''
+        return AssignmentList(self, [ (a.var, a.op, a.val) for a in self._assignments.values() ])
+
+    @conf_data.setter
+    def conf_data(self, assignments):
+        self._assignments = {}
+        self._index = {}
+        self._from_file = set()
+        for var, op, val in assignments:
+            self._append(var, op, val)
+
+    def _append(self, var, op, val):
+        self._seq += 1
+        self._assignments[self._seq] = Assignment(var, op, val)
+        self._index.setdefault(var, []).append(self._seq)
+
+    def get(self, var):
+        ''' Return the list of (var, op, val) assignments to var '''
+        return [ tuple(self._assignments[seq]) for seq in self._index.get(var, []) ]
+
+    def __contains__(self, var):
+        return var in self._index
+
+    def read_conf(self, content=None):
+        ''' Read the configuration file, or `content' (a string) in
+        its place.  The file is streamed: its text is only kept in
+        update mode, to update it in place. '''
+        segments = ( (text, line and parse_conf_line(line))
+                     for text, line in logical_lines(self._lines(content)) )
+        if self.update:
+            self._file_segments = list(segments)
+            segments = self._file_segments
+        self.conf_data = [ expr for _, expr in segments if expr ]
+        if self.update:
+            self._from_file = set(self._assignments.keys())
+
+
+    def _render_update(self):
+        ## Compute the minimal edit from the assignments in the file to
+        ## the current ones
+        key = lambda expr: (expr[0], expr[1], tuple(expr[2]))
+        file_data = [ expr for _, expr in self._file_segments if expr ]
+        matcher = difflib.SequenceMatcher(None,
+                                          [ key(expr) for expr in file_data ],
+                                          [ key(expr) for expr in self.conf_data ],
+                                          autojunk=False)
+        replaced = {}  # index in file_data -> new text
+        inserted = {}  # index in file_data -> text to insert before it
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                continue
+            text = ''.join([ format_assignment(*expr)
+                             for expr in simplify_assignments(self.conf_data[j1:j2]) ])
+            if i1 == i2:
+                inserted[i1] = text
+            else:
+                for i in range(i1, i2):
+                    replaced[i] = ''
+                replaced[i1] = text
 
+        content = ''
+        i = 0
+        for text, expr in self._file_segments:
+            if expr:
+                content += inserted.get(i, '') + replaced.get(i, text)
+                i += 1
+            else:
+                content += text
+        if inserted.get(i):
+            if content and not content.endswith('\n'):
+                content += '\n'
+            content += inserted[i]
+        return content
+
+    def render(self):
+        ''' Return the contents of the configuration file for the
+        current data '''
+        if self.update and self._file_segments is not None:
+            return self._render_update()
+        return ''.join([ format_assignment(var, op, val)
+                         for var, op, val in self._simplify() ])
 
     def write(self):
         if not self.read_only:
-            conf_fd = open(self.conf_file, 'w')
-            for var, op, val in self._simplify():
-                conf_fd.write('%s %s %s\n' % (var, op, format_value(val)))
-            conf_fd.close()
+            content = self.render()
+            try:
+                with open(self.conf_file) as conf_fd:
+                    if conf_fd.read() == content:
+                        debug('%s is up to date' % self.conf_file)
+                        return
+            except (IOError, OSError):
+                pass
+            write_file_atomically(self.conf_file, content)
 
     def add(self, var, op, val):
-        if not self.read_only:
-            self.conf_data.append((var, op, split_keep_spaces(str(val))))
+        if self.read_only:
+            return
+        val = split_keep_spaces(str(val))
+        ## In update mode, an assignment to var with the same operator
+        ## read from the file (i.e., most likely added by a previous
+        ## run) is updated where it is
+        for seq in self._index.get(var, []):
+            if seq in self._from_file and self._assignments[seq].op == op:
+                self._from_file.discard(seq)
+                self._assignments[seq] = Assignment(var, op, val)
+                return
+        self._append(var, op, val)
 
     def remove(self, var):
         if not self.read_only:
-            new_conf = []
-            for expr in self.conf_data:
-                if var != expr[0]:
-                    new_conf.append(expr)
-            self.conf_data = new_conf
+            for seq in self._index.pop(var, []):
+                del self._assignments[seq]
+                self._from_file.discard(seq)
+
+    def reset(self, var, op, val):
+        ''' Make (var, op, val) the only assignment to var.  The first
+        existing assignment to var is edited in place, and the other
+        ones removed. '''
+        if self.read_only:
+            return
+        seqs = self._index.get(var)
+        if not seqs:
+            self.add(var, op, val)
+            return
+        for seq in seqs[1:]:
+            del self._assignments[seq]
+            self._from_file.discard(seq)
+        self._index[var] = seqs[:1]
+        self._assignments[seqs[0]] = Assignment(var, op, split_keep_spaces(str(val)))
+        self._from_file.discard(seqs[0])
+
+def weak_set_var(var):
+    _CONTEXT.weak_set_var(var)
 
 def write_confs():
-    LOCAL_CONF.write()
-    BBLAYERS_CONF.write()
+    _CONTEXT.write_confs()
+
+###
+### Effective values
+###
+## Variable references and inline Python expressions, as matched by
+## BitBake
+VAR_REF_RE = re.compile(r'\$\{[a-zA-Z0-9\-_+./~:]+?\}')
+PYTHON_REF_RE = re.compile(r'\$\{@(?:\{.*?\}|.)+?\}')
+
+## Statements which are not assignments
+INCLUDE_RE = re.compile(r'(include_all|include|require)\s+(.+)$')
+UNSET_RE = re.compile(r'unset\s+([^\s\[]+)$')
+FUNCTION_START_RE = re.compile(r'(?:fakeroot\s+)?(?:python\s+)?[\w\-.${}:]*\s*\(\s*\)\s*\{$')
+
+## Functions inline Python expressions can call.  Expressions calling
+## anything else are left unexpanded.
+PYTHON_REF_FUNCTIONS = { 'os.path.abspath': os.path.abspath,
+                         'os.path.basename': os.path.basename,
+                         'os.path.dirname': os.path.dirname,
+                         'os.path.join': os.path.join,
+                         'os.path.normpath': os.path.normpath,
+                         'os.path.realpath': os.path.realpath,
+                         'str': str,
+                         'int': int,
+                         'len': len }
+
+## String methods inline Python expressions can call
+PYTHON_REF_STR_METHODS = frozenset([ 'endswith', 'lower', 'replace', 'startswith', 'strip', 'upper' ])
+
+## Variables BitBake always takes from the environment, besides the
+## ones in BB_ENV_PASSTHROUGH_ADDITIONS
+EVAL_ENV_VARIABLES = [ 'HOME', 'PATH', 'USER' ]
+
+class _Unevaluable(Exception):
+    pass
+
+class ConfEvaluator(object):
+    ''' Evaluate variables the way BitBake does after parsing
+    configuration files, without parsing any recipe.  Includes are
+    followed, assignment operators, :append, :prepend, :remove and
+    conditional overrides are applied, and references to variables
+    expanded.  Inline Python expressions are only evaluated when they
+    use a few known functions (see PYTHON_REF_FUNCTIONS); like
+    references to unknown variables, other ones are left unexpanded.
+
+    `contents' maps configuration files to contents to read in their
+    place. '''
+
+    def __init__(self, contents=None):
+        self.contents = contents or {}
+        self.values = {}     # var -> value
+        self.defaults = {}   # var -> weak default value (??=)
+        self.overrides = {}  # var -> [(operation, conditions, value)]
+        self.files = []
+        self._expanding = set()
+        self._generation = 0
+        self._active_overrides_cache = (None, None)
+
+    def _exists(self, path):
+        return path in self.contents or os.path.exists(path)
+
+    def set(self, var, val):
+        self._generation += 1
+        self.values[var] = val
+
+    def which(self, path, conf_file=None, find_all=False):
+        ''' Return the list of files path (relative to the directory of
+        conf_file or to BBPATH) refers to: the first one found, or all
+        of them with find_all '''
+        if os.path.isabs(path):
+            return [ path ] if self._exists(path) else []
+        dirs = (self.get('BBPATH') or '').split(':')
+        if conf_file:
+            dirs.insert(0, os.path.dirname(conf_file))
+        found = []
+        for directory in dirs:
+            candidate = os.path.join(directory, path)
+            if directory and '${' not in directory and candidate not in found and self._exists(candidate):
+                found.append(candidate)
+                if not find_all:
+                    break
+        return found
+
+    def read(self, conf_file, required=True):
+        ''' Parse conf_file, following its includes '''
+        if not self._exists(conf_file):
+            if required:
+                raise Exception('Could not find %s' % conf_file)
+            return
+        if conf_file in self.contents:
+            lines = self.contents[conf_file].splitlines(True)
+        else:
+            lines = read_lines(conf_file)
+        self.files.append(conf_file)
+        old_file = self.values.get('FILE')
+        self.set('FILE', conf_file)
+        in_function = False
+        in_def = False
+        for _, line in logical_lines(lines):
+            if line is None:
+                continue
+            stripped = line.strip()
+            ## Skip shell and Python functions
+            if in_function:
+                in_function = stripped != '}'
+                continue
+            if in_def and line[0].isspace():
+                continue
+            in_def = stripped.startswith('def ')
+            if in_def:
+                continue
+            if FUNCTION_START_RE.match(stripped):
+                in_function = True
+                continue
+            m = INCLUDE_RE.match(stripped)
+            if m:
+                self._include(m.group(1), m.group(2), conf_file)
+                continue
+            m = UNSET_RE.match(stripped)
+            if m:
+                self._generation += 1
+                for data in [ self.values, self.defaults, self.overrides ]:
+                    data.pop(m.group(1), None)
+                continue
+            m = ASSIGNMENT_EXPR_RE.match(stripped)
+            if m:
+                self.assign(*m.group('var', 'op', 'val'))
+        if old_file is None:
+            self.values.pop('FILE', None)
+        else:
+            self.set('FILE', old_file)
+
+    def _include(self, kind, path, conf_file):
+        path = self.expand(path.strip())
+        if '${' in path:
+            debug('Not including %s (from %s): could not expand it' % (path, conf_file))
+            return
+        found = self.which(path, None if kind == 'include_all' else conf_file, kind == 'include_all')
+        if not found and kind == 'require':
+            raise Exception('Could not find %s, required by %s' % (path, conf_file))
+        for included_file in found:
+            self.read(included_file)
+
+    def read_layer(self, layer_dir):
+        ''' Parse the layer.conf of layer_dir, like BitBake: with
+        LAYERDIR set to layer_dir while it is parsed, and references to
+        it replaced by its value afterwards '''
+        refs = { '${LAYERDIR}': layer_dir, '${LAYERDIR_RE}': re.escape(layer_dir) }
+        self.set('LAYERDIR', layer_dir)
+        self.set('LAYERDIR_RE', refs['${LAYERDIR_RE}'])
+        self.read(os.path.join(layer_dir, 'conf', 'layer.conf'), required=False)
+        del self.values['LAYERDIR']
+        del self.values['LAYERDIR_RE']
+
+        def replace_refs(val):
+            for ref, ref_val in refs.items():
+                val = val.replace(ref, ref_val)
+            return val
+        for data in [ self.values, self.defaults ]:
+            for var, val in data.items():
+                if '${LAYERDIR' in val:
+                    data[var] = replace_refs(val)
+        for var, variants in self.overrides.items():
+            self.overrides[var] = [ (operation, conditions, replace_refs(val))
+                                    for operation, conditions, val in variants ]
+
+    def assign(self, var, op, val):
+        ''' Apply the `var op val' assignment '''
+        if '[' in var:
+            return # variable flags don't matter here
+        if len(val) > 1 and val[0] == val[-1] and val[0] in '"\'':
+            val = val[1:-1]
+        self._generation += 1
+        var, _, suffix = var.partition(':')
+        if suffix:
+            ## :append, :prepend and :remove, possibly conditional
+            ## (VAR:append:cond or VAR:cond:append), and conditional
+            ## values
+            conditions = suffix.split(':')
+            operation = 'set'
+            for candidate in [ 'append', 'prepend', 'remove' ]:
+                if candidate in conditions:
+                    operation = candidate
+                    conditions.remove(candidate)
+                    break
+            if op == ':=':
+                val = self.expand(val)
+            elif op in [ '+=', '=+' ]:
+                val = ' ' + val if op == '+=' else val + ' '
+            self.overrides.setdefault(var, []).append((operation, conditions, val))
+        elif op == '=':
+            self.values[var] = val
+        elif op == '?=':
+            if var not in self.values:
+                self.values[var] = val
+        elif op == '??=':
+            self.defaults[var] = val
+        elif op == ':=':
+            self.values[var] = self.expand(val)
+        else:
+            ## Like BitBake, these ignore weak defaults
+            current = self.values.get(var, '')
+            if op == '+=':
+                self.values[var] = '%s %s' % (current, val)
+            elif op == '=+':
+                self.values[var] = '%s %s' % (val, current)
+            elif op == '.=':
+                self.values[var] = current + val
+            elif op == '=.':
+                self.values[var] = val + current
+
+    def _active_overrides(self):
+        generation, overrides = self._active_overrides_cache
+        if generation != self._generation:
+            overrides = [ o for o in (self.get('OVERRIDES') or '').split(':') if o and '$' not in o ]
+            self._active_overrides_cache = (self._generation, overrides)
+        return overrides
+
+    def get(self, var, expand=True):
+        ''' Return the value of var, or None if it is not set '''
+        if var in self._expanding:
+            return None
+        value = self.values.get(var, self.defaults.get(var))
+        removes = []
+        variants = self.overrides.get(var)
+        if variants and var != 'OVERRIDES':
+            active = self._active_overrides()
+            applicable = [ (operation, conditions, val) for operation, conditions, val in variants
+                           if all([ c in active for c in conditions ]) ]
+            ## Conditional values: the override which comes last in
+            ## OVERRIDES wins
+            candidates = [ (max([ active.index(c) for c in conditions ]), i, val)
+                           for i, (operation, conditions, val) in enumerate(applicable)
+                           if operation == 'set' and conditions ]
+            if candidates:
+                value = max(candidates)[2]
+            for operation, conditions, val in applicable:
+                if operation == 'append':
+                    value = (value or '') + val
+                elif operation == 'prepend':
+                    value = val + (value or '')
+                elif operation == 'remove':
+                    removes.append(val)
+        if value is None:
+            return None
+        if expand:
+            value = self.expand(value, var)
+        if removes:
+            removed = set(self.expand(' '.join(removes), var).split())
+            value = ''.join([ word for word in re.split(r'(\s+)', value) if word not in removed ])
+        return value
+
+    def expand(self, s, var=None):
+        ''' Return s with the variable references and inline Python
+        expressions which can be evaluated expanded '''
+        if var is not None:
+            self._expanding.add(var)
+        try:
+            for _ in range(100):
+                if '${' not in s:
+                    break
+                new = VAR_REF_RE.sub(self._expand_var_ref, s)
+                new = PYTHON_REF_RE.sub(self._expand_python_ref, new)
+                if new == s:
+                    break
+                s = new
+        finally:
+            if var is not None:
+                self._expanding.discard(var)
+        return s
+
+    def _expand_var_ref(self, match):
+        val = self.get(match.group()[2:-1])
+        return match.group() if val is None else val
+
+    def _expand_python_ref(self, match):
+        try:
+            val = self._eval(ast.parse(match.group()[3:-1].strip(), mode='eval').body)
+        except (_Unevaluable, SyntaxError, ValueError, TypeError, AttributeError, IndexError, KeyError):
+            return match.group()
+        return '' if val is None else str(val)
+
+    def _dotted_name(self, node):
+        if isinstance(node, ast.Name):
+            return node.id
+        if isinstance(node, ast.Attribute):
+            base = self._dotted_name(node.value)
+            return base and '%s.%s' % (base, node.attr)
+        return None
+
+    def _eval(self, node):
+        ''' Evaluate the inline Python expression node, raising
+        _Unevaluable for anything not known to be harmless '''
+        if isinstance(node, ast.Constant) and isinstance(node.value, (str, int, bool, type(None))):
+            return node.value
+        if isinstance(node, ast.Name) and node.id == 'd':
+            return self
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            return self._eval(node.left) + self._eval(node.right)
+        if isinstance(node, ast.BoolOp):
+            val = None
+            for value in node.values:
+                val = self._eval(value)
+                if isinstance(node.op, ast.And) != bool(val):
+                    break
+            return val
+        if isinstance(node, ast.IfExp):
+            return self._eval(node.body) if self._eval(node.test) else self._eval(node.orelse)
+        if isinstance(node, ast.Compare) and len(node.ops) == 1:
+            left = self._eval(node.left)
+            right = self._eval(node.comparators[0])
+            for op_type, fn in [ (ast.Eq, lambda a, b: a == b),
+                                 (ast.NotEq, lambda a, b: a != b),
+                                 (ast.In, lambda a, b: a in b),
+                                 (ast.NotIn, lambda a, b: a not in b) ]:
+                if isinstance(node.ops[0], op_type):
+                    return fn(left, right)
+        if isinstance(node, ast.Call) and not node.keywords:
+            name = self._dotted_name(node.func)
+            args = [ self._eval(arg) for arg in node.args ]
+            if name == 'd.getVar':
+                return self.get(args[0], *args[1:2])
+            if name == 'bb.utils.contains' and len(args) == 5:
+                var, checkvalues, truevalue, falsevalue, _ = args
+                words = set((self.get(var) or '').split())
+                return truevalue if set(checkvalues.split()).issubset(words) else falsevalue
+            if name == 'oe.utils.conditional' and len(args) == 5:
+                var, checkvalue, truevalue, falsevalue, _ = args
+                return truevalue if self.get(var) == checkvalue else falsevalue
+            if name in PYTHON_REF_FUNCTIONS:
+                return PYTHON_REF_FUNCTIONS[name](*args)
+            if isinstance(node.func, ast.Attribute) and node.func.attr in PYTHON_REF_STR_METHODS:
+                obj = self._eval(node.func.value)
+                if isinstance(obj, str):
+                    return getattr(obj, node.func.attr)(*args)
+        raise _Unevaluable()
+
+def bblayers_evaluator(build_dir_path, contents=None, env=None):
+    ''' Return a ConfEvaluator with conf/bblayers.conf of
+    build_dir_path parsed.  Like BitBake, it starts from the variables
+    passed through from env (the environment by default). '''
+    if env is None:
+        env = os.environ
+    evaluator = ConfEvaluator(contents)
+    for var in EVAL_ENV_VARIABLES + env.get('BB_ENV_PASSTHROUGH_ADDITIONS', '').split():
+        if var in env:
+            evaluator.set(var, env[var])
+    evaluator.set('TOPDIR', build_dir_path)
+    evaluator.read(os.path.join(build_dir_path, 'conf', 'bblayers.conf'), required=False)
+    return evaluator
+
+def build_dir_evaluator(build_dir_path, contents=None, env=None):
+    ''' Return a ConfEvaluator with the configuration BitBake parses for
+    build_dir_path: conf/bblayers.conf (see bblayers_evaluator()), the
+    layer.conf files of the layers in BBLAYERS, then conf/bitbake.conf,
+    which includes local.conf and the machine and distro configuration
+    (local.conf only if bitbake.conf can't be found). '''
+    evaluator = bblayers_evaluator(build_dir_path, contents, env)
+    for layer_dir in (evaluator.get('BBLAYERS') or '').split():
+        if '${' not in layer_dir:
+            evaluator.read_layer(layer_dir)
+    bitbake_conf = evaluator.which('conf/bitbake.conf')
+    if bitbake_conf:
+        evaluator.read(bitbake_conf[0])
+    else:
+        evaluator.read(os.path.join(build_dir_path, 'conf', 'local.conf'), required=False)
+    return evaluator
+
+def report_effective_values(build_dir, variables):
+    ''' Print the values of variables for build_dir, as BitBake would
+    set them (see build_dir_evaluator()) '''
+    build_dir_path = os.path.join(PLATFORM_ROOT_DIR, build_dir)
+    if not os.path.isdir(os.path.join(build_dir_path, 'conf')):
+        sys.stderr.write('ERROR: %s has not been set up.\n' % build_dir_path)
+        sys.exit(1)
+    evaluator = build_dir_evaluator(build_dir_path)
+    for var in variables:
+        val = evaluator.get(var)
+        if val is None:
+            print('# %s is not set' % var)
+        else:
+            print('%s="%s"' % (var, val.replace('\\', '\\\\').replace('"', '\\"')))
 
 ###
 ### Misc
@@ -453,6 +1378,56 @@ def debug(msg):
     if DEBUG_SETUP_ENVIRONMENT:
         sys.stderr.write('DEBUG: ' + msg + '\n')
 
+###
+### Tracing & profiling
+###
+## File to write a trace of the setup phases to (Chrome trace event
+## format: load it in chrome://tracing or https://ui.perfetto.dev)
+SETUP_ENVIRONMENT_TRACE = os.environ.get('SETUP_ENVIRONMENT_TRACE')
+
+## File to write cProfile statistics to (see the pstats module)
+SETUP_ENVIRONMENT_PROFILE = os.environ.get('SETUP_ENVIRONMENT_PROFILE')
+
+TRACE_EVENTS = []
+
+@contextlib.contextmanager
+def phase(name, **args):
+    ''' Context manager recording how long the code it wraps takes '''
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start_time
+        TRACE_EVENTS.append({ 'name': name,
+                              'ph': 'X',
+                              'ts': int(start_time * 1000000),
+                              'dur': int(duration * 1000000),
+                              'pid': os.getpid(),
+                              'tid': 0,
+                              'args': args })
+        debug('%s%s took %.1f ms' % (name,
+                                     ''.join([ ' [%s]' % v for v in args.values() ]),
+                                     duration * 1000))
+
+def write_trace(trace_file):
+    with open(trace_file, 'w') as trace_fd:
+        json.dump({ 'traceEvents': TRACE_EVENTS,
+                    'displayTimeUnit': 'ms' }, trace_fd, indent=1)
+
+def start_tracing():
+    ''' Set up writing the trace and profile, as requested in the
+    environment, when the process exits '''
+    if SETUP_ENVIRONMENT_TRACE:
+        atexit.register(write_trace, SETUP_ENVIRONMENT_TRACE)
+    if SETUP_ENVIRONMENT_PROFILE:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        def stop_profiler():
+            profiler.disable()
+            profiler.dump_stats(SETUP_ENVIRONMENT_PROFILE)
+        atexit.register(stop_profiler)
+
 def count_leading_spaces(s):
     spaces = 0
     for char in s:
@@ -479,9 +1454,53 @@ def split_keep_spaces(s):
     else:
         return tokens
 
+def walk_tree(basedir, maxdepth=None, type=None, path=None, name=None, prune=None):
+    ''' In-process equivalent of find(1) for the subset of options
+    supported by system_find().  Directories whose name is in `prune'
+    (PRUNE_DIRS by default) are not descended into. '''
+    if path and name:
+        raise Exception('path and name cannot be used together.')
+    if prune is None:
+        prune = PRUNE_DIRS
+
+    def matches(entry_path, is_dir):
+        if type == 'd' and not is_dir:
+            return False
+        if type == 'f' and (is_dir or os.path.islink(entry_path) or not os.path.isfile(entry_path)):
+            return False
+        if path and not fnmatch.fnmatchcase(entry_path, path):
+            return False
+        if name and not fnmatch.fnmatchcase(os.path.basename(entry_path), name):
+            return False
+        return True
+
+    found = []
+    if not os.path.isdir(basedir):
+        return found
+    if matches(basedir, True):
+        found.append(basedir)
+    if maxdepth is None:
+        maxdepth = sys.maxsize
+    if maxdepth < 1:
+        return found
+    for dir, depth, subdirs, files in walk_cached(basedir, maxdepth, {}, {}, prune):
+        for subdir in subdirs:
+            subdir_path = os.path.join(dir, subdir)
+            if matches(subdir_path, True):
+                found.append(subdir_path)
+        for file in files:
+            file_path = os.path.join(dir, file)
+            if matches(file_path, False):
+                found.append(file_path)
+    return found
+
 def system_find(basedir, maxdepth=None, type=None, expr=None, path=None, name=None):
     if path and name:
         raise Exception('path and name cannot be used together.')
+    if not expr and type in [None, 'd', 'f']:
+        return walk_tree(basedir, maxdepth=maxdepth, type=type, path=path, name=name)
+
+    ## Fall back to find(1) for what walk_tree() doesn't support
     args = [basedir]
     if maxdepth:
         args += ['-maxdepth', str(maxdepth)]
@@ -498,74 +1517,689 @@ def system_find(basedir, maxdepth=None, type=None, expr=None, path=None, name=No
     ## Remove the trailing newlines
     return [ l[:-1].decode() for l in proc.stdout.readlines() ]
 
+## Layer priorities, indexed by layer directory, so that each
+## layer.conf is parsed at most once per run
+_LAYER_PRIORITIES = {}
+
 def get_layer_priority(layer_dir):
-    conf_file = os.path.join(layer_dir, 'conf', 'layer.conf')
-    c = Conf(conf_file, quiet=True)
-    c.read_conf()
-    priority = None
-    for expr in c.conf_data:
-        ## Although it's quite sloppy, let's consider a layer conf
-        ## file will only set the priority for itself.  Just pick
-        ## anything that starts with BBFILE_PRIORITY
-        if expr[0].startswith('BBFILE_PRIORITY'):
-            try:
-                priority = int(expr[2][0])
-            except:
-                ## Some layers try to use "dynamic" priority based on other layers (e.g: meta-qt6)
-                ## and we can assume it as undefined.
-                pass
+    layer_dir = os.path.normpath(layer_dir)
+    if layer_dir in _LAYER_PRIORITIES:
+        return _LAYER_PRIORITIES[layer_dir]
+    ## Priorities based on the priority of other layers (e.g., meta-qt6)
+    ## are resolved against the layers parsed so far (see
+    ## resolve_priority())
+    priority = layer_priority_from_info(get_layer_info(layer_dir))
     if priority is None:
-        debug('Could not determine priority for layer (%s). Setting it as "1."' % conf_file)
+        debug('Could not determine priority for layer (%s). Setting it as "1."' %
+              os.path.join(layer_dir, 'conf', 'layer.conf'))
         priority = 1
+    _LAYER_PRIORITIES[layer_dir] = priority
     return priority
 
+def reset_caches():
+    ''' Forget everything cached in memory about the sources tree '''
+    global _LAYER_INDEX, _SOURCES, _LAYERS, _MACHINES, _COMPILED_MODULES, _MODULE_DECLARATIONS
+    _COMPILED_MODULES = None
+    _MODULE_DECLARATIONS = None
+    _LAYER_INDEX = None
+    _SOURCES = None
+    _LAYERS = None
+    _MACHINES = None
+    _LAYER_PRIORITIES.clear()
+    _LAYER_INFO.clear()
+
+###
+### Layer index
+###
+LAYER_INDEX_VERSION = 3
+
+## Number of threads used to scan the sources tree and parse layer.conf
+## files.  Most of the time is spent waiting for the filesystem
+## (especially on network filesystems), so this is not bound to the
+## number of CPUs.
+try:
+    SETUP_ENVIRONMENT_JOBS = max(1, int(os.environ.get('SETUP_ENVIRONMENT_JOBS', 8)))
+except ValueError:
+    sys.stderr.write('WARNING: invalid SETUP_ENVIRONMENT_JOBS value.  Using 1.\n')
+    SETUP_ENVIRONMENT_JOBS = 1
+
+## Directories which are never searched for layers or modules
+PRUNE_DIRS = frozenset(['.git', '.hg', '.svn', '.bzr', '.repo', 'CVS', '__pycache__'])
+
+## In-memory state, computed once per process: the layer index, the
+## result of scan_sources(), the result of find_layers() and the
+## machine catalog
+_LAYER_INDEX = None
+_SOURCES = None
+_LAYERS = None
+_MACHINES = None
+
+def _stat_key(path):
+    st = os.stat(path)
+    ## Entries modified in the last couple of seconds are not trusted,
+    ## as further changes in the same timestamp granule (NFS has one
+    ## second resolution) would go unnoticed.
+    if time.time() - st.st_mtime < 2:
+        return None
+    return [st.st_mtime_ns, st.st_ino]
+
+def read_cache_file(cache_file):
+    ''' Return the data stored in cache_file, or None if it can't be
+    read or SETUP_ENVIRONMENT_REFRESH is set '''
+    if not cache_file or SETUP_ENVIRONMENT_REFRESH:
+        return None
+    try:
+        with open(cache_file) as cache_fd:
+            return json.load(cache_fd)
+    except (IOError, OSError, ValueError):
+        debug('Could not read cache file %s' % cache_file)
+        return None
+
+def write_cache_file(cache_file, data):
+    if DRY_RUN:
+        return
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'w') as cache_fd:
+            json.dump(data, cache_fd)
+        os.replace(tmp_file, cache_file)
+    except (IOError, OSError) as e:
+        debug('Could not write cache file %s: %s' % (cache_file, e))
+
+def load_layer_index():
+    global _LAYER_INDEX
+    if _LAYER_INDEX is not None:
+        return _LAYER_INDEX
+    index = read_cache_file(LAYER_INDEX_FILE)
+    if (not isinstance(index, dict) or
+        index.get('version') != LAYER_INDEX_VERSION or
+        index.get('root') != PLATFORM_ROOT_DIR):
+        index = { 'version': LAYER_INDEX_VERSION,
+                  'root': PLATFORM_ROOT_DIR,
+                  'dirs': {},
+                  'layers': {} }
+    _LAYER_INDEX = index
+    return index
+
+def save_layer_index(index):
+    if LAYER_INDEX_FILE:
+        write_cache_file(LAYER_INDEX_FILE, index)
+
+def walk_cached(basedir, maxdepth, old_dirs, new_dirs, prune=PRUNE_DIRS):
+    ''' Walk basedir down to maxdepth (like find -maxdepth), yielding
+    (dir, depth, subdirs, files).  The listing of directories whose
+    mtime did not change since they were recorded in old_dirs is
+    reused instead of reading the directory again.  The listings of
+    all visited directories are stored in new_dirs.  Directories in
+    `prune' are left out of the listings. '''
+    stack = [(basedir, 0)]
+    while stack:
+        path, depth = stack.pop()
+        try:
+            key = _stat_key(path)
+        except OSError:
+            continue
+        entry = old_dirs.get(path)
+        if key is None or not entry or entry['stat'] != key:
+            subdirs = []
+            files = []
+            try:
+                for dir_entry in os.scandir(path):
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        if dir_entry.name not in prune:
+                            subdirs.append(dir_entry.name)
+                    else:
+                        files.append(dir_entry.name)
+            except OSError:
+                continue
+            entry = { 'stat': key,
+                      'dirs': sorted(subdirs),
+                      'files': sorted(files) }
+        new_dirs[path] = entry
+        yield path, depth, entry['dirs'], entry['files']
+        if depth + 1 < maxdepth:
+            for subdir in reversed(entry['dirs']):
+                stack.append((os.path.join(path, subdir), depth + 1))
+
+def parallel_map(fn, items):
+    ''' Like map(), but calls fn in up to SETUP_ENVIRONMENT_JOBS
+    threads.  The results are returned as a list, in the same order as
+    items. '''
+    items = list(items)
+    if SETUP_ENVIRONMENT_JOBS < 2 or len(items) < 2:
+        return [ fn(item) for item in items ]
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(SETUP_ENVIRONMENT_JOBS, len(items))) as executor:
+        return list(executor.map(fn, items))
+
+def scan_sources():
+    ''' Walk sources/ once and return a (layers, modules) tuple, where
+    layers maps layer names to their directories (any directory with a
+    conf/layer.conf down to depth 4, like find -path
+    '*/conf/layer.conf') and modules lists the hook modules found in
+    setup-environment.d directories down to depth 3. '''
+    global _SOURCES
+    if _SOURCES is not None:
+        return _SOURCES
+
+    with phase('scan sources'):
+        sources_dir = os.path.join(PLATFORM_ROOT_DIR, "sources")
+        index = load_layer_index()
+        new_dirs = {}
+
+        ## Each directory in sources/ is walked in its own thread
+        def walk_subtree(subdir):
+            subtree_dirs = {}
+            entries = [ (path, depth + 1, subdirs, files)
+                        for path, depth, subdirs, files in walk_cached(os.path.join(sources_dir, subdir),
+                                                                       3, index['dirs'], subtree_dirs) ]
+            return entries, subtree_dirs
+
+        top_subdirs = []
+        for path, depth, subdirs, files in walk_cached(sources_dir, 1, index['dirs'], new_dirs):
+            top_subdirs = subdirs
+
+        layers = {}
+        modules = []
+        for entries, subtree_dirs in parallel_map(walk_subtree, top_subdirs):
+            new_dirs.update(subtree_dirs)
+            for path, depth, subdirs, files in entries:
+                basename = os.path.basename(path)
+                if basename == 'conf' and 'layer.conf' in files:
+                    layer_dir = os.path.dirname(path)
+                    layer = os.path.basename(layer_dir)
+                    if layer in layers:
+                        sys.stderr.write('WARNING: layer %s found in %s and %s.  Ignoring the latter.\n' %
+                                         (layer, layers[layer], layer_dir))
+                    else:
+                        layers[layer] = layer_dir
+                elif basename == 'setup-environment.d' and depth <= 3:
+                    modules += [ os.path.join(path, f) for f in files
+                                 if f.endswith('.py') and not f.startswith('.') ]
+
+        if new_dirs != index['dirs']:
+            index['dirs'] = new_dirs
+            save_layer_index(index)
+
+    _SOURCES = (layers, modules)
+    return _SOURCES
+
 def find_layers():
-    ''' Return a dict mapping layer names to their paths '''
-    layer_conf_paths = system_find(os.path.join(PLATFORM_ROOT_DIR, "sources"),
-                                   maxdepth = 4,
-                                   path = '*/conf/layer.conf')
-    layers = {}
-    for layer_conf_path in layer_conf_paths:
-        layer_dir = os.path.dirname(os.path.dirname(layer_conf_path))
-        layer = os.path.basename(layer_dir)
-        layers[layer] = layer_dir
-
-    # Determine priorities
-    layers_with_priorities = {}
-    for name, layer_dir in layers.items():
-        priority = get_layer_priority(layer_dir)
-        layers_with_priorities[name] = {'priority': priority,
-                                        'path': layer_dir }
-    return layers_with_priorities
+    ''' Return a dict mapping layer names to their paths and priorities.
+
+    The result is computed once per process.  Across runs, the layer
+    index in LAYER_INDEX_FILE is used to avoid listing directories and
+    parsing layer.conf files which have not changed. '''
+    global _LAYERS
+    if _LAYERS is not None:
+        return _LAYERS
+
+    layers, _ = scan_sources()
+    with phase('find layers'):
+        index = load_layer_index()
+
+        def layer_entry(item):
+            name, layer_dir = item
+            conf_file = os.path.join(layer_dir, 'conf', 'layer.conf')
+            try:
+                key = _stat_key(conf_file)
+            except OSError:
+                key = None
+            entry = index['layers'].get(layer_dir)
+            if key is None or not entry or entry['stat'] != key:
+                debug('Parsing %s' % conf_file)
+                entry = { 'name': name,
+                          'path': layer_dir,
+                          'info': parse_layer_conf(layer_dir),
+                          'stat': key }
+            return entry
+
+        # Parse all the layer.conf files (concurrently) before
+        # determining priorities, as they may depend on each other
+        new_layers = {}
+        for entry in parallel_map(layer_entry, sorted(layers.items())):
+            new_layers[entry['path']] = entry
+            _LAYER_INFO[os.path.normpath(entry['path'])] = entry['info']
+        layers_with_priorities = {}
+        for layer_dir, entry in sorted(new_layers.items()):
+            _LAYER_PRIORITIES.pop(os.path.normpath(layer_dir), None)
+            layers_with_priorities[entry['name']] = {'priority': get_layer_priority(layer_dir),
+                                                     'path': layer_dir }
+
+        if new_layers != index['layers']:
+            index['layers'] = new_layers
+            save_layer_index(index)
+
+    _LAYERS = layers_with_priorities
+    return _LAYERS
 
-def weak_set_var(var):
-    # Use the environment as value or take the default, making it weak
-    # in the local.conf
+###
+### Layer graph
+###
+## What layer.conf files say about the layers they configure, by layer
+## directory (see parse_layer_conf())
+_LAYER_INFO = {}
+
+def parse_layer_conf(layer_dir):
+    ''' Parse layer_dir/conf/layer.conf in a single pass.  Return a dict
+    with the collections it defines (BBFILE_COLLECTIONS), the release
+    series it is for (LAYERSERIES_CORENAMES, only set by OE-Core), and
+    dicts mapping collections to the raw values of their
+    BBFILE_PRIORITY, LAYERDEPENDS, LAYERRECOMMENDS and
+    LAYERSERIES_COMPAT variables.  Nothing is found for layers
+    without a readable layer.conf. '''
+    info = { 'collections': [],
+             'corenames': [],
+             'priority': {},
+             'depends': {},
+             'recommends': {},
+             'series_compat': {} }
     try:
-        val = os.environ[var]
-    except:
-        val = DEFAULTS[var]
+        assignments = list(iter_assignments(os.path.join(layer_dir, 'conf', 'layer.conf')))
+    except (IOError, OSError, UnicodeDecodeError):
+        return info
+    for var, op, val in assignments:
+        value = ' '.join([ v.strip() for v in val if v.strip() ])
+        ## The parser keeps overrides in variable names: appending to
+        ## (or prepending to) lists of words is like '+='
+        for suffix in [ ':append', ':prepend' ]:
+            if var.endswith(suffix):
+                var, op = var[:-len(suffix)], '+='
+        if var == 'BBFILE_COLLECTIONS':
+            if op not in ['+=', '.=', '=+', '=.']:
+                info['collections'] = []
+            info['collections'] += [ c for c in value.split() if c not in info['collections'] ]
+            continue
+        if var == 'LAYERSERIES_CORENAMES':
+            info['corenames'] = value.split()
+            continue
+        for prefix, key in [ ('BBFILE_PRIORITY_', 'priority'),
+                             ('LAYERDEPENDS_', 'depends'),
+                             ('LAYERRECOMMENDS_', 'recommends'),
+                             ('LAYERSERIES_COMPAT_', 'series_compat') ]:
+            if var.startswith(prefix):
+                collection = var[len(prefix):]
+                if op in ['+=', '.=', '=+', '=.'] and collection in info[key]:
+                    info[key][collection] += ' ' + value
+                elif op not in ['?=', '??='] or collection not in info[key]:
+                    info[key][collection] = value
+    return info
+
+def get_layer_info(layer_dir):
+    ''' Return parse_layer_conf(layer_dir), parsing layer.conf at most
+    once '''
+    layer_dir = os.path.normpath(layer_dir)
+    info = _LAYER_INFO.get(layer_dir)
+    if info is None:
+        info = parse_layer_conf(layer_dir)
+        _LAYER_INFO[layer_dir] = info
+    return info
+
+def parse_layer_list(value):
+    ''' Return the collections (or series) in a LAYERDEPENDS-like value,
+    without version constraints and ignoring anything that would need
+    to be expanded '''
+    return [ item for item in re.sub(r'\([^)]*\)', ' ', value).split() if '$' not in item ]
+
+def _eval_priority_expr(node):
+    ## Integer arithmetic only
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, str)):
+        return int(node.value)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        value = _eval_priority_expr(node.operand)
+        return -value if isinstance(node.op, ast.USub) else value
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub, ast.Mult, ast.FloorDiv)):
+        left = _eval_priority_expr(node.left)
+        right = _eval_priority_expr(node.right)
+        if isinstance(node.op, ast.Add):
+            return left + right
+        if isinstance(node.op, ast.Sub):
+            return left - right
+        if isinstance(node.op, ast.Mult):
+            return left * right
+        return left // right
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+        node.func.id == 'int' and len(node.args) == 1 and not node.keywords):
+        return _eval_priority_expr(node.args[0])
+    raise ValueError('unsupported priority expression')
+
+def resolve_priority(collection, priorities, resolving=()):
+    ''' Return the priority of collection as an integer, or None if it
+    can't be determined.  priorities maps collections to the raw values
+    of their BBFILE_PRIORITY.  Besides integers, simple expressions
+    based on the priority of other layers are supported, like
+    "${BBFILE_PRIORITY_core}" or
+    "${@int(d.getVar('BBFILE_PRIORITY_core')) + 1}". '''
+    value = priorities.get(collection)
+    if value is None or collection in resolving:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    resolving = resolving + (collection,)
+    def other_priority(match):
+        priority = resolve_priority(match.group(1), priorities, resolving)
+        if priority is None:
+            raise ValueError('unknown priority for %s' % match.group(1))
+        return str(priority)
+    try:
+        value = re.sub(r'\$\{BBFILE_PRIORITY_([^}]+)\}', other_priority, value.strip())
+        m = re.match(r'^\$\{@(.*)\}$', value)
+        if m:
+            value = re.sub(r'''d\.getVar\(\s*['"]BBFILE_PRIORITY_([^'"]+)['"]\s*(,\s*\w+\s*)?\)''',
+                           other_priority, m.group(1))
+        return _eval_priority_expr(ast.parse(value.strip(), mode='eval').body)
+    except (ValueError, SyntaxError, TypeError, ZeroDivisionError):
+        return None
+
+def layer_priority_from_info(info):
+    ''' Return the priority of the layer described by info, or None '''
+    ## Like bitbake, consider the collections the layer defines.
+    ## Layers setting a priority for an undeclared collection are
+    ## still considered, as they used to be.
+    collections = info['collections'] + sorted(info['priority'].keys())
+    for collection in collections:
+        priority = resolve_priority(collection, info['priority'])
+        if priority is not None:
+            return priority
+    ## The priority may be based on the priority of other layers
+    priorities = {}
+    for other_info in list(_LAYER_INFO.values()):
+        priorities.update(other_info['priority'])
+    priorities.update(info['priority'])
+    for collection in collections:
+        priority = resolve_priority(collection, priorities)
+        if priority is not None:
+            return priority
+    return None
+
+def order_layers(layer_dirs):
+    ''' Return layer_dirs sorted by priority (highest first), keeping
+    the given order for layers with the same priority, except that
+    layers always come before the layers they depend on (a stable
+    topological sort). '''
+    by_priority = sorted(layer_dirs, key=get_layer_priority, reverse=True)
+    providers = {}
+    for layer_dir in by_priority:
+        for collection in get_layer_info(layer_dir)['collections']:
+            providers.setdefault(collection, layer_dir)
+    dependencies = {}
+    dependents = dict([ (layer_dir, 0) for layer_dir in by_priority ])
+    for layer_dir in by_priority:
+        info = get_layer_info(layer_dir)
+        deps = set()
+        for collection in info['collections']:
+            for dep in parse_layer_list(info['depends'].get(collection, '')):
+                if dep in providers and providers[dep] != layer_dir:
+                    deps.add(providers[dep])
+        dependencies[layer_dir] = deps
+        for dep in deps:
+            dependents[dep] += 1
+
+    ordered = []
+    remaining = by_priority
+    while remaining:
+        for i, layer_dir in enumerate(remaining):
+            if dependents[layer_dir] == 0:
+                break
+        else:
+            ## Dependency loop: fall back to the priority order
+            i = 0
+        layer_dir = remaining.pop(i)
+        ordered.append(layer_dir)
+        for dep in dependencies[layer_dir]:
+            dependents[dep] -= 1
+    return ordered
+
+def check_layers(layer_dirs):
+    ''' Return a list of error messages about the layers in layer_dirs
+    (as in BBLAYERS): missing dependencies and layers not compatible
+    with the release series of OE-Core.  Only what can be determined
+    without expanding variables is checked. '''
+    errors = []
+    collections = set()
+    corenames = set()
+    for layer_dir in layer_dirs:
+        info = get_layer_info(layer_dir)
+        collections.update(info['collections'])
+        corenames.update(info['corenames'])
+    for layer_dir in layer_dirs:
+        info = get_layer_info(layer_dir)
+        for collection in info['collections']:
+            for dep in parse_layer_list(info['depends'].get(collection, '')):
+                if dep not in collections:
+                    errors.append('layer %s (%s) depends on %s, which is not in BBLAYERS' %
+                                  (collection, layer_dir, dep))
+            for rec in parse_layer_list(info['recommends'].get(collection, '')):
+                if rec not in collections:
+                    debug('layer %s (%s) recommends %s, which is not in BBLAYERS' % (collection, layer_dir, rec))
+            compat = parse_layer_list(info['series_compat'].get(collection, ''))
+            if corenames and compat and not corenames.intersection(compat):
+                errors.append('layer %s (%s) is not compatible with the release series of OE-Core (%s): '
+                              'LAYERSERIES_COMPAT_%s = "%s"' %
+                              (collection, layer_dir, ' '.join(sorted(corenames)), collection, ' '.join(compat)))
+    return errors
 
-    reset_var(var, val, op='?=')
+###
+### Machine catalog
+###
+def get_soc_families(machine_conf_file):
+    ''' Return the SoC families set by a machine configuration file,
+    from SOC_FAMILY or, failing that, from what it prepends to
+    MACHINEOVERRIDES '''
+    soc_family = []
+    machineoverrides = []
+    try:
+        for var, op, val in iter_assignments(machine_conf_file):
+            if var == 'SOC_FAMILY':
+                soc_family.append(''.join(val))
+            elif var == 'MACHINEOVERRIDES' and op == '=.':
+                machineoverrides.append(''.join(val))
+    except (IOError, OSError, UnicodeDecodeError):
+        return []
+    values = soc_family or machineoverrides
+    families = []
+    for value in values:
+        families += [ f for f in value.split(':') if f and '$' not in f and f not in families ]
+    return families
+
+def get_machine_catalog():
+    ''' Return a dict mapping every machine found in the layers to the
+    list of layers providing it (see find_machine()).  It is computed
+    once per process and persisted in the layer index, so only machine
+    configuration files which changed are parsed again. '''
+    global _MACHINES
+    if _MACHINES is not None:
+        return _MACHINES
+
+    layers = find_layers()
+    with phase('machine catalog'):
+        index = load_layer_index()
+        old_machines = index.get('machines', {})
+
+        def layer_machines(item):
+            layer, layer_props = item
+            machines_dir = os.path.join(layer_props['path'], 'conf', 'machine')
+            entry = {'stat': None, 'confs': {}}
+            try:
+                entry['stat'] = _stat_key(machines_dir)
+            except OSError:
+                return machines_dir, entry
+            old_entry = old_machines.get(machines_dir, {})
+            if entry['stat'] is not None and old_entry.get('stat') == entry['stat']:
+                conf_files = list(old_entry['confs'].keys())
+            else:
+                try:
+                    conf_files = [ f for f in os.listdir(machines_dir)
+                                   if f.endswith('.conf') and not f.startswith('.') ]
+                except OSError:
+                    conf_files = []
+            for conf_file in sorted(conf_files):
+                conf_path = os.path.join(machines_dir, conf_file)
+                try:
+                    key = _stat_key(conf_path)
+                except OSError:
+                    continue
+                conf_entry = old_entry.get('confs', {}).get(conf_file)
+                if key is None or not conf_entry or conf_entry['stat'] != key:
+                    conf_entry = { 'stat': key,
+                                   'soc_families': get_soc_families(conf_path) }
+                entry['confs'][conf_file] = conf_entry
+            return machines_dir, entry
+
+        catalog = {}
+        new_machines = {}
+        sorted_layers = sorted(layers.items())
+        for (layer, layer_props), (machines_dir, entry) in zip(sorted_layers,
+                                                               parallel_map(layer_machines, sorted_layers)):
+            new_machines[machines_dir] = entry
+            for conf_file, conf_entry in entry['confs'].items():
+                machine = os.path.splitext(conf_file)[0]
+                catalog.setdefault(machine, []).append({ 'layer': layer,
+                                                         'priority': layer_props['priority'],
+                                                         'conf': os.path.join(machines_dir, conf_file),
+                                                         'soc_families': conf_entry['soc_families'] })
+        for providers in catalog.values():
+            providers.sort(key=lambda p: p['priority'], reverse=True)
+
+        if new_machines != old_machines:
+            index['machines'] = new_machines
+            save_layer_index(index)
+
+    _MACHINES = catalog
+    return _MACHINES
+
+def check_machine(machine, build_dir):
+    ''' Warn if no layer (nor the build directory) provides machine,
+    suggesting close matches.  The machine may come from somewhere the
+    catalog doesn't know about, so BitBake has the final word. '''
+    catalog = get_machine_catalog()
+    if not catalog or machine in catalog:
+        return
+    if os.path.exists(os.path.join(PLATFORM_ROOT_DIR, build_dir, 'conf', 'machine', machine + '.conf')):
+        return
+    sys.stderr.write("WARNING: MACHINE '%s' is not provided by any layer.\n" % machine)
+    candidates = difflib.get_close_matches(machine, catalog.keys())
+    if candidates:
+        sys.stderr.write('Did you mean: %s?\n' % ', '.join(candidates))
+
+###
+### Build environment
+###
+BUILD_ENV_CACHE_VERSION = 1
+
+## Environment variables which affect the environment set up by
+## oe-init-build-env
+BUILD_ENV_INPUTS = [ 'PATH',
+                     'BBPATH',
+                     'BBSERVER',
+                     'BB_ENV_PASSTHROUGH_ADDITIONS',
+                     'BB_ENV_EXTRAWHITE',
+                     'TEMPLATECONF',
+                     'PYTHONPATH',
+                     'HOME',
+                     'SHELL' ]
+
+## Scripts (relative to OEROOT) run by oe-init-build-env
+BUILD_ENV_SCRIPTS = [ 'oe-init-build-env',
+                      'scripts/oe-buildenv-internal',
+                      'scripts/oe-setup-builddir' ]
+
+def git_head(repo_dir):
+    ''' Return the commit checked out in repo_dir, or None.  Reads the
+    git metadata directly, to avoid running git. '''
+    git_dir = os.path.join(repo_dir, '.git')
+    try:
+        if os.path.isfile(git_dir):
+            ## Submodules and worktrees: .git is a file pointing to the
+            ## actual git directory
+            with open(git_dir) as git_fd:
+                git_dir = os.path.join(repo_dir, git_fd.readline().partition('gitdir:')[2].strip())
+        with open(os.path.join(git_dir, 'HEAD')) as head_fd:
+            head = head_fd.readline().strip()
+        if not head.startswith('ref:'):
+            return head
+        ref = head[len('ref:'):].strip()
+        common_dir = git_dir
+        if os.path.exists(os.path.join(git_dir, 'commondir')):
+            with open(os.path.join(git_dir, 'commondir')) as common_dir_fd:
+                common_dir = os.path.join(git_dir, common_dir_fd.readline().strip())
+        for refs_dir in [git_dir, common_dir]:
+            ref_file = os.path.join(refs_dir, ref)
+            if os.path.exists(ref_file):
+                with open(ref_file) as ref_fd:
+                    return ref_fd.readline().strip()
+        with open(os.path.join(common_dir, 'packed-refs')) as packed_refs_fd:
+            for line in packed_refs_fd:
+                sha, _, name = line.strip().partition(' ')
+                if name == ref:
+                    return sha
+    except (IOError, OSError):
+        pass
+    return None
+
+def build_env_cache_key(build_dir_path, bitbake_dir_path, env=None):
+    if env is None:
+        env = os.environ
+    key = [BUILD_ENV_CACHE_VERSION,
+           OEROOT,
+           build_dir_path,
+           bitbake_dir_path,
+           git_head(OEROOT),
+           git_head(bitbake_dir_path)]
+    for script in BUILD_ENV_SCRIPTS:
+        try:
+            st = os.stat(os.path.join(OEROOT, script))
+            key.append([script, st.st_mtime_ns, st.st_size])
+        except OSError:
+            key.append([script, None])
+    for var in BUILD_ENV_INPUTS:
+        key.append([var, env.get(var)])
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
 
 def run_oe_init_build_env(build_dir, bitbake_dir):
     build_dir_path = os.path.join(PLATFORM_ROOT_DIR, build_dir)
     bitbake_dir_path = os.path.join(PLATFORM_ROOT_DIR, bitbake_dir)
 
-    command = ['bash',
-               '-c',
-               'source %s/oe-init-build-env %s %s > /dev/null && env' % (OEROOT, build_dir_path, bitbake_dir_path)]
-    proc = subprocess.Popen(command, stdout = subprocess.PIPE)
-    # Update the current environment
-    for line in proc.stdout.readlines():
-        # Skip empty lines
-        line = line.strip().decode()
-        if line == '':
-            continue
+    ## For build directories which have already been set up, the
+    ## environment changes made by oe-init-build-env are cached in
+    ## the build directory, so sourcing it can be skipped
+    cache_file = os.path.join(build_dir_path, 'conf', '.build-env-cache.json')
+    cacheable = (os.path.exists(os.path.join(build_dir_path, 'conf', 'local.conf')) and
+                 os.path.exists(os.path.join(build_dir_path, 'conf', 'bblayers.conf')))
+    cache_key = build_env_cache_key(build_dir_path, bitbake_dir_path)
+    cache = None
+    if cacheable:
+        cache = read_cache_file(cache_file)
+    if isinstance(cache, dict) and cache.get('key') == cache_key:
+        debug('Using cached oe-init-build-env environment from %s' % cache_file)
+        os.environ.update(cache['env'])
+    else:
+        command = ['bash',
+                   '-c',
+                   'source %s/oe-init-build-env %s %s > /dev/null && env' % (OEROOT, build_dir_path, bitbake_dir_path)]
+        proc = subprocess.Popen(command, stdout = subprocess.PIPE)
+        # Update the current environment
+        env_changes = {}
+        for line in proc.stdout.readlines():
+            # Skip empty lines
+            line = line.strip().decode()
+            if line == '':
+                continue
 
-        (var, _, val) = line.partition("=")
-        os.environ[var] = val
+            (var, _, val) = line.partition("=")
+            if os.environ.get(var) != val:
+                env_changes[var] = val
+            os.environ[var] = val
 
+        if proc.wait() == 0:
+            write_cache_file(cache_file, {'key': cache_key, 'env': env_changes})
+
+    link_site_conf(build_dir)
+
+def link_site_conf(build_dir):
     # Enable site.conf use
     for p in ['.oe', '.yocto']:
         source_site_conf = os.path.join(os.getenv('HOME'), p, 'site.conf')
@@ -580,96 +2214,1190 @@ def run_oe_init_build_env(build_dir, bitbake_dir):
             os.symlink(source_site_conf, dest_site_conf)
             break
 
-def report_environment(env_file):
-    meaningful_variables = os.environ.get('BB_ENV_PASSTHROUGH_ADDITIONS', '').split()
+def template_conf(name):
+    ''' Return the contents oe-init-build-env would give to conf/<name>
+    in a new build directory (from <name>.sample in TEMPLATECONF), or
+    None if no template could be found. '''
+    templateconf = os.environ.get('TEMPLATECONF')
+    if not templateconf:
+        try:
+            with open(os.path.join(OEROOT, '.templateconf')) as templateconf_fd:
+                for line in templateconf_fd:
+                    m = re.match(r'\s*TEMPLATECONF=\$\{TEMPLATECONF:-(.+)\}\s*$', line)
+                    if m:
+                        templateconf = m.group(1)
+        except (IOError, OSError):
+            pass
+    candidates = [ os.path.join(OEROOT, 'meta', 'conf', 'templates', 'default'),
+                   os.path.join(OEROOT, 'meta', 'conf') ]
+    if templateconf:
+        candidates.insert(0, os.path.join(OEROOT, templateconf))
+    for template_dir in candidates:
+        sample = os.path.join(template_dir, name + '.sample')
+        if os.path.exists(sample):
+            with open(sample) as sample_fd:
+                content = sample_fd.read()
+            return content.replace('##OEROOT##', OEROOT).replace('##COREBASE##', OEROOT)
+    return None
+
+def plan_oe_init_build_env(build_dir, bitbake_dir):
+    ''' Plan mode counterpart of run_oe_init_build_env: update the
+    environment without running anything.  The environment cached by a
+    previous run is used when still valid; otherwise the main changes
+    made by oe-init-build-env are approximated. '''
+    build_dir_path = os.path.join(PLATFORM_ROOT_DIR, build_dir)
+    bitbake_dir_path = os.path.join(PLATFORM_ROOT_DIR, bitbake_dir)
+    cache = read_cache_file(os.path.join(build_dir_path, 'conf', '.build-env-cache.json'))
+    if isinstance(cache, dict) and cache.get('key') == build_env_cache_key(build_dir_path, bitbake_dir_path):
+        os.environ.update(cache['env'])
+        return
+    sys.stderr.write('WARNING: no cached oe-init-build-env environment for %s.  '
+                     'The reported environment is an approximation.\n' % build_dir)
+    os.environ['BUILDDIR'] = build_dir_path
+    os.environ['PATH'] = ':'.join([ os.path.join(OEROOT, 'scripts'),
+                                    os.path.join(bitbake_dir_path, 'bin'),
+                                    os.environ.get('PATH', '') ])
+
+## Variables which can be passed through to the user's shell
+PASSTHROUGH_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'variable-passthrough.inc')
+
+def passthrough_variables():
+    ''' Return the list of variables in PASSTHROUGH_FILE, or None if it
+    can't be read '''
+    try:
+        with open(PASSTHROUGH_FILE) as passthrough_fd:
+            return passthrough_fd.read().split()
+    except (IOError, OSError):
+        return None
+
+def environment_report(env=None):
+    ''' Return the (variable, value) tuples of env (the current
+    environment by default) to be passed through to the user's shell:
+    those in both BB_ENV_PASSTHROUGH_ADDITIONS and PASSTHROUGH_FILE '''
+    if env is None:
+        env = os.environ
+    meaningful_variables = set(os.environ.get('BB_ENV_PASSTHROUGH_ADDITIONS', '').split())
+    passthrough = passthrough_variables()
+    if passthrough is not None:
+        meaningful_variables.intersection_update(passthrough)
+    return [ (var, val) for var, val in env.items() if var in meaningful_variables ]
+
+def report_environment(env_file, report=None):
+    ''' Write to env_file a script exporting the variables to pass
+    through to the user's shell (report, or environment_report() by
+    default), to be sourced by it '''
+    if report is None:
+        report = environment_report()
     env_fd = open(env_file, 'w')
-    for var,val in os.environ.items():
-        if var not in meaningful_variables:
+    for var, val in report:
+        env_fd.write('export %s=%s\n' % (var, shlex_quote(val)))
+    env_fd.close()
+
+def report_plan(old_env):
+    ''' Print, as unified diffs, the changes setting up the build
+    directory would make to the configuration files and to the
+    environment (old_env being the environment before setup) '''
+    local_conf_content = LOCAL_CONF.render()
+    to_accept, to_prompt = eulas.plan(LOCAL_CONF)
+    if to_accept and not LOCAL_CONF.read_only:
+        local_conf_content += ''.join([ eulas.accept[f] + '\n' for f in to_accept ])
+    for conf, new_content in [ (LOCAL_CONF, local_conf_content),
+                               (BBLAYERS_CONF, BBLAYERS_CONF.render()) ]:
+        if conf.read_only:
             continue
+        try:
+            with open(conf.conf_file) as conf_fd:
+                old_content = conf_fd.read()
+            from_file = conf.conf_file
+        except (IOError, OSError):
+            old_content = ''
+            from_file = '/dev/null'
+        sys.stdout.writelines(difflib.unified_diff(old_content.splitlines(True),
+                                                   new_content.splitlines(True),
+                                                   from_file,
+                                                   conf.conf_file))
+    sys.stdout.writelines(difflib.unified_diff(sorted([ '%s=%s\n' % item for item in environment_report(old_env) ]),
+                                               sorted([ '%s=%s\n' % item for item in environment_report() ]),
+                                               'environment',
+                                               'environment'))
+    for eula_file in to_prompt:
+        print('EULA %s would require acceptance' % eula_file)
 
-        env_fd.write('%s=%s\n' % (var, val))
-    env_fd.close()
+###
+### Host tuning
+###
+## Set SETUP_ENVIRONMENT_NO_HOST_TUNING to leave parallelism settings
+## to BitBake's defaults
+SETUP_ENVIRONMENT_NO_HOST_TUNING = 'SETUP_ENVIRONMENT_NO_HOST_TUNING' in os.environ
+
+## Memory (in bytes) each parallel job is assumed to need: linking big
+## C++ programs easily takes a couple of GiB
+HOST_TUNING_MEMORY_PER_JOB = 2 * 1024 * 1024 * 1024
+
+## Pressure thresholds (stall microseconds per second, see
+## BB_PRESSURE_MAX_* in the Yocto Project reference manual), used when
+## the kernel provides pressure stall information
+HOST_TUNING_PRESSURE = { 'BB_PRESSURE_MAX_CPU': 15000,
+                         'BB_PRESSURE_MAX_IO': 15000,
+                         'BB_PRESSURE_MAX_MEMORY': 2000 }
+
+## Variables weakly set in local.conf from the host tuning defaults
+HOST_TUNING_VARIABLES = [ 'BB_NUMBER_THREADS',
+                          'PARALLEL_MAKE',
+                          'BB_PRESSURE_MAX_CPU',
+                          'BB_PRESSURE_MAX_IO',
+                          'BB_PRESSURE_MAX_MEMORY',
+                          'XZ_THREADS',
+                          'ZSTD_THREADS' ]
+
+def read_first_line(path):
+    try:
+        with open(path) as fd:
+            return fd.readline().strip()
+    except (IOError, OSError):
+        return None
+
+def cgroup_cpu_limit(cgroup_dir):
+    ''' Return the CPU limit (rounded up) set in cgroup_dir (v2 or v1),
+    or None '''
+    try:
+        cpu_max = (read_first_line(os.path.join(cgroup_dir, 'cpu.max')) or 'max').split()
+        if cpu_max[0] != 'max':
+            return max(1, -(-int(cpu_max[0]) // int(cpu_max[1])))
+        quota = int(read_first_line(os.path.join(cgroup_dir, 'cpu.cfs_quota_us')) or -1)
+        if quota > 0:
+            period = int(read_first_line(os.path.join(cgroup_dir, 'cpu.cfs_period_us')) or 100000)
+            return max(1, -(-quota // period))
+    except (ValueError, IndexError, ZeroDivisionError):
+        pass
+    return None
+
+def cgroup_memory_limit(cgroup_dir):
+    ''' Return the memory limit (in bytes) set in cgroup_dir (v2 or v1),
+    or None '''
+    try:
+        memory_max = read_first_line(os.path.join(cgroup_dir, 'memory.max')) or 'max'
+        if memory_max != 'max':
+            return int(memory_max)
+        ## cgroup v1 reports no limit as a huge number
+        limit = int(read_first_line(os.path.join(cgroup_dir, 'memory.limit_in_bytes')) or -1)
+        if 0 < limit < 2 ** 62:
+            return limit
+    except ValueError:
+        pass
+    return None
+
+def cgroup_limits(proc_cgroup='/proc/self/cgroup', cgroup_root='/sys/fs/cgroup'):
+    ''' Return a (cpus, memory) tuple with the tightest CPU and memory
+    (in bytes) limits of the cgroups of this process and their
+    ancestors.  Each is None when unlimited. '''
+    limits = { 'cpu': None, 'memory': None }
+    try:
+        with open(proc_cgroup) as cgroup_fd:
+            cgroups = [ line.strip().split(':', 2) for line in cgroup_fd if line.count(':') >= 2 ]
+    except (IOError, OSError):
+        return None, None
+    for _, controllers, path in cgroups:
+        ## The unified hierarchy (v2) has no controllers listed; v1
+        ## hierarchies are mounted in directories named after theirs
+        if controllers == '':
+            kinds = [ 'cpu', 'memory' ]
+            base = cgroup_root
+        else:
+            kinds = [ kind for kind in controllers.split(',') if kind in limits ]
+            base = os.path.join(cgroup_root, controllers)
+        if not kinds:
+            continue
+        path = path.strip('/')
+        while True:
+            cgroup_dir = os.path.join(base, path)
+            for kind in kinds:
+                if kind == 'cpu':
+                    limit = cgroup_cpu_limit(cgroup_dir)
+                else:
+                    limit = cgroup_memory_limit(cgroup_dir)
+                if limit is not None and (limits[kind] is None or limit < limits[kind]):
+                    limits[kind] = limit
+            if not path:
+                break
+            path = os.path.dirname(path)
+    return limits['cpu'], limits['memory']
+
+def available_memory(meminfo='/proc/meminfo'):
+    ''' Return the available memory (in bytes) according to meminfo, or
+    None if it can't be read '''
+    try:
+        with open(meminfo) as meminfo_fd:
+            for line in meminfo_fd:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+def host_resources():
+    ''' Return a (cpus, memory) tuple: the number of CPUs this process
+    can use and the memory (in bytes) available to it, taking cgroup
+    limits into account.  memory is None if unknown. '''
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+    memory = available_memory()
+    cgroup_cpus, cgroup_memory = cgroup_limits()
+    if cgroup_cpus:
+        cpus = min(cpus, cgroup_cpus)
+    if cgroup_memory:
+        memory = min(memory or cgroup_memory, cgroup_memory)
+    return cpus, memory
+
+def host_tuning(cpus, memory, pressure=True):
+    ''' Return a dict with the defaults of HOST_TUNING_VARIABLES for a
+    host with cpus CPUs and memory bytes available (None if unknown).
+    Up to BB_NUMBER_THREADS tasks each run up to PARALLEL_MAKE jobs, so
+    their product is limited so that each job gets
+    HOST_TUNING_MEMORY_PER_JOB, both being close to its square root.
+    With pressure, BitBake is also told to hold off starting tasks when
+    the host is under pressure. '''
+    threads = make_jobs = cpus
+    if memory:
+        memory_jobs = max(1, memory // HOST_TUNING_MEMORY_PER_JOB)
+        if threads * make_jobs > memory_jobs:
+            threads = max(1, min(cpus, int(memory_jobs ** 0.5)))
+            make_jobs = max(1, min(cpus, memory_jobs // threads))
+    tuning = { 'BB_NUMBER_THREADS': str(threads),
+               'PARALLEL_MAKE': '-j %d' % make_jobs,
+               'XZ_THREADS': str(make_jobs),
+               'ZSTD_THREADS': str(make_jobs) }
+    if pressure:
+        for var, threshold in HOST_TUNING_PRESSURE.items():
+            tuning[var] = str(threshold)
+    return tuning
 
 ###
-### Parse command line and do stuff
+### Shared caches
 ###
-if __name__ == '__main__':
-    if os.getuid() == 0:
-        print("ERROR: do not use the BSP as root. Exiting...")
-        sys.exit(1)
+## With SETUP_ENVIRONMENT_SHARED_CACHE set, build directories share an
+## sstate cache and a hash equivalence server, in the directory it
+## names (relative to the platform root directory).  Additional sstate
+## mirrors (directories or HTTP URLs) can be given in
+## SETUP_ENVIRONMENT_SSTATE_MIRRORS.
+SETUP_ENVIRONMENT_SHARED_CACHE = os.environ.get('SETUP_ENVIRONMENT_SHARED_CACHE')
+SETUP_ENVIRONMENT_SSTATE_MIRRORS = os.environ.get('SETUP_ENVIRONMENT_SSTATE_MIRRORS', '').split()
+
+## Variables weakly set in local.conf from the shared cache defaults
+SHARED_CACHE_VARIABLES = [ 'SSTATE_DIR',
+                           'SSTATE_MIRRORS',
+                           'BB_SIGNATURE_HANDLER',
+                           'BB_HASHSERVE' ]
+
+## Time (in seconds) to wait for bitbake-hashserv to start listening
+HASHSERV_START_TIMEOUT = 5
+
+def shared_cache_dir():
+    return os.path.join(PLATFORM_ROOT_DIR, SETUP_ENVIRONMENT_SHARED_CACHE or 'shared-cache')
+
+def hashserv_socket_path(cache_dir):
+    ''' Return the path to the socket of the hash equivalence server for
+    cache_dir.  It is not in cache_dir, as Unix socket paths are
+    limited to about a hundred characters. '''
+    cache_hash = hashlib.sha1(cache_dir.encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, 'hashserv-%s.sock' % cache_hash)
+
+def hashserv_running(socket_path):
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        return True
+    except (IOError, OSError):
+        return False
+    finally:
+        sock.close()
+
+def start_hashserv(cache_dir, bitbake_dir):
+    ''' Start bitbake-hashserv for cache_dir, unless it is already
+    running.  Its database and log are kept in cache_dir.  Return the
+    BB_HASHSERVE value to use it, or None if it could not be
+    started. '''
+    socket_path = hashserv_socket_path(cache_dir)
+    if hashserv_running(socket_path):
+        return 'unix://' + socket_path
+    hashserv = os.path.join(PLATFORM_ROOT_DIR, bitbake_dir, 'bin', 'bitbake-hashserv')
+    if not os.path.exists(hashserv):
+        sys.stderr.write('WARNING: %s not found, not starting a shared hash equivalence server.\n' % hashserv)
+        return None
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    print('INFO: Starting the hash equivalence server for %s' % cache_dir)
+    with open(os.path.join(cache_dir, 'hashserv.log'), 'a') as log_fd:
+        ## The server outlives this process, in its own session
+        subprocess.Popen([hashserv,
+                          '--bind', 'unix://' + socket_path,
+                          '--database', os.path.join(cache_dir, 'hashserv.db')],
+                         stdin=subprocess.DEVNULL,
+                         stdout=log_fd,
+                         stderr=subprocess.STDOUT,
+                         cwd=cache_dir,
+                         start_new_session=True)
+    deadline = time.time() + HASHSERV_START_TIMEOUT
+    while time.time() < deadline:
+        if hashserv_running(socket_path):
+            return 'unix://' + socket_path
+        time.sleep(0.1)
+    sys.stderr.write('WARNING: the hash equivalence server did not start (see %s).\n' %
+                     os.path.join(cache_dir, 'hashserv.log'))
+    return None
+
+def planned_hashserv(cache_dir, bitbake_dir):
+    ''' Return the BB_HASHSERVE value start_hashserv() would return,
+    without starting the server: assume it starts if it can be found '''
+    socket_path = hashserv_socket_path(cache_dir)
+    if (hashserv_running(socket_path) or
+        os.path.exists(os.path.join(PLATFORM_ROOT_DIR, bitbake_dir, 'bin', 'bitbake-hashserv'))):
+        return 'unix://' + socket_path
+    return None
+
+def sstate_mirrors(mirrors):
+    ''' Return the SSTATE_MIRRORS value for mirrors (directories or
+    HTTP URLs).  Directories which do not exist and other URLs are left
+    out, with a warning. '''
+    entries = []
+    for mirror in mirrors:
+        if re.match(r'https?://', mirror):
+            entries.append('file://.* %s/PATH;downloadfilename=PATH' % mirror.rstrip('/'))
+        elif os.path.isdir(mirror):
+            entries.append('file://.* file://%s/PATH' % os.path.abspath(mirror))
+        else:
+            sys.stderr.write('WARNING: ignoring sstate mirror %s: not a directory nor an HTTP URL.\n' % mirror)
+    return ' '.join(entries)
+
+def shared_cache_defaults(bitbake_dir, start=True):
+    ''' Return a dict with the defaults of SHARED_CACHE_VARIABLES.
+    Exit with an error if the sstate cache directory can't be used.
+    The hash equivalence server is started if needed, only with start
+    (otherwise, BB_HASHSERVE is the value starting it would give, see
+    planned_hashserv()).  If it can't be started, BitBake starts its own
+    one for the build directory. '''
+    cache_dir = shared_cache_dir()
+    sstate_dir = os.environ.get('SSTATE_DIR', os.path.join(cache_dir, 'sstate-cache'))
+    for directory in [ cache_dir, sstate_dir ]:
+        try:
+            if not DRY_RUN:
+                os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            sys.stderr.write('ERROR: could not create %s: %s.\n' % (directory, e.strerror))
+            sys.exit(1)
+        if os.path.exists(directory) and not os.access(directory, os.W_OK | os.X_OK):
+            sys.stderr.write('ERROR: %s is not writable.\n' % directory)
+            sys.exit(1)
+    if start:
+        hashserve = start_hashserv(cache_dir, bitbake_dir)
+    else:
+        hashserve = planned_hashserv(cache_dir, bitbake_dir)
+    defaults = { 'SSTATE_DIR': sstate_dir,
+                 'BB_SIGNATURE_HANDLER': 'OEEquivHash',
+                 'BB_HASHSERVE': hashserve or 'auto' }
+    mirrors = sstate_mirrors(SETUP_ENVIRONMENT_SSTATE_MIRRORS)
+    if mirrors:
+        defaults['SSTATE_MIRRORS'] = mirrors
+    return defaults
+
+def sstate_cache_stats(sstate_dir):
+    ''' Return an (objects, size, recipes) tuple for the sstate cache
+    in sstate_dir: the number of sstate objects, their total size (in
+    bytes) and the number of recipes they are for '''
+    objects = 0
+    size = 0
+    recipes = set()
+    for dirpath, _, files in os.walk(sstate_dir):
+        for f in files:
+            if not f.startswith('sstate:') or f.endswith('.siginfo') or f.endswith('.sig'):
+                continue
+            try:
+                size += os.lstat(os.path.join(dirpath, f)).st_size
+            except OSError:
+                continue
+            objects += 1
+            recipes.add(f.split(':')[1])
+    return objects, size, len(recipes)
+
+def report_shared_cache(sstate_dir, hashserve):
+    ''' Print how much the shared sstate cache, the sstate mirrors
+    which are directories and the hash equivalence server can save '''
+    caches = [ ('Shared sstate cache', sstate_dir) ]
+    caches += [ ('sstate mirror', mirror) for mirror in SETUP_ENVIRONMENT_SSTATE_MIRRORS
+                if os.path.isdir(mirror) ]
+    for description, cache in caches:
+        objects, size, recipes = sstate_cache_stats(cache)
+        if objects:
+            print('INFO: %s %s: %d objects (%.1f GiB) for %d recipes' %
+                  (description, cache, objects, size / float(1024 ** 3), recipes))
+        else:
+            print('INFO: %s %s is empty' % (description, cache))
+    if hashserve != 'auto':
+        print('INFO: Hash equivalence server: %s' % hashserve)
 
-    if len(sys.argv) < 3:
-        usage(1)
+###
+### Setup fingerprint
+###
+SETUP_FINGERPRINT_VERSION = 2
+
+## Variables which affect the setup, besides the ones in
+## PASSTHROUGH_FILE and BUILD_ENV_INPUTS
+SETUP_FINGERPRINT_INPUTS = [ 'MACHINE',
+                             'SDKMACHINE',
+                             'DISTRO',
+                             'PACKAGE_CLASSES',
+                             'PLATFORM_ROOT_DIR',
+                             'OEROOT' ]
+
+## Variables passed through to the user's shell which change with each
+## login session, but don't affect the setup: they are left out of the
+## fingerprint, and their current values are reported
+SETUP_FINGERPRINT_SESSION_VARIABLES = [ 'SSH_AGENT_PID',
+                                        'SSH_AUTH_SOCK' ]
+
+def setup_fingerprint_file(build_dir):
+    return os.path.join(PLATFORM_ROOT_DIR, build_dir, 'conf', '.setup-fingerprint.json')
+
+def setup_fingerprint(build_dir, bitbake_dir, env):
+    ''' Return a digest of what setting up build_dir depends on, apart
+    from the sources tree: the configuration files, the environment
+    (env) the setup starts from, this script and the OEROOT and BitBake
+    revisions (see build_env_cache_key()).  Return None if the
+    configuration files do not exist yet. '''
+    build_dir_path = os.path.join(PLATFORM_ROOT_DIR, build_dir)
+    key = [SETUP_FINGERPRINT_VERSION,
+           build_env_cache_key(build_dir_path, os.path.join(PLATFORM_ROOT_DIR, bitbake_dir), env)]
+    for conf in [ 'local.conf', 'bblayers.conf' ]:
+        try:
+            with open(os.path.join(build_dir_path, 'conf', conf), 'rb') as conf_fd:
+                key.append([conf, hashlib.sha256(conf_fd.read()).hexdigest()])
+        except (IOError, OSError):
+            return None
+    for path in [ os.path.abspath(__file__), PASSTHROUGH_FILE ]:
+        try:
+            st = os.stat(path)
+            key.append([path, st.st_mtime_ns, st.st_size])
+        except OSError:
+            key.append([path, None])
+    variables = set(SETUP_FINGERPRINT_INPUTS + (passthrough_variables() or []))
+    variables.update(daemon_settings(env).keys())
+    variables.difference_update(SETUP_FINGERPRINT_SESSION_VARIABLES)
+    for var in sorted(variables):
+        key.append([var, env.get(var)])
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+def recorded_setup(build_dir, fingerprint):
+    ''' Return the environment report (see environment_report())
+    recorded by record_setup() for build_dir, if fingerprint and the
+    sources tree are the same as then.  Return None otherwise. '''
+    if fingerprint is None:
+        return None
+    recorded = read_cache_file(setup_fingerprint_file(build_dir))
+    if (not isinstance(recorded, dict) or
+        recorded.get('key') != fingerprint or
+        stat_signature([ path for path, _ in recorded['sources'] ]) != recorded['sources']):
+        return None
+    return ([ tuple(item) for item in recorded['environment'] ] +
+            [ (var, val) for var, val in environment_report()
+              if var in SETUP_FINGERPRINT_SESSION_VARIABLES ])
+
+def record_setup(build_dir, bitbake_dir, env):
+    ''' Record in build_dir the fingerprint of the setup which has just
+    been made from env, the sources tree it was made from and the
+    resulting environment report, so that it can be replayed while none
+    of them changes '''
+    fingerprint = setup_fingerprint(build_dir, bitbake_dir, env)
+    signature = sources_signature()
+    if fingerprint is None or signature is None:
+        return
+    write_cache_file(setup_fingerprint_file(build_dir),
+                     { 'key': fingerprint,
+                       'sources': signature,
+                       'environment': [ (var, val) for var, val in environment_report()
+                                        if var not in SETUP_FINGERPRINT_SESSION_VARIABLES ] })
 
-    if sys.argv[1] in [ '--help', '-h' ]:
-        usage(0)
+###
+### Setup context
+###
+class SetupContext(object):
+    ''' The state of the setup of a build directory: paths,
+    configuration objects, defaults, hooks and EULAs.
+
+    The API used by hook scripts (set_default(), set_var(),
+    run_after_init(), etc.) works on the active context.  As hook
+    scripts also use PLATFORM_ROOT_DIR, OEROOT, LOCAL_CONF,
+    BBLAYERS_CONF, DEFAULTS, HOOKS, eulas, build_dir and env_file
+    directly, activate() makes them module globals.  What is known about the sources tree
+    (layers, machines, compiled modules) is kept across contexts for
+    the same platform root directory. '''
+
+    def __init__(self, platform_root_dir=None):
+        self.platform_root_dir = platform_root_dir
+        self.build_dir = None
+        self.env_file = None
+        self.oeroot = None
+        self.bitbake_dir = None
+        self.layer_index_file = None
+        self.local_conf = None
+        self.bblayers_conf = None
+        self.eulas = None
+        self.confs_read = False
+        self.defaults = dict(INITIAL_DEFAULTS)
+        self.hooks = { 'set-defaults': [],
+                       'before-init': [],
+                       'after-init': [] }
+
+    def activate(self):
+        ''' Make this context the one the module API works on '''
+        global _CONTEXT, _CACHES_ROOT_DIR
+        global PLATFORM_ROOT_DIR, OEROOT, LAYER_INDEX_FILE, LOCAL_CONF, BBLAYERS_CONF
+        global DEFAULTS, HOOKS, eulas, bitbake_dir, local_conf_file, bblayers_conf_file
+        global build_dir, env_file
+        if self.platform_root_dir != _CACHES_ROOT_DIR:
+            reset_caches()
+            _CACHES_ROOT_DIR = self.platform_root_dir
+        PLATFORM_ROOT_DIR = self.platform_root_dir
+        OEROOT = self.oeroot
+        LAYER_INDEX_FILE = self.layer_index_file
+        LOCAL_CONF = self.local_conf
+        BBLAYERS_CONF = self.bblayers_conf
+        DEFAULTS = self.defaults
+        HOOKS = self.hooks
+        eulas = self.eulas
+        bitbake_dir = self.bitbake_dir
+        build_dir = self.build_dir
+        env_file = self.env_file
+        local_conf_file = self.local_conf and self.local_conf.conf_file
+        bblayers_conf_file = self.bblayers_conf and self.bblayers_conf.conf_file
+        _CONTEXT = self
+        return self
+
+    def set_default(self, var, val):
+        self.defaults[var] = val
+
+    def set_var(self, var, val, op='='):
+        self.local_conf.add(var, op, val)
+
+    def remove_var(self, var):
+        self.local_conf.remove(var)
+
+    def reset_var(self, var, val, op='='):
+        self.local_conf.reset(var, op, val)
+
+    def weak_set_var(self, var):
+        # Use the environment as value or take the default, making it weak
+        # in the local.conf
+        try:
+            val = os.environ[var]
+        except:
+            val = self.defaults[var]
+
+        self.reset_var(var, val, op='?=')
+
+    def append_layers(self, layer_dirs):
+        # Merge all the given layers into BBLAYERS in a single pass.  The
+        # result is the same as appending them one by one: a stable sort
+        # by layer priority (highest first) of the current BBLAYERS
+        # followed by the new layers, with layers before their
+        # dependencies (see order_layers()).
+        layers = []
+        for i, (var, op, val) in enumerate(self.bblayers_conf.get('BBLAYERS')):
+            ## Like _simplify(), consider the first assignment, merged with
+            ## the next ones if they all use '+='
+            if i > 0 and (op != '+=' or layers_op != '+='):
+                break
+            layers_op = op
+            layers += val
+        layers += layer_dirs
+        layers = [l.strip() for l in layers]
+        layers = list(dict.fromkeys(layers))
+        layers = order_layers(layers)
+        self.bblayers_conf.reset('BBLAYERS', '+=', ' '.join(layers))
+
+    def add_hook(self, hook, fn):
+        self.hooks[hook].append(fn)
+
+    def run_hook(self, hook):
+        for fn in self.hooks[hook]:
+            with phase('hook %s' % hook,
+                       function='%s (%s)' % (getattr(fn, '__name__', fn),
+                                             getattr(getattr(fn, '__code__', None), 'co_filename', '?'))):
+                fn()
+
+    def write_confs(self):
+        self.local_conf.write()
+        self.bblayers_conf.write()
+
+    def evaluator(self):
+        ''' Return a ConfEvaluator for the build directory, taking the
+        changes made to its configuration files so far into account '''
+        contents = {}
+        if self.confs_read:
+            for conf in [ self.local_conf, self.bblayers_conf ]:
+                if not conf.read_only:
+                    contents[conf.conf_file] = conf.render()
+        build_dir_path = os.path.dirname(os.path.dirname(self.local_conf.conf_file))
+        return build_dir_evaluator(build_dir_path, contents)
+
+    def setup(self, build_dir, env_file=None, plan=False):
+        ''' Set up build_dir, reporting the resulting environment to
+        env_file.  With plan, only print what would change (see
+        report_plan()). '''
+        old_env = dict(os.environ)
+        self.build_dir = build_dir
+        self.env_file = env_file
+        self.activate()
+        os.environ['PLATFORM_ROOT_DIR'] = self.platform_root_dir
+
+        # Identify the OEROOT to use
+        if os.path.exists(os.path.join(self.platform_root_dir, 'sources/oe-core')):
+            self.oeroot = os.path.join(self.platform_root_dir, 'sources/oe-core')
+        elif os.path.exists(os.path.join(self.platform_root_dir, 'sources/openembedded-core')):
+            self.oeroot = os.path.join(self.platform_root_dir, 'sources/openembedded-core')
+        elif os.path.exists(os.path.join(self.platform_root_dir, 'sources/poky')):
+            self.oeroot = os.path.join(self.platform_root_dir, 'sources/poky')
+        else:
+            sys.stderr.write("ERROR: Neither OE-Core or Poky could be found inside 'sources' directory.\n")
+            sys.exit(1)
 
-    build_dir = sys.argv[1]
-    env_file = sys.argv[2] # file where the environment will be reported to
+        os.environ['OEROOT'] = self.oeroot
 
-    # Check if env_file really exists, just in case.
-    if not os.path.exists(env_file):
-        sys.stderr.write('env file (%s) does not exist.  Aborting.\n' % env_file)
+        # Identify BitBake directory
+        if os.path.exists(os.path.join(self.platform_root_dir, 'sources/bitbake')):
+            self.bitbake_dir = os.path.join(self.platform_root_dir, 'sources/bitbake')
+        else:
+            self.bitbake_dir = os.path.join(self.oeroot, 'bitbake')
+
+        conf_dir = os.path.join(self.platform_root_dir, build_dir, 'conf')
+        self.layer_index_file = os.path.join(conf_dir, '.layer-index.json')
+        update_confs = 'SETUP_ENVIRONMENT_UPDATE_CONFS' in os.environ
+        initial_env = dict(os.environ)
+
+        ## If nothing the setup depends on changed since the build
+        ## directory was last set up, the existing configuration files
+        ## would be left untouched, so just report the environment
+        ## recorded then
+        if not plan and not update_confs:
+            with phase('fingerprint'):
+                self.activate()
+                report = recorded_setup(build_dir, setup_fingerprint(build_dir, self.bitbake_dir, initial_env))
+            if report is not None:
+                debug('%s has not changed since it was set up, reusing its setup' % build_dir)
+                link_site_conf(build_dir)
+                if SETUP_ENVIRONMENT_SHARED_CACHE is not None:
+                    ## The hash equivalence server may have been stopped
+                    start_hashserv(shared_cache_dir(), self.bitbake_dir)
+                if env_file:
+                    report_environment(env_file, report)
+                return
+
+        ## Create the configuration objects here, before loading modules
+        ## and before running run_oe_init_build_env, but don't try to read
+        ## the configuration files yet.  With SETUP_ENVIRONMENT_UPDATE_CONFS
+        ## set, existing configuration files are updated in place instead
+        ## of being left untouched.
+        self.local_conf = Conf(os.path.join(conf_dir, 'local.conf'), update=update_confs)
+        self.bblayers_conf = Conf(os.path.join(conf_dir, 'bblayers.conf'), update=update_confs)
+
+        ## Create the eula object here, so hook scripts can add stuff to
+        ## eulas.accept
+        self.eulas = Eula(self.local_conf.conf_file)
+
+        self.activate()
+
+        ## Load all the hook scripts (only the relevant ones with
+        ## SETUP_ENVIRONMENT_LAZY_MODULES)
+        with phase('load modules'):
+            load_modules(self.local_conf.conf_file, self.bblayers_conf.conf_file)
+
+        ## Tune parallelism to the host.  Hook scripts can override
+        ## the values with set_default()
+        if not SETUP_ENVIRONMENT_NO_HOST_TUNING:
+            with phase('host tuning'):
+                cpus, memory = host_resources()
+                self.defaults.update(host_tuning(cpus, memory, os.path.exists('/proc/pressure/cpu')))
+
+        ## Share the sstate cache and hash equivalence data between
+        ## build directories.  Hook scripts can override the values with
+        ## set_default() too.
+        if SETUP_ENVIRONMENT_SHARED_CACHE is not None:
+            with phase('shared cache'):
+                self.defaults.update(shared_cache_defaults(self.bitbake_dir, start=not plan))
+
+        self.run_hook('set-defaults')
+
+        ## Check MACHINE now, to point out typos before bitbake fails on
+        ## them later.
+        ## When it is not set in the environment, an existing local.conf
+        ## determines MACHINE, so there's nothing to check.
+        if 'MACHINE' in os.environ or not self.local_conf.read_only:
+            check_machine(os.environ.get('MACHINE', self.defaults['MACHINE']), build_dir)
+
+        self.run_hook('before-init')
+        ## Configuration files oe-init-build-env is about to create from
+        ## the templates
+        created_confs = [ conf.conf_file for conf in [ self.local_conf, self.bblayers_conf ]
+                          if not os.path.exists(conf.conf_file) ]
+        with phase('oe-init-build-env'):
+            if plan:
+                plan_oe_init_build_env(build_dir, self.bitbake_dir)
+            else:
+                run_oe_init_build_env(build_dir, self.bitbake_dir)
+
+        ## Now that run_oe_init_build_env has been run, we can actually
+        ## read the configuration files.  In plan mode, configuration files
+        ## which do not exist yet are read from the templates
+        ## oe-init-build-env would copy.
+        with phase('read confs'):
+            for conf in [ self.local_conf, self.bblayers_conf ]:
+                if plan and not os.path.exists(conf.conf_file):
+                    conf.read_conf(template_conf(os.path.basename(conf.conf_file)) or '')
+                else:
+                    conf.read_conf()
+        self.confs_read = True
+
+        ## Set some basic variables here, so that they can be overwritten by
+        ## after-init scripts
+        self.reset_var('PLATFORM_ROOT_DIR', self.platform_root_dir)
+
+        self.weak_set_var('MACHINE')
+        self.weak_set_var('SDKMACHINE')
+        self.weak_set_var('DISTRO')
+        self.weak_set_var('PACKAGE_CLASSES')
+        for var in HOST_TUNING_VARIABLES + SHARED_CACHE_VARIABLES:
+            if var in os.environ or var in self.defaults:
+                self.weak_set_var(var)
+
+        self.run_hook('after-init')
+
+        ## Report missing layer dependencies and incompatible layers
+        ## now, rather than after bitbake parsed everything
+        if not self.bblayers_conf.read_only:
+            ## BBLAYERS entries usually refer to other variables (e.g.,
+            ## ${BSPDIR}/sources/...), so expand them like BitBake.  As
+            ## dependencies on layers which can't be resolved can't be
+            ## checked, give up on checking them in that case.
+            bblayers_conf_file = self.bblayers_conf.conf_file
+            evaluator = bblayers_evaluator(os.path.dirname(os.path.dirname(bblayers_conf_file)),
+                                           { bblayers_conf_file: self.bblayers_conf.render() })
+            layer_dirs = (evaluator.get('BBLAYERS') or '').split()
+            errors = []
+            if [ layer for layer in layer_dirs if '$' in layer ]:
+                debug('Not checking layers: could not expand BBLAYERS (%s)' % ' '.join(layer_dirs))
+            else:
+                errors = check_layers(layer_dirs)
+            for error in errors:
+                sys.stderr.write('ERROR: %s\n' % error)
+            if errors:
+                ## Don't leave the configuration files created from the
+                ## templates behind: next time, they would be considered
+                ## as set up already and hook scripts would not add
+                ## their layers to them
+                if not plan:
+                    for conf_file in created_confs:
+                        if os.path.exists(conf_file):
+                            os.unlink(conf_file)
+                sys.exit(1)
 
-    os.environ['PLATFORM_ROOT_DIR'] = PLATFORM_ROOT_DIR
+        if plan:
+            report_plan(old_env)
+            ## Walking the caches takes a while when they are big: only
+            ## report what they hold when asked for a plan
+            if SETUP_ENVIRONMENT_SHARED_CACHE is not None:
+                report_shared_cache(self.defaults['SSTATE_DIR'], self.defaults['BB_HASHSERVE'])
+            return
 
-    # Identify the OEROOT to use
-    if os.path.exists(os.path.join(PLATFORM_ROOT_DIR, 'sources/oe-core')):
-        OEROOT = os.path.join(PLATFORM_ROOT_DIR, 'sources/oe-core')
-    elif os.path.exists(os.path.join(PLATFORM_ROOT_DIR, 'sources/openembedded-core')):
-        OEROOT = os.path.join(PLATFORM_ROOT_DIR, 'sources/openembedded-core')
-    elif os.path.exists(os.path.join(PLATFORM_ROOT_DIR, 'sources/poky')):
-        OEROOT = os.path.join(PLATFORM_ROOT_DIR, 'sources/poky')
-    else:
-        sys.stderr.write("ERROR: Neither OE-Core or Poky could be found inside 'sources' directory.\n")
-        sys.exit(1)
+        with phase('write confs'):
+            self.write_confs()
+
+        with phase('eulas'):
+            unaccepted_eulas = self.eulas.handle()
+
+        if env_file:
+            with phase('report environment'):
+                report_environment(env_file)
+
+        ## EULAs which were not accepted have to be prompted for again
+        ## next time
+        if not unaccepted_eulas:
+            with phase('record setup'):
+                record_setup(build_dir, self.bitbake_dir, initial_env)
+
+## The platform root directory the in-memory caches about the sources
+## tree are for
+_CACHES_ROOT_DIR = None
 
-    os.environ['OEROOT'] = OEROOT
+## The active context.  Importing this module does not look at the
+## filesystem: the initial context has no platform root directory.
+_CONTEXT = SetupContext().activate()
 
-    # Identify BitBake directory
-    if os.path.exists(os.path.join(PLATFORM_ROOT_DIR, 'sources/bitbake')):
-        bitbake_dir = os.path.join(PLATFORM_ROOT_DIR, 'sources/bitbake')
+###
+### Daemon
+###
+## Time (in seconds) after which an idle daemon exits
+SETUP_ENVIRONMENT_DAEMON_TIMEOUT = float(os.environ.get('SETUP_ENVIRONMENT_DAEMON_TIMEOUT', 3600))
+
+## Set in the processes handling daemon requests
+_IN_DAEMON = False
+
+def daemon_socket_path(platform_root_dir):
+    ''' Return the path to the socket of the daemon for platform_root_dir '''
+    root_hash = hashlib.sha1(platform_root_dir.encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, 'daemon-%s.sock' % root_hash)
+
+def daemon_settings(env):
+    ''' Return the variables of env which the module reads when it is
+    imported.  The daemon only serves requests with the same settings
+    as its own. '''
+    return dict([ (var, val) for var, val in env.items()
+                  if ((var.startswith('SETUP_ENVIRONMENT_') and
+                       not var.startswith('SETUP_ENVIRONMENT_DAEMON')) or
+                      var in [ 'DEBUG_SETUP_ENVIRONMENT', 'HOME', 'XDG_CACHE_HOME' ]) ])
+
+def sources_signature():
+    ''' Return the stat information of everything the in-memory caches
+    about the sources tree were computed from (directories, layer.conf
+    files, machine configuration files and hook scripts), or None if
+    some of it was modified too recently to be trusted. '''
+    index = _LAYER_INDEX or {}
+    paths = list(index.get('dirs', {}).keys())
+    for layer_props in (_LAYERS or {}).values():
+        paths.append(os.path.join(layer_props['path'], 'conf', 'layer.conf'))
+    for machines_dir, entry in index.get('machines', {}).items():
+        paths.append(machines_dir)
+        paths += [ os.path.join(machines_dir, conf) for conf in entry['confs'] ]
+    for module, _ in _COMPILED_MODULES or []:
+        paths += [ module, os.path.join(os.path.dirname(module), 'priority') ]
+    return stat_signature(paths)
+
+def stat_signature(paths):
+    ''' Return a list of [path, stat key] lists for paths (see
+    _stat_key()), or None if some of them were modified too recently
+    to be trusted '''
+    signature = []
+    for path in sorted(set(paths)):
+        try:
+            key = _stat_key(path)
+        except OSError:
+            key = 'missing'
+        if key is None:
+            return None
+        signature.append([path, key])
+    return signature
+
+def warm_caches():
+    ''' Discover layers, machines and hook scripts, and return the
+    sources_signature() of what has been found '''
+    compile_modules()
+    get_machine_catalog()
+    if SETUP_ENVIRONMENT_LAZY_MODULES:
+        module_declarations()
+    return sources_signature()
+
+def daemon_request(argv):
+    ''' Have the daemon for the current directory, if any, handle argv.
+    The daemon uses this process' standard input and outputs.  Return
+    the exit status, or None if the request could not be handed to a
+    daemon. '''
+    path = daemon_socket_path(os.getcwd())
+    if not os.path.exists(path):
+        return None
+    ## Only needed to talk to a daemon: not imported when none is
+    ## running, to keep starting up cheap
+    import array
+    import socket
+    request = json.dumps({ 'argv': argv,
+                           'cwd': os.getcwd(),
+                           'env': dict(os.environ) }).encode() + b'\n'
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sent = sock.sendmsg([request], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [0, 1, 2]))])
+        sock.sendall(request[sent:])
+        reply = sock.makefile('rb').readline()
+        sock.close()
+    except (IOError, OSError) as e:
+        debug('Could not use the daemon (%s): %s' % (path, e))
+        return None
+    if not reply:
+        sys.stderr.write('ERROR: the setup-environment daemon (%s) failed to handle the request.\n' % path)
+        return 1
+    reply = json.loads(reply.decode())
+    if 'fallback' in reply:
+        debug('Not using the daemon: %s' % reply['fallback'])
+        return None
+    return reply['status']
+
+def handle_daemon_request(conn):
+    ''' Handle a request from daemon_request(), in a process forked by
+    the daemon.  Never returns. '''
+    global _IN_DAEMON
+    import array
+    import signal
+    import socket
+    import traceback
+    _IN_DAEMON = True
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    del TRACE_EVENTS[:]
+    fds = array.array('i')
+    data, ancdata, _, _ = conn.recvmsg(65536, socket.CMSG_LEN(3 * fds.itemsize))
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    while data and not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    if not data.endswith(b'\n'):
+        ## Not a complete request (e.g., serve() checking whether the
+        ## daemon is running)
+        os._exit(0)
+    request = json.loads(data.decode())
+
+    if len(fds) != 3:
+        reply = { 'fallback': 'standard input and outputs not received' }
+    elif request['cwd'] != PLATFORM_ROOT_DIR:
+        reply = { 'fallback': 'the daemon is for %s' % PLATFORM_ROOT_DIR }
+    elif daemon_settings(request['env']) != daemon_settings(os.environ):
+        reply = { 'fallback': 'the daemon settings are different' }
     else:
-        bitbake_dir = os.path.join(OEROOT, 'bitbake')
+        reply = None
+    if reply:
+        conn.sendall(json.dumps(reply).encode() + b'\n')
+        os._exit(0)
+
+    for fd, std_fd in zip(fds, [0, 1, 2]):
+        os.dup2(fd, std_fd)
+        os.close(fd)
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    try:
+        main(request['argv'])
+        status = 0
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    if SETUP_ENVIRONMENT_TRACE:
+        write_trace(SETUP_ENVIRONMENT_TRACE)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    conn.sendall(json.dumps({ 'status': status }).encode() + b'\n')
+    os._exit(status)
+
+def serve(platform_root_dir):
+    ''' Serve setup requests for platform_root_dir on a Unix socket,
+    until SETUP_ENVIRONMENT_DAEMON_TIMEOUT seconds without requests.
+    Layers, machines and hook scripts are kept in memory, and each
+    request is handled by a forked process.  Before each request, they
+    are discovered again if anything they were found from changed. '''
+    import signal
+    import socket
+    import traceback
+    SetupContext(platform_root_dir).activate()
+    path = daemon_socket_path(platform_root_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            sys.stderr.write('ERROR: a setup-environment daemon is already running for %s.\n' % platform_root_dir)
+            sys.exit(1)
+        except (IOError, OSError):
+            os.unlink(path)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+    server.settimeout(SETUP_ENVIRONMENT_DAEMON_TIMEOUT)
+    ## Handler processes are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    script = os.path.abspath(__file__)
+    script_stat = _stat_key(script)
+    signature = warm_caches()
+    print('INFO: setup-environment daemon listening on %s' % path)
+    sys.stdout.flush()
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break
+            conn.settimeout(None)
+            if script_stat is None or _stat_key(script) != script_stat:
+                ## This script changed: let the client run the new
+                ## one, and exit
+                conn.sendall(json.dumps({ 'fallback': '%s changed' % script }).encode() + b'\n')
+                conn.close()
+                break
+            new_signature = sources_signature()
+            if new_signature is None or new_signature != signature:
+                debug('Sources changed, discovering layers and hook scripts again')
+                reset_caches()
+                signature = warm_caches()
+            if os.fork() == 0:
+                ## Handler processes must never get back here
+                try:
+                    server.close()
+                    handle_daemon_request(conn)
+                except BaseException:
+                    traceback.print_exc()
+                finally:
+                    os._exit(1)
+            conn.close()
+    finally:
+        server.close()
+        os.unlink(path)
 
-    local_conf_file = os.path.join(PLATFORM_ROOT_DIR, build_dir, 'conf', 'local.conf')
-    bblayers_conf_file = os.path.join(PLATFORM_ROOT_DIR, build_dir, 'conf', 'bblayers.conf')
+###
+### Parse command line and do stuff
+###
+def parse_target(target):
+    ''' Split a --batch target (<build dir>[:<machine>]) into a
+    (build dir, machine) tuple.  machine is None when not given. '''
+    build_dir, _, machine = target.partition(':')
+    return build_dir, machine or None
+
+def setup_target(target):
+    ''' Set up a --batch target.  Targets are isolated from each other:
+    each one gets its own SetupContext, where hooks are loaded again,
+    and the environment is restored afterwards.  Return the exit
+    status. '''
+    build_dir, machine = parse_target(target)
+    env = dict(os.environ)
+    if machine:
+        os.environ['MACHINE'] = machine
+    try:
+        with phase('setup build dir', build_dir=build_dir):
+            SetupContext(PLATFORM_ROOT_DIR).setup(build_dir)
+        status = 0
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception:
+        ## e.g., a failing hook script: other targets are still set up
+        import traceback
+        sys.stderr.write('ERROR: setting up %s failed:\n' % build_dir)
+        traceback.print_exc()
+        status = 1
+    finally:
+        os.environ.clear()
+        os.environ.update(env)
+    return status
+
+def setup_build_dirs(targets, jobs=1):
+    ''' Set up the build directories of targets (see parse_target()).
+    Sources and modules are discovered and compiled only once.  With
+    jobs > 1, targets are set up in that many worker processes, which
+    cannot prompt for EULAs.  Return the list of failed targets. '''
+    global SETUP_ENVIRONMENT_NONINTERACTIVE
+    compile_modules()
+    get_machine_catalog()
+    if SETUP_ENVIRONMENT_LAZY_MODULES:
+        module_declarations()
+    if jobs > 1:
+        SETUP_ENVIRONMENT_NONINTERACTIVE = True
+        ## Workers are forked, so they inherit everything discovered so
+        ## far
+        import concurrent.futures
+        import multiprocessing
+        with concurrent.futures.ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context('fork')) as executor:
+            statuses = list(executor.map(setup_target, targets))
+    else:
+        statuses = [ setup_target(target) for target in targets ]
+    failed = [ target for target, status in zip(targets, statuses) if status ]
+    for target in failed:
+        sys.stderr.write('ERROR: could not set up %s.\n' % target)
+    return failed
 
-    ## Create the configuration objects here, before loading modules
-    ## and before running run_oe_init_build_env, but don't try to read
-    ## the configuration files yet.
-    LOCAL_CONF = Conf(local_conf_file)
-    BBLAYERS_CONF = Conf(bblayers_conf_file)
+def main(argv):
+    global DRY_RUN
 
-    ## Create the eula object here, so hook scripts can add stuff to
-    ## eulas.accept
-    eulas = Eula(local_conf_file)
+    context = SetupContext(os.getcwd()).activate()
 
-    ## Load all the hook scripts
-    load_modules()
+    if os.getuid() == 0:
+        print("ERROR: do not use the BSP as root. Exiting...")
+        sys.exit(1)
 
-    run_hook('set-defaults')
+    args = argv[1:]
 
-    run_hook('before-init')
-    run_oe_init_build_env(build_dir, bitbake_dir)
+    if args and args[0] in [ '--help', '-h' ]:
+        usage(0)
 
-    ## Now that run_oe_init_build_env has been run, we can actually
-    ## read the configuration files
-    LOCAL_CONF.read_conf()
-    BBLAYERS_CONF.read_conf()
+    if args and args[0] == '--daemon':
+        serve(PLATFORM_ROOT_DIR)
+        return
+
+    ## Let the daemon for this platform, if one is running, handle
+    ## the request
+    if not _IN_DAEMON and 'SETUP_ENVIRONMENT_NO_DAEMON' not in os.environ:
+        status = daemon_request(argv)
+        if status is not None:
+            sys.exit(status)
+
+    ## Batch mode: set up several build directories, each one
+    ## optionally with its own MACHINE
+    if args and args[0] == '--batch':
+        args = args[1:]
+        jobs = 1
+        if args and args[0] == '--jobs':
+            try:
+                jobs = int(args[1])
+            except (IndexError, ValueError):
+                usage(1)
+            args = args[2:]
+        if not args:
+            usage(1)
+        start_tracing()
+        if setup_build_dirs(args, jobs):
+            sys.exit(1)
+        return
+
+    ## Print the values BitBake would give to variables in a build
+    ## directory, without parsing recipes
+    if args and args[0] == '--eval':
+        if len(args) < 3:
+            usage(1)
+        report_effective_values(args[1], args[2:])
+        return
+
+    ## Plan mode: compute the configuration and environment and print
+    ## how they differ from the current ones, without running
+    ## oe-init-build-env nor writing anything
+    plan = bool(args) and args[0] == '--plan'
+    if plan:
+        args = args[1:]
+        DRY_RUN = True
+
+    if len(args) < (1 if plan else 2):
+        usage(1)
 
-    ## Set some basic variables here, so that they can be overwritten by
-    ## after-init scripts
-    reset_var('PLATFORM_ROOT_DIR', PLATFORM_ROOT_DIR)
+    build_dir = args[0]
+    env_file = None
+    if not plan:
+        env_file = args[1] # file where the environment will be reported to
 
-    weak_set_var('MACHINE')
-    weak_set_var('SDKMACHINE')
-    weak_set_var('DISTRO')
-    weak_set_var('PACKAGE_CLASSES')
+    start_tracing()
 
-    run_hook('after-init')
-    write_confs()
+    # Check if env_file really exists, just in case.
+    if env_file and not os.path.exists(env_file):
+        sys.stderr.write('env file (%s) does not exist.  Aborting.\n' % env_file)
 
-    eulas.handle()
+    context.setup(build_dir, env_file, plan)
 
-    report_environment(env_file)
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,7 +1,17 @@
 from setup_environment_internal import *
+import setup_environment_internal
 
+import contextlib
+import hashlib
+import json
 import os
 import pprint
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
 
 pp = pprint.pprint
 
@@ -18,6 +28,31 @@ def get_var(v, conf):
             return val
     return None
 
+def backdate(root, age=3600):
+    ''' Pretend everything in root was modified age seconds ago: files
+    modified in the last seconds are not trusted by the layer index,
+    the setup fingerprint and the daemon '''
+    when = time.time() - age
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            os.utime(os.path.join(dirpath, name), (when, when))
+    os.utime(root, (when, when))
+
+@contextlib.contextmanager
+def modified_environ(env={}, unset=[]):
+    ''' Add env to the environment and remove the variables in unset
+    from it, restoring it afterwards (also from changes made in the
+    meantime) '''
+    saved_environ = dict(os.environ)
+    for var in unset:
+        os.environ.pop(var, None)
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_environ)
+
 
 ##
 ## Read-only test
@@ -41,6 +76,22 @@ assert conf1.conf_data == [('BB_NUMBER_THREADS', '=', ['8']),
                            ('BBFILES', '+=', ['${@bb.utils.contains("VAR",', '"",', '"",', '"",', 'd)}'])]
 
 
+##
+## Assignment expressions
+##
+assert parse_assignment_expr('FOO:append = " x"') == ('FOO:append', '=', [' x'])
+assert parse_assignment_expr('FOO:remove:mx6 = "y"') == ('FOO:remove:mx6', '=', ['y'])
+assert parse_assignment_expr('FOO ??= "z"') == ('FOO', '??=', ['z'])
+assert parse_assignment_expr('FOO:="z"') == ('FOO', ':=', ['z'])
+assert parse_assignment_expr('FOO .= "a"') == ('FOO', '.=', ['a'])
+assert parse_assignment_expr('FOO =. "a"') == ('FOO', '=.', ['a'])
+assert parse_assignment_expr('FOO ?= "a = b"') == ('FOO', '?=', ['a', '=', 'b'])
+assert parse_assignment_expr('export FOO = "1"') == ('FOO', '=', ['1'])
+assert parse_assignment_expr('FOO[doc] = "A foo"') == ('FOO[doc]', '=', ['A', 'foo'])
+assert parse_assignment_expr('inherit foo') == None
+assert parse_assignment_expr('FOO =') == None
+
+
 ## Since test-data/conf1 exists, conf1 is created as read-only
 conf1.add('FOO', '=', 'a foo')
 assert get_var('FOO', conf1) == None
@@ -66,6 +117,26 @@ assert get_var('APPEND_append', conf2) == [' foo', 'bar']
 conf2.add('PREPEND_prepend', '=', ' xxx yyy  ')
 assert get_var('PREPEND_prepend', conf2) == [' xxx', 'yyy  ']
 
+conf2.add('MORE', '=', 'foo')
+conf2.add('MORE', '+=', 'bar')
+assert conf2.get('MORE') == [('MORE', '=', ['foo']), ('MORE', '+=', ['bar'])]
+conf2.remove('MORE')
+assert conf2.get('MORE') == []
+assert 'MORE' not in conf2
+
+## Hook scripts may still change conf_data in place
+conf2.conf_data.append(('DIRECT', '=', ['x']))
+assert conf2.get('DIRECT') == [('DIRECT', '=', ['x'])]
+conf2_data = conf2.conf_data
+del conf2_data[-1]
+assert 'DIRECT' not in conf2
+
+conf2.add('RESET', '=', 'a')
+conf2.add('RESET', '+=', 'b')
+conf2.reset('RESET', '?=', 'c')
+assert conf2.get('RESET') == [('RESET', '?=', ['c'])]
+conf2.remove('RESET')
+
 conf2.write()
 
 assert os.path.exists('test-data/conf2')
@@ -79,4 +150,883 @@ assert conf2_check.conf_data == [('FOO', '=', ['a', 'foo']),
                                  ('APPEND_append', '=', [' foo', 'bar']),
                                  ('PREPEND_prepend', '=', [' xxx', 'yyy  '])]
 
+
+###
+### In place update test
+###
+conf_dir = tempfile.mkdtemp()
+conf3_file = os.path.join(conf_dir, 'conf3')
+conf3_content = ('# A comment\n'
+                 'require conf/foo.inc\n'
+                 'MACHINE ??= "qemuarm"\n'
+                 'MULTILINE = "foo \\\n'
+                 '             bar"\n'
+                 '\n'
+                 'DISTRO ?= "poky"\n'
+                 'REMOVED = "1"\n')
+with open(conf3_file, 'w') as f:
+    f.write(conf3_content)
+os.utime(conf3_file, (0, 0))
+
+conf3 = Conf(conf3_file, quiet=True, update=True)
+conf3.read_conf()
+conf3.reset('MULTILINE', '=', 'foo bar')
+conf3.write()
+## Nothing changed, so the file must not have been written
+assert os.stat(conf3_file).st_mtime == 0
+
+conf3.reset('MACHINE', '?=', 'wandboard')
+conf3.remove('REMOVED')
+conf3.add('NEW', '=', 'new')
+conf3.write()
+with open(conf3_file) as f:
+    assert f.read() == ('# A comment\n'
+                        'require conf/foo.inc\n'
+                        "MACHINE ?= 'wandboard'\n"
+                        'MULTILINE = "foo \\\n'
+                        '             bar"\n'
+                        '\n'
+                        'DISTRO ?= "poky"\n'
+                        "NEW = 'new'\n")
+
+## Assignments already in the file are updated where they are rather
+## than added again
+conf3 = Conf(conf3_file, quiet=True, update=True)
+conf3.read_conf()
+conf3.add('NEW', '=', 'newer')
+conf3.add('OTHER', '+=', 'other')
+conf3.reset('MACHINE', '=', 'imx6qsabresd')
+conf3.write()
+with open(conf3_file) as f:
+    assert f.read() == ('# A comment\n'
+                        'require conf/foo.inc\n'
+                        "MACHINE = 'imx6qsabresd'\n"
+                        'MULTILINE = "foo \\\n'
+                        '             bar"\n'
+                        '\n'
+                        'DISTRO ?= "poky"\n'
+                        "NEW = 'newer'\n"
+                        "OTHER += 'other'\n")
+shutil.rmtree(conf_dir)
+
+
+###
+### Layer discovery
+###
+platform_dir = tempfile.mkdtemp()
+for layer_dir, priority in [('poky/meta', 5),
+                            ('meta-foo', 7),
+                            ('meta-openembedded/meta-oe', 6),
+                            ('other/meta-foo', 2), # duplicate: ignored
+                            ('too/deep/meta-bar', 9)]:
+    os.makedirs(os.path.join(platform_dir, 'sources', layer_dir, 'conf'))
+    with open(os.path.join(platform_dir, 'sources', layer_dir, 'conf', 'layer.conf'), 'w') as f:
+        f.write('BBFILE_PRIORITY_layer = "%d"\n' % priority)
+os.makedirs(os.path.join(platform_dir, 'sources', 'meta-foo', 'conf', 'machine'))
+with open(os.path.join(platform_dir, 'sources', 'meta-foo', 'conf', 'machine', 'foo-board.conf'), 'w') as f:
+    f.write('MACHINEOVERRIDES =. "mx6:mx6q:"\n')
+
+for mod_dir in ['meta-foo/setup-environment.d',
+                'meta-foo/.git/setup-environment.d',
+                'too/deep/meta-bar/setup-environment.d']:
+    os.makedirs(os.path.join(platform_dir, 'sources', mod_dir))
+    open(os.path.join(platform_dir, 'sources', mod_dir, 'hook.py'), 'w').close()
+
+backdate(platform_dir)
+
+parsed_layer_confs = []
+parse_layer_conf_orig = setup_environment_internal.parse_layer_conf
+def parse_layer_conf_counting(layer_dir):
+    parsed_layer_confs.append(layer_dir)
+    return parse_layer_conf_orig(layer_dir)
+setup_environment_internal.parse_layer_conf = parse_layer_conf_counting
+
+context = SetupContext(platform_dir)
+context.layer_index_file = os.path.join(platform_dir, 'build', 'conf', '.layer-index.json')
+context.activate()
+expected_layers = {
+    'meta': {'priority': 5, 'path': os.path.join(platform_dir, 'sources', 'poky', 'meta')},
+    'meta-foo': {'priority': 7, 'path': os.path.join(platform_dir, 'sources', 'meta-foo')},
+    'meta-oe': {'priority': 6, 'path': os.path.join(platform_dir, 'sources', 'meta-openembedded', 'meta-oe')}}
+assert find_layers() == expected_layers
+assert os.path.exists(context.layer_index_file)
+assert scan_sources()[1] == [os.path.join(platform_dir, 'sources', 'meta-foo', 'setup-environment.d', 'hook.py')]
+assert (sorted(system_find(os.path.join(platform_dir, 'sources'), maxdepth=4, path='*/conf/layer.conf')) ==
+        sorted([os.path.join(l['path'], 'conf', 'layer.conf') for l in expected_layers.values()] +
+               [os.path.join(platform_dir, 'sources', 'other', 'meta-foo', 'conf', 'layer.conf')]))
+
+## A fresh process reuses the persisted index, without parsing any
+## layer.conf again
+assert parsed_layer_confs
+del parsed_layer_confs[:]
+reset_caches()
+assert find_layers() == expected_layers
+assert parsed_layer_confs == []
+setup_environment_internal.parse_layer_conf = parse_layer_conf_orig
+
+## Machine catalog
+assert get_machines_by_layer('meta-foo') == ['foo-board']
+assert get_machines_by_layer('meta') == []
+assert find_machine('foo-board') == [{'layer': 'meta-foo',
+                                      'priority': 7,
+                                      'conf': os.path.join(platform_dir, 'sources', 'meta-foo',
+                                                           'conf', 'machine', 'foo-board.conf'),
+                                      'soc_families': ['mx6', 'mx6q']}]
+assert find_machine('bar-board') == []
+assert get_machines_by_soc_family('mx6q') == ['foo-board']
+
+## Layers are merged into BBLAYERS sorted by priority, keeping the
+## current order for layers with the same priority
+meta_dir = expected_layers['meta']['path']
+meta_foo_dir = expected_layers['meta-foo']['path']
+meta_oe_dir = expected_layers['meta-oe']['path']
+context.bblayers_conf = Conf(os.path.join(platform_dir, 'bblayers.conf'), quiet=True)
+context.bblayers_conf.add('BBLAYERS', '?=', meta_dir + ' ')
+append_layers([meta_oe_dir, meta_foo_dir, meta_dir])
+append_layer(meta_oe_dir)
+assert context.bblayers_conf.conf_data == [
+    ('BBLAYERS', '+=', [meta_foo_dir, meta_oe_dir, meta_dir])]
+
+shutil.rmtree(platform_dir)
+
+
+###
+### Hook modules bytecode cache
+###
+cache_dir = tempfile.mkdtemp()
+setup_environment_internal.CACHE_DIR = cache_dir
+module = os.path.join(cache_dir, 'hook.py')
+with open(module, 'w') as f:
+    f.write('HOOK_VALUE = 1\n')
+code = compile_module(module)
+assert os.path.exists(module_cache_file(module))
+assert compile_module(module).co_filename == module
+with open(module, 'w') as f:
+    f.write('HOOK_VALUE = 22\n')
+hook_globals = {}
+exec(compile_module(module), hook_globals)
+assert hook_globals['HOOK_VALUE'] == 22
+shutil.rmtree(cache_dir)
+
+
+###
+### Tracing
+###
+with phase('test phase', detail='foo'):
+    pass
+assert TRACE_EVENTS[-1]['name'] == 'test phase'
+assert TRACE_EVENTS[-1]['ph'] == 'X'
+assert TRACE_EVENTS[-1]['args'] == {'detail': 'foo'}
+
+
+###
+### Build environment cache key
+###
+repo_dir = tempfile.mkdtemp()
+os.makedirs(os.path.join(repo_dir, '.git'))
+with open(os.path.join(repo_dir, '.git', 'HEAD'), 'w') as f:
+    f.write('ref: refs/heads/master\n')
+with open(os.path.join(repo_dir, '.git', 'packed-refs'), 'w') as f:
+    f.write('# pack-refs with: peeled fully-peeled sorted\n')
+    f.write('0123456789abcdef0123456789abcdef01234567 refs/heads/master\n')
+assert git_head(repo_dir) == '0123456789abcdef0123456789abcdef01234567'
+os.makedirs(os.path.join(repo_dir, '.git', 'refs', 'heads'))
+with open(os.path.join(repo_dir, '.git', 'refs', 'heads', 'master'), 'w') as f:
+    f.write('89abcdef0123456789abcdef0123456789abcdef\n')
+assert git_head(repo_dir) == '89abcdef0123456789abcdef0123456789abcdef'
+assert git_head(os.path.join(repo_dir, 'nonexistent')) == None
+shutil.rmtree(repo_dir)
+
+###
+### EULAs
+###
+eula_root = tempfile.mkdtemp()
+os.makedirs(os.path.join(eula_root, 'sources', 'meta-foo'))
+for name in ['EULA-a', 'EULA-b', 'EULA-c']:
+    with open(os.path.join(eula_root, 'sources', 'meta-foo', name), 'w') as f:
+        f.write('text of %s\n' % name)
+eula_local_conf = os.path.join(eula_root, 'local.conf')
+with open(eula_local_conf, 'w') as f:
+    f.write('ACCEPT_A = "1"')
+
+saved_ledger = setup_environment_internal.SETUP_ENVIRONMENT_EULA_LEDGER
+SetupContext(eula_root).activate()
+setup_environment_internal.SETUP_ENVIRONMENT_EULA_LEDGER = os.path.join(eula_root, 'ledger.json')
+with open(setup_environment_internal.SETUP_ENVIRONMENT_EULA_LEDGER, 'w') as f:
+    json.dump({'meta-foo/EULA-b': {'sha256': hashlib.sha256(b'text of EULA-b\n').hexdigest(),
+                                   'acceptance': 'ACCEPT_B = "1"'},
+               'meta-foo/EULA-c': {'sha256': 'outdated',
+                                   'acceptance': 'ACCEPT_C = "1"'}}, f)
+
+e = Eula(eula_local_conf)
+e.accept['meta-foo/EULA-a'] = 'ACCEPT_A = "1"'
+e.accept['meta-foo/EULA-b'] = 'ACCEPT_B = "1"'
+e.accept['meta-foo/EULA-c'] = 'ACCEPT_C = "1"'
+assert e.plan() == (['meta-foo/EULA-b'], ['meta-foo/EULA-c'])
+
+os.environ['ACCEPTED_EULAS'] = 'meta-foo/EULA-c'
+e.handle()
+del os.environ['ACCEPTED_EULAS']
+assert open(eula_local_conf).read() == 'ACCEPT_A = "1"\nACCEPT_B = "1"\nACCEPT_C = "1"\n'
+assert e.plan() == ([], [])
+
+## A missing EULA file aborts the setup
+e.accept['meta-foo/EULA-missing'] = 'ACCEPT_MISSING = "1"'
+try:
+    e.handle()
+    assert False
+except SystemExit as exit:
+    assert exit.code == 1
+
+setup_environment_internal.SETUP_ENVIRONMENT_EULA_LEDGER = saved_ledger
+shutil.rmtree(eula_root)
+
+###
+### Plan mode
+###
+plan_conf = Conf('/nonexistent/local.conf')
+plan_conf.read_conf('# comment\nMACHINE ??= "qemux86-64"\nFOO = "a \\\n b"\n')
+assert plan_conf.get('MACHINE') == [('MACHINE', '??=', ['qemux86-64'])]
+assert plan_conf.get('FOO') == [('FOO', '=', ['a', 'b'])]
+
+template_root = tempfile.mkdtemp()
+os.makedirs(os.path.join(template_root, 'meta-poky', 'conf', 'templates', 'default'))
+with open(os.path.join(template_root, '.templateconf'), 'w') as f:
+    f.write('# Template settings\nTEMPLATECONF=${TEMPLATECONF:-meta-poky/conf/templates/default}\n')
+with open(os.path.join(template_root, 'meta-poky', 'conf', 'templates', 'default', 'bblayers.conf.sample'), 'w') as f:
+    f.write('BBLAYERS ?= "##OEROOT##/meta"\n')
+context = SetupContext(template_root)
+context.oeroot = template_root
+context.activate()
+assert template_conf('bblayers.conf') == 'BBLAYERS ?= "%s/meta"\n' % template_root
+assert template_conf('local.conf') == None
+shutil.rmtree(template_root)
+
+###
+### Batch mode
+###
+assert parse_target('build-foo') == ('build-foo', None)
+assert parse_target('build-foo:foo-board') == ('build-foo', 'foo-board')
+
+###
+### Setup contexts
+###
+context = SetupContext('/platform').activate()
+run_set_defaults(lambda: set_default('MACHINE', 'foo-board'))
+run_hook('set-defaults')
+assert context.defaults['MACHINE'] == 'foo-board'
+assert setup_environment_internal.DEFAULTS is context.defaults
+assert setup_environment_internal.PLATFORM_ROOT_DIR == '/platform'
+other_context = SetupContext('/platform').activate()
+assert other_context.hooks['set-defaults'] == []
+assert setup_environment_internal.DEFAULTS['MACHINE'] == 'qemuarm'
+context.activate()
+assert setup_environment_internal.DEFAULTS['MACHINE'] == 'foo-board'
+
+###
+### Daemon
+###
+assert (daemon_settings({'HOME': '/home/foo', 'PATH': '/bin', 'MACHINE': 'foo-board',
+                         'SETUP_ENVIRONMENT_REFRESH': '1', 'SETUP_ENVIRONMENT_DAEMON_TIMEOUT': '10'}) ==
+        {'HOME': '/home/foo', 'SETUP_ENVIRONMENT_REFRESH': '1'})
+assert daemon_socket_path('/platform') != daemon_socket_path('/other-platform')
+assert daemon_socket_path('/platform').startswith(setup_environment_internal.CACHE_DIR)
+
+###
+### Environment report
+###
+with modified_environ({'BB_ENV_PASSTHROUGH_ADDITIONS': 'MACHINE DISTRO NOT_PASSED_THROUGH',
+                       'MACHINE': 'foo-board',
+                       'DISTRO': "it's \"$quoted\" `cmd`\nand \\ more  ",
+                       'NOT_PASSED_THROUGH': 'foo'}):
+    assert sorted(environment_report()) == [('DISTRO', os.environ['DISTRO']), ('MACHINE', 'foo-board')]
+    env_file = tempfile.mktemp()
+    report_environment(env_file)
+    output = subprocess.check_output(['sh', '-c', '. %s; printf "%%s|%%s" "$MACHINE" "$DISTRO"' % env_file],
+                                     env={'PATH': os.environ['PATH']}).decode()
+    assert output == 'foo-board|' + os.environ['DISTRO']
+    os.remove(env_file)
+
+###
+### Layer graph
+###
+graph_dir = tempfile.mkdtemp()
+for layer, conf in [('core', 'BBFILE_COLLECTIONS += "core"\n'
+                             'BBFILE_PRIORITY_core = "5"\n'
+                             'LAYERSERIES_CORENAMES = "scarthgap"\n'
+                             'LAYERSERIES_COMPAT_core = "scarthgap"\n'),
+                    ('qt6', 'BBFILE_COLLECTIONS += "qt6-layer"\n'
+                            'BBFILE_PRIORITY_qt6-layer = "${@int(d.getVar(\'BBFILE_PRIORITY_core\')) + 1}"\n'
+                            'LAYERDEPENDS_qt6-layer = "core (>= 12)"\n'
+                            'LAYERSERIES_COMPAT_qt6-layer = "kirkstone scarthgap"\n'),
+                    ('app', 'BBFILE_COLLECTIONS += "app"\n'
+                            'BBFILE_PRIORITY_app = "${BBFILE_PRIORITY_core}"\n'
+                            'LAYERDEPENDS_app = "qt6-layer openembedded-layer"\n'
+                            'LAYERRECOMMENDS_app = "browser"\n'
+                            'LAYERSERIES_COMPAT_app = "kirkstone"\n'),
+                    ('oe', 'BBFILE_COLLECTIONS:append = " openembedded-layer"\n'
+                           'BBFILE_PRIORITY_openembedded-layer = "6"\n'
+                           'LAYERDEPENDS_openembedded-layer = "core"\n'
+                           'LAYERDEPENDS_openembedded-layer:append = " meta-python"\n')]:
+    os.makedirs(os.path.join(graph_dir, layer, 'conf'))
+    with open(os.path.join(graph_dir, layer, 'conf', 'layer.conf'), 'w') as f:
+        f.write(conf)
+core_dir, qt6_dir, app_dir = [ os.path.join(graph_dir, l) for l in ['core', 'qt6', 'app'] ]
+
+reset_caches()
+assert parse_layer_conf(app_dir) == {'collections': ['app'],
+                                     'corenames': [],
+                                     'priority': {'app': '${BBFILE_PRIORITY_core}'},
+                                     'depends': {'app': 'qt6-layer openembedded-layer'},
+                                     'recommends': {'app': 'browser'},
+                                     'series_compat': {'app': 'kirkstone'}}
+## Overrides style appends, as current layers use them
+oe_dir = os.path.join(graph_dir, 'oe')
+assert parse_layer_conf(oe_dir)['collections'] == ['openembedded-layer']
+assert parse_layer_conf(oe_dir)['depends'] == {'openembedded-layer': 'core meta-python'}
+assert parse_layer_list('core (>= 12) ${EXTRA} openembedded-layer') == ['core', 'openembedded-layer']
+assert resolve_priority('a', {'a': '${@int(d.getVar("BBFILE_PRIORITY_b")) * 2 - 1}', 'b': '${BBFILE_PRIORITY_c}', 'c': '3'}) == 5
+assert resolve_priority('a', {'a': '${BBFILE_PRIORITY_b}', 'b': '${BBFILE_PRIORITY_a}'}) == None
+assert resolve_priority('a', {'a': '${@__import__("os").getpid()}'}) == None
+
+## Priorities based on other layers can only be resolved once those
+## layers are known
+for layer_dir in [core_dir, qt6_dir, app_dir]:
+    get_layer_info(layer_dir)
+assert [ get_layer_priority(l) for l in [core_dir, qt6_dir, app_dir] ] == [5, 6, 5]
+
+## Layers come before their dependencies, otherwise by priority
+assert order_layers([core_dir, app_dir, qt6_dir]) == [app_dir, qt6_dir, core_dir]
+assert order_layers([core_dir, qt6_dir]) == [qt6_dir, core_dir]
+
+assert check_layers([core_dir, qt6_dir]) == []
+assert check_layers([qt6_dir, app_dir]) == [
+    'layer qt6-layer (%s) depends on core, which is not in BBLAYERS' % qt6_dir,
+    'layer app (%s) depends on openembedded-layer, which is not in BBLAYERS' % app_dir]
+assert check_layers([core_dir, qt6_dir, app_dir]) == [
+    'layer app (%s) depends on openembedded-layer, which is not in BBLAYERS' % app_dir,
+    'layer app (%s) is not compatible with the release series of OE-Core (scarthgap): '
+    'LAYERSERIES_COMPAT_app = "kirkstone"' % app_dir]
+assert check_layers([core_dir, oe_dir]) == [
+    'layer openembedded-layer (%s) depends on meta-python, which is not in BBLAYERS' % oe_dir]
+reset_caches()
+shutil.rmtree(graph_dir)
+
+###
+### Setup fingerprint
+###
+fingerprint_root = tempfile.mkdtemp()
+os.makedirs(os.path.join(fingerprint_root, 'sources', 'meta-foo', 'conf'))
+with open(os.path.join(fingerprint_root, 'sources', 'meta-foo', 'conf', 'layer.conf'), 'w') as f:
+    f.write('BBFILE_PRIORITY_foo = "7"\n')
+os.makedirs(os.path.join(fingerprint_root, 'build', 'conf'))
+context = SetupContext(fingerprint_root)
+context.oeroot = os.path.join(fingerprint_root, 'sources', 'poky')
+context.activate()
+fingerprint_env = { 'MACHINE': 'foo-board', 'HOME': '/home/user' }
+assert setup_fingerprint('build', 'bitbake', fingerprint_env) is None
+for conf in ['local.conf', 'bblayers.conf']:
+    with open(os.path.join(fingerprint_root, 'build', 'conf', conf), 'w') as f:
+        f.write('# %s\n' % conf)
+fingerprint = setup_fingerprint('build', 'bitbake', fingerprint_env)
+assert fingerprint == setup_fingerprint('build', 'bitbake', dict(fingerprint_env))
+assert fingerprint != setup_fingerprint('build', 'bitbake', dict(fingerprint_env, MACHINE='bar-board'))
+## Variables changing with each login session are left out
+assert fingerprint == setup_fingerprint('build', 'bitbake', dict(fingerprint_env, SSH_AUTH_SOCK='/tmp/ssh-1/agent'))
+backdate(os.path.join(fingerprint_root, 'sources'))
+find_layers()
+with modified_environ({'BB_ENV_PASSTHROUGH_ADDITIONS': 'MACHINE SSH_AUTH_SOCK',
+                       'MACHINE': 'foo-board',
+                       'SSH_AUTH_SOCK': '/tmp/ssh-1/agent'}):
+    record_setup('build', 'bitbake', fingerprint_env)
+    del os.environ['MACHINE']
+    os.environ['SSH_AUTH_SOCK'] = '/tmp/ssh-2/agent'
+    assert recorded_setup('build', fingerprint) == [('MACHINE', 'foo-board'), ('SSH_AUTH_SOCK', '/tmp/ssh-2/agent')]
+assert recorded_setup('build', None) is None
+## Changes in the sources tree invalidate the recorded setup
+os.utime(os.path.join(fingerprint_root, 'sources', 'meta-foo', 'conf', 'layer.conf'))
+assert recorded_setup('build', fingerprint) is None
+with open(os.path.join(fingerprint_root, 'build', 'conf', 'local.conf'), 'a') as f:
+    f.write('MACHINE = "bar-board"\n')
+assert setup_fingerprint('build', 'bitbake', fingerprint_env) != fingerprint
+shutil.rmtree(fingerprint_root)
+
+###
+### Lazy hook modules
+###
+lazy_root = tempfile.mkdtemp()
+for layer in ['meta-foo', 'meta-bar']:
+    os.makedirs(os.path.join(lazy_root, 'sources', layer, 'conf', 'machine'))
+    os.makedirs(os.path.join(lazy_root, 'sources', layer, 'setup-environment.d'))
+    with open(os.path.join(lazy_root, 'sources', layer, 'conf', 'layer.conf'), 'w') as f:
+        f.write('BBFILE_PRIORITY_%s = "7"\n' % layer)
+    open(os.path.join(lazy_root, 'sources', layer, 'conf', 'machine', '%s-board.conf' % layer[5:]), 'w').close()
+with open(os.path.join(lazy_root, 'sources', 'meta-foo', 'setup-environment.d', 'foo.py'), 'w') as f:
+    f.write('#! /usr/bin/env python3\n'
+            '# setup-environment-layers: meta-foo meta-foo-extra\n'
+            '#setup-environment-machines: foo-* \n'
+            '\n'
+            'import os\n'
+            '# setup-environment-layers: ignored\n')
+open(os.path.join(lazy_root, 'sources', 'meta-bar', 'setup-environment.d', 'bar.py'), 'w').close()
+os.makedirs(os.path.join(lazy_root, 'build', 'conf'))
+context = SetupContext(lazy_root)
+context.layer_index_file = os.path.join(lazy_root, 'build', 'conf', '.layer-index.json')
+context.activate()
+foo_module = os.path.join(lazy_root, 'sources', 'meta-foo', 'setup-environment.d', 'foo.py')
+bar_module = os.path.join(lazy_root, 'sources', 'meta-bar', 'setup-environment.d', 'bar.py')
+assert module_declarations() == {
+    foo_module: {'layers': ['meta-foo', 'meta-foo-extra'], 'machines': ['foo-*'], 'stat': None},
+    bar_module: {'layers': [], 'machines': [], 'stat': None}}
+
+local_conf_file = os.path.join(lazy_root, 'build', 'conf', 'local.conf')
+bblayers_conf_file = os.path.join(lazy_root, 'build', 'conf', 'bblayers.conf')
+assert conf_machine(local_conf_file) is None
+with open(local_conf_file, 'w') as f:
+    f.write('MACHINE ??= "qemux86-64"\nMACHINE ?= "bar-board"\nMACHINE ?= "foo-board"\n')
+assert conf_machine(local_conf_file) == 'bar-board'
+with open(local_conf_file, 'a') as f:
+    f.write('MACHINE = "${OTHER}"\n')
+assert conf_machine(local_conf_file) is None
+
+with modified_environ(unset=['MACHINE']):
+    assert module_scope(local_conf_file, bblayers_conf_file) == (None, None)
+    with open(bblayers_conf_file, 'w') as f:
+        f.write('BBLAYERS ?= "${TOPDIR}/../sources/poky/meta \\\n  /sources/meta-baz/ \\\n"\n')
+    assert module_scope(local_conf_file, bblayers_conf_file) == (None, set(['meta', 'meta-baz']))
+    os.environ['MACHINE'] = 'bar-board'
+    assert module_scope(local_conf_file, bblayers_conf_file) == ('bar-board', set(['meta', 'meta-baz', 'meta-bar']))
+
+foo_declarations = module_declarations()[foo_module]
+assert module_applies(module_declarations()[bar_module], 'bar-board', set())
+assert module_applies(foo_declarations, 'foo-board', set())
+assert module_applies(foo_declarations, 'bar-board', set(['meta-foo-extra']))
+assert module_applies(foo_declarations, None, set())
+assert not module_applies(foo_declarations, 'bar-board', set(['meta-bar']))
+assert not module_applies({'layers': ['meta-foo'], 'machines': []}, None, set(['meta-bar']))
+assert module_applies({'layers': ['meta-foo'], 'machines': []}, 'bar-board', None)
+shutil.rmtree(lazy_root)
+
+###
+### Host tuning
+###
+cgroup_root = tempfile.mkdtemp()
+def write_cgroup_file(path, content):
+    os.makedirs(os.path.dirname(os.path.join(cgroup_root, path)), exist_ok=True)
+    with open(os.path.join(cgroup_root, path), 'w') as f:
+        f.write(content)
+## cgroup v2: the tightest limit of the cgroup and its ancestors
+write_cgroup_file('proc-v2', '0::/build.slice/job\n')
+write_cgroup_file('v2/build.slice/cpu.max', '400000 100000\n')
+write_cgroup_file('v2/build.slice/memory.max', '%d\n' % (16 * 1024 ** 3))
+write_cgroup_file('v2/build.slice/job/cpu.max', '250000 100000\n')
+write_cgroup_file('v2/build.slice/job/memory.max', 'max\n')
+assert cgroup_limits(os.path.join(cgroup_root, 'proc-v2'), os.path.join(cgroup_root, 'v2')) == (3, 16 * 1024 ** 3)
+## cgroup v1
+write_cgroup_file('proc-v1', '4:memory:/job\n2:cpu,cpuacct:/job\n1:pids:/job\n')
+write_cgroup_file('v1/cpu,cpuacct/job/cpu.cfs_quota_us', '800000\n')
+write_cgroup_file('v1/cpu,cpuacct/job/cpu.cfs_period_us', '100000\n')
+write_cgroup_file('v1/memory/job/memory.limit_in_bytes', '9223372036854771712\n')
+assert cgroup_limits(os.path.join(cgroup_root, 'proc-v1'), os.path.join(cgroup_root, 'v1')) == (8, None)
+assert cgroup_limits(os.path.join(cgroup_root, 'nonexistent')) == (None, None)
+write_cgroup_file('meminfo', 'MemTotal:       32000000 kB\nMemAvailable:   20000000 kB\n')
+assert available_memory(os.path.join(cgroup_root, 'meminfo')) == 20000000 * 1024
+shutil.rmtree(cgroup_root)
+
+def host_tuning_jobs(tuning):
+    ''' Return the maximum number of jobs tuning can run at once '''
+    return int(tuning['BB_NUMBER_THREADS']) * int(tuning['PARALLEL_MAKE'].split()[1])
+
+## Each job, in all the tasks run in parallel, gets its share of memory
+for cpus, memory in [(128, 64 * 1024 ** 3), (128, 512 * 1024 ** 3), (8, 64 * 1024 ** 3), (4, 1024 ** 3)]:
+    tuning = host_tuning(cpus, memory)
+    assert host_tuning_jobs(tuning) <= max(1, memory // setup_environment_internal.HOST_TUNING_MEMORY_PER_JOB)
+    assert int(tuning['BB_NUMBER_THREADS']) <= cpus
+assert host_tuning(128, 512 * 1024 ** 3) == {'BB_NUMBER_THREADS': '16',
+                                            'PARALLEL_MAKE': '-j 16',
+                                            'XZ_THREADS': '16',
+                                            'ZSTD_THREADS': '16',
+                                            'BB_PRESSURE_MAX_CPU': '15000',
+                                            'BB_PRESSURE_MAX_IO': '15000',
+                                            'BB_PRESSURE_MAX_MEMORY': '2000'}
+## Enough memory for BitBake's defaults
+assert host_tuning_jobs(host_tuning(8, 256 * 1024 ** 3)) == 64
+assert host_tuning(8, None, pressure=False) == {'BB_NUMBER_THREADS': '8',
+                                                'PARALLEL_MAKE': '-j 8',
+                                                'XZ_THREADS': '8',
+                                                'ZSTD_THREADS': '8'}
+assert host_tuning_jobs(host_tuning(4, 1024 ** 3, pressure=False)) == 1
+
+###
+### Shared caches
+###
+shared_root = tempfile.mkdtemp()
+SetupContext(shared_root).activate()
+os.makedirs(os.path.join(shared_root, 'mirror', 'ab', 'cd'))
+for f in ['sstate:busybox:x:1:r0:x:11:abc_package.tar.zst',
+          'sstate:busybox:x:1:r0:x:11:abc_package.tar.zst.siginfo',
+          'sstate:zlib:x:1:r0:x:11:def_populate_sysroot.tar.zst']:
+    with open(os.path.join(shared_root, 'mirror', 'ab', 'cd', f), 'w') as fd:
+        fd.write('data')
+assert sstate_cache_stats(os.path.join(shared_root, 'mirror')) == (2, 8, 2)
+assert sstate_mirrors([os.path.join(shared_root, 'mirror'),
+                       'https://sstate.example.com/',
+                       os.path.join(shared_root, 'nonexistent')]) == \
+    ('file://.* file://%s/mirror/PATH ' % shared_root +
+     'file://.* https://sstate.example.com/PATH;downloadfilename=PATH')
+assert hashserv_socket_path('/a') != hashserv_socket_path('/b')
+setup_environment_internal.SETUP_ENVIRONMENT_SHARED_CACHE = 'cache'
+with modified_environ(unset=['SSTATE_DIR']):
+    assert shared_cache_defaults('bitbake', start=False) == {
+        'SSTATE_DIR': os.path.join(shared_root, 'cache', 'sstate-cache'),
+        'BB_SIGNATURE_HANDLER': 'OEEquivHash',
+        'BB_HASHSERVE': 'auto'}
+    assert os.path.isdir(os.path.join(shared_root, 'cache', 'sstate-cache'))
+    os.environ['SSTATE_DIR'] = os.path.join(shared_root, 'sstate')
+    assert shared_cache_defaults('bitbake', start=False)['SSTATE_DIR'] == os.path.join(shared_root, 'sstate')
+    ## Plan mode reports the server a real setup would start
+    os.makedirs(os.path.join(shared_root, 'bitbake', 'bin'))
+    open(os.path.join(shared_root, 'bitbake', 'bin', 'bitbake-hashserv'), 'w').close()
+    assert (shared_cache_defaults('bitbake', start=False)['BB_HASHSERVE'] ==
+            'unix://' + hashserv_socket_path(os.path.join(shared_root, 'cache')))
+setup_environment_internal.SETUP_ENVIRONMENT_SHARED_CACHE = None
+shutil.rmtree(shared_root)
+
+###
+### Effective values
+###
+eval_root = tempfile.mkdtemp()
+def write_eval_file(path, content):
+    os.makedirs(os.path.dirname(os.path.join(eval_root, path)), exist_ok=True)
+    with open(os.path.join(eval_root, path), 'w') as f:
+        f.write(content)
+write_eval_file('build/conf/bblayers.conf',
+                'BBPATH = "${TOPDIR}"\n'
+                'BSPDIR := "${@os.path.abspath(os.path.dirname(d.getVar(\'FILE\', True)) + \'/../..\')}"\n'
+                'BBLAYERS = " \\\n'
+                '  ${BSPDIR}/sources/meta \\\n'
+                '  ${BSPDIR}/sources/meta-foo \\\n'
+                '"\n')
+write_eval_file('sources/meta/conf/layer.conf',
+                'BBPATH .= ":${LAYERDIR}"\n'
+                'BBFILE_PATTERN_core = "^${LAYERDIR_RE}/"\n')
+write_eval_file('sources/meta-foo/conf/layer.conf',
+                'BBPATH .= ":${LAYERDIR}"\n'
+                'FOO_LAYER_DIR = "${LAYERDIR}"\n')
+write_eval_file('sources/meta/conf/bitbake.conf',
+                'include conf/local.conf\n'
+                'require conf/machine/${MACHINE}.conf\n'
+                'include conf/nonexistent.conf\n'
+                'include conf/${UNKNOWN}.conf\n'
+                'OVERRIDES = "${MACHINEOVERRIDES}:${DISTRO}"\n'
+                'python () {\n'
+                '    NOT_SET = "1"\n'
+                '}\n'
+                'def foo(d):\n'
+                '    ALSO_NOT_SET = "1"\n'
+                '    return 1\n'
+                'unset UNSET_ME\n')
+write_eval_file('sources/meta-foo/conf/machine/foo-board.conf',
+                'MACHINEOVERRIDES =. "mx6:${MACHINE}"\n'
+                'FEATURES:append:mx6 = " mx6"\n'
+                'FEATURES:append:other = " other"\n')
+write_eval_file('build/conf/local.conf',
+                'MACHINE ??= "qemuarm"\n'
+                'MACHINE ?= "foo-board"\n'
+                'DISTRO = "poky"\n'
+                'DISTRO ?= "other"\n'
+                'WEAK ??= "weak"\n'
+                'WEAK += "appended"\n'
+                'DEFAULT ??= "first"\n'
+                'DEFAULT ??= "second"\n'
+                'FEATURES = "a b c"\n'
+                'FEATURES += "d"\n'
+                'FEATURES:remove = "b ${REMOVED}"\n'
+                'REMOVED = "c"\n'
+                'FEATURES:prepend = "z "\n'
+                'PRIORITY = "low"\n'
+                'PRIORITY:mx6 = "mx6"\n'
+                'PRIORITY:foo-board = "foo-board"\n'
+                'LAZY = "${MACHINE}"\n'
+                'IMMEDIATE := "${DISTRO}"\n'
+                'DISTRO:forcevariable = "ignored"\n'
+                'CONTAINS = "${@bb.utils.contains(\'FEATURES\', \'a d\', \'yes\', \'no\', d)}"\n'
+                'CONDITIONAL = "${@oe.utils.conditional(\'DISTRO\', \'poky\', \'yes\', \'no\', d)}"\n'
+                'UNSAFE = "${@open(\'/etc/passwd\').read()}"\n'
+                'UNKNOWN_REF = "${NOT_DEFINED} ${@d.getVar(\'MACHINE\').upper()}"\n'
+                'UNSET_ME = "1"\n'
+                'FLAG[doc] = "not a value"\n'
+                'SELF = "${SELF} loop"\n'
+                'export EMPTY = ""\n')
+build_path = os.path.join(eval_root, 'build')
+evaluator = build_dir_evaluator(build_path, env={'MACHINE': 'foo-board', 'BB_ENV_PASSTHROUGH_ADDITIONS': 'MACHINE'})
+assert evaluator.get('BSPDIR') == eval_root
+assert evaluator.get('BBLAYERS').split() == [os.path.join(eval_root, 'sources', 'meta'),
+                                            os.path.join(eval_root, 'sources', 'meta-foo')]
+assert evaluator.get('BBPATH') == ':'.join([build_path,
+                                            os.path.join(eval_root, 'sources', 'meta'),
+                                            os.path.join(eval_root, 'sources', 'meta-foo')])
+assert evaluator.get('FOO_LAYER_DIR') == os.path.join(eval_root, 'sources', 'meta-foo')
+assert evaluator.get('BBFILE_PATTERN_core') == '^%s/' % re.escape(os.path.join(eval_root, 'sources', 'meta'))
+assert evaluator.get('LAYERDIR') is None
+assert evaluator.files == [os.path.join(build_path, 'conf', 'bblayers.conf'),
+                           os.path.join(eval_root, 'sources', 'meta', 'conf', 'layer.conf'),
+                           os.path.join(eval_root, 'sources', 'meta-foo', 'conf', 'layer.conf'),
+                           os.path.join(eval_root, 'sources', 'meta', 'conf', 'bitbake.conf'),
+                           os.path.join(build_path, 'conf', 'local.conf'),
+                           os.path.join(eval_root, 'sources', 'meta-foo', 'conf', 'machine', 'foo-board.conf')]
+assert evaluator.get('MACHINE') == 'foo-board'
+assert evaluator.get('DISTRO') == 'poky'
+assert evaluator.get('WEAK') == ' appended'
+assert evaluator.get('DEFAULT') == 'second'
+assert evaluator.get('OVERRIDES') == 'mx6:foo-board:poky'
+assert evaluator.get('FEATURES') == 'z a   d mx6'
+assert evaluator.get('FEATURES', expand=False) == 'z a   d mx6'
+assert evaluator.get('PRIORITY') == 'foo-board'
+assert evaluator.get('LAZY') == 'foo-board'
+assert evaluator.get('LAZY', expand=False) == '${MACHINE}'
+assert evaluator.get('IMMEDIATE') == 'poky'
+assert evaluator.get('CONTAINS') == 'yes'
+assert evaluator.get('CONDITIONAL') == 'yes'
+assert evaluator.get('UNSAFE') == "${@open('/etc/passwd').read()}"
+assert evaluator.get('UNKNOWN_REF') == '${NOT_DEFINED} FOO-BOARD'
+assert evaluator.get('SELF') == '${SELF} loop'
+assert evaluator.get('EMPTY') == ''
+for var in ['NOT_SET', 'ALSO_NOT_SET', 'UNSET_ME', 'FLAG', 'FILE']:
+    assert evaluator.get(var) is None, var
+
+## Without MACHINE in the environment, local.conf sets it
+assert build_dir_evaluator(build_path, env={}).get('MACHINE') == 'foo-board'
+## Contents given in place of files
+local_conf_file = os.path.join(build_path, 'conf', 'local.conf')
+evaluator = build_dir_evaluator(build_path,
+                                contents={local_conf_file: 'MACHINE = "foo-board"\nDISTRO = "other"\n'},
+                                env={})
+assert evaluator.get('DISTRO') == 'other'
+try:
+    build_dir_evaluator(build_path, contents={local_conf_file: 'MACHINE = "bar-board"\n'}, env={})
+    assert False, 'the required machine configuration does not exist'
+except Exception as e:
+    assert 'bar-board.conf' in str(e)
+shutil.rmtree(eval_root)
+
+###
+### Setting up build directories
+###
+def make_setup_platform(bblayers, hook):
+    ''' Create a platform whose oe-init-build-env writes bblayers to
+    bblayers.conf, with a meta-foo layer depending on core, whose hook
+    script is hook '''
+    root = tempfile.mkdtemp()
+    files = { 'sources/poky/meta/conf/layer.conf':
+                  'BBFILE_COLLECTIONS += "core"\nBBFILE_PRIORITY_core = "5"\n',
+              'sources/poky/meta/conf/machine/qemuarm.conf': '',
+              'sources/meta-foo/conf/layer.conf':
+                  'BBFILE_COLLECTIONS += "foo"\nBBFILE_PRIORITY_foo = "6"\nLAYERDEPENDS_foo = "core"\n',
+              'sources/meta-foo/setup-environment.d/hook.py': hook,
+              'sources/poky/bblayers.conf.sample': bblayers,
+              'sources/poky/oe-init-build-env':
+                  'mkdir -p $1/conf\n'
+                  '[ -f $1/conf/local.conf ] || echo \'MACHINE ??= "qemuarm"\' > $1/conf/local.conf\n'
+                  '[ -f $1/conf/bblayers.conf ] || cp %s/sources/poky/bblayers.conf.sample $1/conf/bblayers.conf\n'
+                  'export BUILDDIR=$1\n' % root }
+    for path, content in files.items():
+        os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+        with open(os.path.join(root, path), 'w') as f:
+            f.write(content)
+    return root
+
+def setup_build_dir(root, build_dir, env={}):
+    with modified_environ(env, unset=['MACHINE']):
+        SetupContext(root).setup(build_dir)
+
+## Update mode: hook assignments are updated in place, not added again
+update_root = make_setup_platform('BBLAYERS ?= "${TOPDIR}/../sources/poky/meta"\n',
+                                  'def hook_after_init():\n'
+                                  '    set_var("HOOK_VAR", "x")\n'
+                                  '    append_var("HOOK_LIST", "y")\n'
+                                  'run_after_init(hook_after_init)\n')
+update_local_conf = os.path.join(update_root, 'build', 'conf', 'local.conf')
+update_contents = []
+for i in range(3):
+    setup_build_dir(update_root, 'build', {'SETUP_ENVIRONMENT_UPDATE_CONFS': '1'})
+    with open(update_local_conf) as f:
+        update_contents.append(f.read())
+assert update_contents[0] == update_contents[1] == update_contents[2]
+assert update_contents[0].count('HOOK_VAR') == 1
+assert update_contents[0].count('HOOK_LIST') == 1
+## MACHINE is weakly set where oe-init-build-env put it
+assert update_contents[0].startswith("MACHINE ?= 'qemuarm'\n")
+shutil.rmtree(update_root)
+
+## Hook scripts see the build directory being set up
+build_dir_root = make_setup_platform('BBLAYERS ?= "${TOPDIR}/../sources/poky/meta"\n',
+                                     'def hook_after_init():\n'
+                                     '    set_var("HOOK_BUILD_DIR", build_dir)\n'
+                                     '    set_var("HOOK_ENV_FILE", str(env_file))\n'
+                                     'run_after_init(hook_after_init)\n')
+setup_build_dir(build_dir_root, 'build')
+with open(os.path.join(build_dir_root, 'build', 'conf', 'local.conf')) as f:
+    build_dir_local_conf = f.read()
+assert "HOOK_BUILD_DIR = 'build'\n" in build_dir_local_conf
+assert "HOOK_ENV_FILE = 'None'\n" in build_dir_local_conf
+assert setup_environment_internal.build_dir == 'build'
+shutil.rmtree(build_dir_root)
+
+## An unknown MACHINE is only warned about, BitBake has the final word
+machine_root = make_setup_platform('BBLAYERS ?= "${TOPDIR}/../sources/poky/meta"\n', '')
+setup_build_dir(machine_root, 'build', {'MACHINE': 'qemuarn'})
+with open(os.path.join(machine_root, 'build', 'conf', 'local.conf')) as f:
+    assert "MACHINE ?= 'qemuarn'\n" in f.read()
+shutil.rmtree(machine_root)
+
+## A failing target does not stop the other ones in batch mode
+batch_root = make_setup_platform('BBLAYERS ?= "${TOPDIR}/../sources/poky/meta"\n',
+                                 'def hook_after_init():\n'
+                                 '    if build_dir == "build-bad":\n'
+                                 '        raise RuntimeError("hook failure")\n'
+                                 'run_after_init(hook_after_init)\n')
+SetupContext(batch_root).activate()
+with modified_environ(unset=['MACHINE']):
+    assert setup_build_dirs(['build-bad', 'build-good:qemuarm']) == ['build-bad']
+assert os.path.exists(os.path.join(batch_root, 'build-good', 'conf', 'local.conf'))
+shutil.rmtree(batch_root)
+
+## Layer dependencies are checked against the expanded BBLAYERS
+append_foo_hook = ('def hook_after_init():\n'
+                   '    append_layer(PLATFORM_ROOT_DIR + "/sources/meta-foo")\n'
+                   'run_after_init(hook_after_init)\n')
+layers_root = make_setup_platform('BSPDIR := "${@os.path.abspath(os.path.dirname(d.getVar(\'FILE\', True)) + \'/../..\')}"\n'
+                                  'BBLAYERS = "${BSPDIR}/sources/poky/meta"\n',
+                                  append_foo_hook)
+setup_build_dir(layers_root, 'build')
+with open(os.path.join(layers_root, 'build', 'conf', 'bblayers.conf')) as f:
+    assert '/sources/meta-foo' in f.read()
+shutil.rmtree(layers_root)
+
+## The configuration files created from the templates are removed, so
+## that setting up again fails again
+layers_root = make_setup_platform('BBLAYERS = ""\n', append_foo_hook)
+for i in range(2):
+    try:
+        setup_build_dir(layers_root, 'build')
+        assert False, 'meta-foo depends on core, which is not in BBLAYERS'
+    except SystemExit as e:
+        assert e.code == 1
+    assert not os.path.exists(os.path.join(layers_root, 'build', 'conf', 'local.conf'))
+    assert not os.path.exists(os.path.join(layers_root, 'build', 'conf', 'bblayers.conf'))
+shutil.rmtree(layers_root)
+
+## Dependencies are not checked when BBLAYERS can't be expanded
+layers_root = make_setup_platform('BBLAYERS = "${UNKNOWN}/meta"\n', append_foo_hook)
+setup_build_dir(layers_root, 'build')
+shutil.rmtree(layers_root)
+
+###
+### Daemon requests
+###
+daemon_root = make_setup_platform('BBLAYERS ?= "${TOPDIR}/../sources/poky/meta"\n', '')
+setup_build_dir(daemon_root, 'build')
+backdate(daemon_root)
+
+saved_cache_dir = setup_environment_internal.CACHE_DIR
+setup_environment_internal.CACHE_DIR = os.path.join(daemon_root, 'cache')
+## Nor does it serve requests with a script modified in the last
+## seconds
+while setup_environment_internal._stat_key(setup_environment_internal.__file__) is None:
+    time.sleep(0.5)
+daemon_pid = os.fork()
+if daemon_pid == 0:
+    try:
+        ## The BSP refuses to be used as root, which the tests may be run as
+        os.getuid = lambda: 1000
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        ## Request handlers write to the standard outputs received from
+        ## the client, through file descriptors 1 and 2, even when
+        ## sys.stdout and sys.stderr were replaced (e.g., by pytest)
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        serve(daemon_root)
+    finally:
+        os._exit(0)
+for i in range(100):
+    if os.path.exists(daemon_socket_path(daemon_root)):
+        break
+    time.sleep(0.1)
+
+def daemon_request_output(argv, env={}):
+    ''' Return the status daemon_request() returns for argv (with env
+    added to the environment) and what the daemon wrote to the standard
+    outputs '''
+    saved_cwd = os.getcwd()
+    os.chdir(daemon_root)
+    saved_fds = [ os.dup(1), os.dup(2) ]
+    with tempfile.TemporaryFile() as output, modified_environ(env):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(output.fileno(), 1)
+        os.dup2(output.fileno(), 2)
+        try:
+            status = daemon_request(['setup-environment-internal.py'] + argv)
+        finally:
+            for fd, saved_fd in zip([1, 2], saved_fds):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+            os.chdir(saved_cwd)
+        output.seek(0)
+        return status, output.read().decode()
+
+try:
+    ## The daemon writes to the standard outputs of the client and
+    ## exits with the status of the request
+    status, output = daemon_request_output(['--eval', 'build', 'MACHINE'])
+    assert status == 0
+    assert 'qemuarm' in output
+    status, output = daemon_request_output(['--eval', 'build'])
+    assert status == 1
+    assert output.startswith('Usage: ')
+
+    ## Requests with different settings are left to the client
+    assert daemon_request_output(['--eval', 'build', 'MACHINE'],
+                                 {'SETUP_ENVIRONMENT_REFRESH': '1'}) == (None, '')
+
+    ## Machines added after the daemon started are found
+    status, output = daemon_request_output(['--plan', 'build'], {'MACHINE': 'qemunew'})
+    assert "MACHINE 'qemunew' is not provided by any layer" in output
+    machines_dir = os.path.join(daemon_root, 'sources', 'poky', 'meta', 'conf', 'machine')
+    with open(os.path.join(machines_dir, 'qemunew.conf'), 'w') as f:
+        f.write('')
+    backdate(machines_dir, 1800)
+    status, output = daemon_request_output(['--plan', 'build'], {'MACHINE': 'qemunew'})
+    assert "MACHINE 'qemunew' is not provided by any layer" not in output
+finally:
+    os.kill(daemon_pid, signal.SIGTERM)
+    os.waitpid(daemon_pid, 0)
+    setup_environment_internal.CACHE_DIR = saved_cache_dir
+    shutil.rmtree(daemon_root)
+
+###
+### Streaming reader
+###
+conf1_assignments = iter_assignments('test-data/conf1')
+assert next(conf1_assignments) == ('BB_NUMBER_THREADS', '=', ['8'])
+conf1_assignments.close()
+conf1 = Conf('test-data/conf1', quiet=True)
+conf1.read_conf()
+assert list(iter_assignments('test-data/conf1')) == conf1.conf_data
+with open('test-data/conf1') as f:
+    conf1_text = f.read()
+assert ''.join([ text for text, _ in logical_lines(read_lines('test-data/conf1')) ]) == conf1_text
+assert [ line for _, line in logical_lines(['A = "1 \\\n', '  2"\n', '# c\n', 'B = "3"\n']) ] == \
+    ['A = "1   2"\n', None, 'B = "3"\n']
+stream_dir = tempfile.mkdtemp()
+with open(os.path.join(stream_dir, 'crlf.conf'), 'wb') as f:
+    f.write(b'A = "1"\r\nB = "2 \\\r\n 3"\r\n')
+assert list(iter_assignments(os.path.join(stream_dir, 'crlf.conf'))) == [('A', '=', ['1']), ('B', '=', ['2', '3'])]
+open(os.path.join(stream_dir, 'empty.conf'), 'w').close()
+assert list(iter_assignments(os.path.join(stream_dir, 'empty.conf'))) == []
+shutil.rmtree(stream_dir)
+
 print('All fine!')